@@ -34,6 +34,7 @@ class ConduitContent(BaseModel):
     name: str
     formula_error: str = ""
     styles: dict[str, dict[str, str]] = {}
+    palette: dict[str, str] = {}  # styles referenced from `styles` as "@key", shared by many cells
     real_indices: list[int] = []  # old index for problems, -1 for virtual columns like "sum"
     limited_columns: list[str] = []
     limited_rows: list[str] = []
@@ -4,7 +4,7 @@ from pydantic import BaseModel
 
 from pyconduit.shared.datastore import datastore_manager, deatomize
 
-datastore = datastore_manager.get("sheets")
+datastore = datastore_manager.scoped("sheets")
 
 
 class LatexObject(BaseModel, abc.ABC):
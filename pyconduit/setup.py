@@ -1,6 +1,7 @@
+import json
 import os
 import secrets
-import shutil
+import statistics
 import subprocess
 import sys
 import time
@@ -13,8 +14,50 @@ from pyconduit.website.decorators import create_access_token
 
 
 @click.group()
-def cli():
-    pass
+@click.option("--tenant", default=None, help="Course to work on, see datastore.tenants in the config")
+def cli(tenant: str):
+    from pyconduit.shared.datastore import datastore_tenant, datastore_tenants
+
+    # Registers the summary of the sheets, so that the commands which write sheets keep it in their index
+    from pyconduit.shared.init import sheet_summary  # noqa: F401
+
+    if tenant is not None and tenant not in datastore_tenants:
+        raise click.BadParameter(f"not one of {datastore_tenants}", param_hint="--tenant")
+    datastore_tenant.set(tenant)
+
+
+def generate_sheets(sheet_count: int, user_count: int = 30, problem_count: int = 40) -> dict:
+    users = [f"student_{i}" for i in range(user_count)]
+    problem_names = [str(i) for i in range(problem_count)]
+    return {
+        f"{i:03}": {
+            "latex": {
+                "objects": [
+                    dict(
+                        cls="problem",
+                        text=f"Problem {name}",
+                        num=f"{name}.",
+                        conduit_num=name,
+                        nlb=True,
+                        nla=True,
+                        inline=False,
+                        conduit_include=True,
+                    )
+                    for name in problem_names
+                ],
+                "orig_doc": "",
+                "sheet_id": f"{i:03}",
+                "sheet_name": f"Sheet {i}",
+                "conduit_strategy": "cache-optimal",
+            },
+            "conduit": {
+                "content": {user: ["1;01.09.2023;Teacher;Teacher" for _ in problem_names] for user in users},
+                "problem_names": problem_names,
+                "problem_text_cache": [f"Problem {name}" for name in problem_names],
+            },
+        }
+        for i in range(sheet_count)
+    }
 
 
 @cli.command()
@@ -57,16 +100,99 @@ def create_admin():
 
 
 @cli.command()
-def backup_database():
-    backup_folder = "backups/"
-    os.makedirs(backup_folder, exist_ok=True)
-    current_backups = os.listdir(backup_folder)
-    if len(current_backups) > 5:
-        current_backups.sort()
-        shutil.rmtree(backup_folder + current_backups[0])
+@click.option(
+    "--keep", default=None, type=int, help="Number of backups to keep, backup-keep from the config by default"
+)
+def backup_database(keep: None | int):
+    from pyconduit.shared.backups import BackupStore, create_backup
+    from pyconduit.shared.datastore import cfg
+
+    store = BackupStore(cfg["datastore"].get("backup-folder", "backups"))
+    manifest = create_backup(store)
+    click.echo(
+        f"Backup {manifest['created']}: {len(manifest['files'])} files, {manifest['size'] / 1024 / 1024:.1f} MB, "
+        f"{manifest['written'] / 1024 / 1024:.2f} MB written in {manifest['seconds']:.2f}s"
+    )
+
+    removed, removed_chunks = store.collect(keep or cfg["datastore"].get("backup-keep", 30))
+    if removed:
+        click.echo(f"Removed {removed} old backups and {removed_chunks} unused chunks")
+
+
+@cli.command()
+def list_backups():
+    from pyconduit.shared.backups import BackupStore
+    from pyconduit.shared.datastore import cfg
+
+    store = BackupStore(cfg["datastore"].get("backup-folder", "backups"))
+    for name in store.manifests():
+        manifest = store.read_manifest(name)
+        click.echo(
+            f"{name} {manifest['backend']:>6} {len(manifest['files']):>6} files "
+            f"{manifest['size'] / 1024 / 1024:>8.1f} MB, {manifest['written'] / 1024 / 1024:>8.2f} MB written"
+        )
+
 
-    new_path = backup_folder + "backup_" + str(int(time.time()))
-    subprocess.run(["cp", "-r", "json-db", new_path])
+@cli.command()
+@click.argument("name", default="latest")
+@click.option("--target", default=None, help="Folder to restore into, the data folder by default")
+@click.option("--force", is_flag=True, help="Move an existing target folder aside instead of failing")
+def restore_database(name: str, target: None | str, force: bool):
+    """
+    Restore a backup made by backup-database. Stop the server before restoring into its data folder.
+    """
+    from pyconduit.shared.backups import BackupStore, restore_backup
+    from pyconduit.shared.datastore import cfg
+
+    store = BackupStore(cfg["datastore"].get("backup-folder", "backups"))
+    target = target or cfg["datastore"]["data-folder"]
+    if os.path.exists(target):
+        if not force:
+            raise click.ClickException(f"{target} already exists, use --force to move it aside")
+        aside = f"{target}.before-restore-{int(time.time())}"
+        os.rename(target, aside)
+        click.echo(f"Moved {target} to {aside}")
+
+    manifest = restore_backup(store, name, target)
+    if manifest["backend"] != cfg["datastore"]["backend"]:
+        click.echo(f"Warning: the backup was made with the {manifest['backend']} backend")
+    click.echo(f"Restored {manifest['created']} into {target} ({len(manifest['files'])} files)")
+
+
+@cli.command()
+@click.argument("json_folder", default="json-db")
+@click.option("--backend", default="sqlite", help="Datastore backend to import into")
+def import_json(json_folder: str, backend: str):
+    from pyconduit.shared.datastore import DatastoreJSON, DatastoreManager, JSONSerializer, find_categories
+
+    manager = DatastoreManager(backend)
+    for category in find_categories(json_folder, {JSONSerializer.extension}):
+        # Only read, pending journal records and sharded roots are picked up without folding them into the files
+        data = DatastoreJSON.readFolder(json_folder, category)
+        datastore = manager.get(category)
+        with datastore.operation():
+            for key, value in data.items():
+                datastore[key] = value
+        datastore.flush()
+        click.echo(f"Imported {category} ({len(data)} keys)")
+
+
+@cli.command()
+@click.argument("json_folder", default="json-export")
+def export_json(json_folder: str):
+    """
+    Write every category of the configured datastore as indented JSON files, which import-json reads back.
+    """
+    from pyconduit.shared.datastore import datastore_manager, deatomize, find_categories, snapshotSerializers
+
+    extensions = {serializer.extension for serializer in snapshotSerializers.values()} | {".sqlite3"}
+    for category in find_categories(datastore_manager.get("sheets").baseDataFolder, extensions):
+        data = deatomize(datastore_manager.get(category).data)
+        filename = os.path.join(json_folder, f"{category}.json")
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, "w") as f:
+            json.dump(data, f, indent=2, ensure_ascii=False)
+        click.echo(f"Exported {category} ({len(data)} keys)")
 
 
 @cli.command()
@@ -74,14 +200,13 @@ def backup_database():
 @click.argument("user_order_file")
 @click.argument("conduit_tsv")
 def import_conduits(sheet_id: str, user_order_file: str, conduit_tsv: str):
+    from pyconduit.shared.account_index import account_index
     from pyconduit.shared.datastore import datastore_manager
 
-    accounts = datastore_manager.get("accounts")
     with open(user_order_file) as f:
         user_order = [line.strip() for line in f]
 
-    username_dict = {x.name: x.login for x in accounts.accounts.values() if not x.virtual}
-    user_order = [username_dict[x] for x in user_order]
+    user_order = [account_index.login_by_name(x) for x in user_order]
 
     with open(conduit_tsv) as f:
         conduit_data = [line.replace(" ", "").replace("\n", "").split("\t") for line in f]
@@ -127,7 +252,7 @@ def create_techops_bot():
 @cli.command()
 def precompute_conduits():
     from pyconduit.models.conduit import Conduit
-    from pyconduit.shared.conduit_postprocessing import calculate_with_formula, get_all_users
+    from pyconduit.shared.conduit_postprocessing import calculate_with_formula, fill_rows, get_all_users
     from pyconduit.shared.datastore import datastore_manager, deatomize
 
     sheets = datastore_manager.get("sheets")
@@ -144,6 +269,7 @@ def precompute_conduits():
 
         conduit = Conduit.parse_obj(deatomize(sheet.conduit))
         users = get_all_users(conduit)
+        fill_rows(conduit, users)
         precomputed[sheet_id] = calculate_with_formula(conduit, sheet_id, sheet.latex.sheet_name, users, formula)
 
     with sheets.operation():
@@ -153,5 +279,274 @@ def precompute_conduits():
     subprocess.run(["killall", "uvicorn"])
 
 
+@cli.command()
+@click.option("--sizes", default="10,100,500", help="Comma-separated sheet counts to benchmark")
+@click.option("--saves", default=50, help="Number of single-cell saves per measurement")
+def benchmark_datastore(sizes: str, saves: int):
+    from pyconduit.shared.datastore import DatastoreManager
+
+    manager = DatastoreManager("json", prefix="benchmark")
+    click.echo(f"{'sheets':>8} {'size, MB':>10} {'journal, ms':>12} {'rewrite, ms':>12}")
+    for sheet_count in map(int, sizes.split(",")):
+        datastore = manager.get(f"sheets_{sheet_count}")
+        with datastore.operation():
+            datastore.sheets = generate_sheets(sheet_count)
+        datastore.flush()
+        datastore.checkpoint()
+
+        timings = {}
+        for use_journal in (True, False):
+            datastore.useJournal = use_journal
+            samples = []
+            for i in range(saves):
+                start = time.perf_counter()
+                with datastore.operation():
+                    datastore.sheets["000"].conduit.content["student_0"][i % 40] = str(i)
+                datastore.flush()
+                samples.append(time.perf_counter() - start)
+            timings[use_journal] = statistics.median(samples) * 1000
+
+        size = os.path.getsize(datastore.filename) / 1024 / 1024
+        click.echo(f"{sheet_count:>8} {size:>10.1f} {timings[True]:>12.3f} {timings[False]:>12.3f}")
+        datastore.wipe()
+
+
+@cli.command()
+@click.option("--sheets", default=300, help="Number of sheets in the synthetic database")
+@click.option("--users", default=40, help="Number of students per conduit")
+def benchmark_datastore_memory(sheets: int, users: int):
+    import gc
+    import tracemalloc
+
+    from pyconduit.shared.datastore import AtomicDict, deatomize
+
+    class EagerNode:
+        # The layout used before the wrappers became lazy: every dictionary and list of the tree
+        # was wrapped at load time into an object with a __dict__ and a precomputed path
+        def __init__(self, parent, data, path):
+            self.parent = parent if parent is not None else self
+            self._data = data
+            self.path = path
+            self.updates = self.parent.updates if parent is not None else {}
+
+    def eager_atomize(parent, value, path):
+        if isinstance(value, dict):
+            return EagerNode(parent, {k: eager_atomize(parent, v, f"{path}{k}.") for k, v in value.items()}, path)
+        elif isinstance(value, list):
+            return EagerNode(parent, [eager_atomize(parent, v, f"{path}{i}.") for i, v in enumerate(value)], path)
+        return value
+
+    serialized = json.dumps({"sheets": generate_sheets(sheets, users)})
+
+    def measure(build):
+        gc.collect()
+        tracemalloc.start()
+        start = time.perf_counter()
+        result = build()
+        elapsed = time.perf_counter() - start
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        return result, size / 1024 / 1024, elapsed * 1000
+
+    def build_eager():
+        root = EagerNode(None, {}, "")
+        root._data.update({k: eager_atomize(root, v, f"{k}.") for k, v in json.loads(serialized).items()})
+        return root
+
+    def build_lazy():
+        root = AtomicDict({})
+        root.direct_update(**json.loads(serialized))
+        return root
+
+    click.echo(f"{sheets} sheets x {users} users, {len(serialized) / 1024 / 1024:.1f} MB of JSON")
+    click.echo(f"{'layout':>8} {'memory, MB':>12} {'load, ms':>10}")
+    for name, build in (("raw", lambda: json.loads(serialized)), ("eager", build_eager), ("lazy", build_lazy)):
+        result, size, elapsed = measure(build)
+        click.echo(f"{name:>8} {size:>12.1f} {elapsed:>10.0f}")
+        del result
+
+    root = build_lazy()
+    assert deatomize(root.sheets["000"]) == json.loads(serialized)["sheets"]["000"]
+
+
+@cli.command()
+@click.option("--size", default=50, help="Size of the generated dataset as indented JSON, MB")
+@click.option("--repeat", default=3, help="Number of measurements per serializer, the best one is shown")
+def benchmark_serializers(size: int, repeat: int):
+    import tempfile
+
+    from pyconduit.shared.datastore import DatastoreJSON, snapshotSerializers
+
+    sheet_size = len(json.dumps(generate_sheets(10), indent=2)) / 10
+    # Round trip through JSON so that no object is shared between sheets, like in a loaded datastore
+    data = json.loads(json.dumps({"sheets": generate_sheets(int(size * 1024 * 1024 / sheet_size) + 1), "formulas": ""}))
+
+    click.echo(f"{'format':>8} {'size, MB':>10} {'save, ms':>10} {'load, ms':>10}")
+    with tempfile.TemporaryDirectory() as folder:
+        for name, serializer in snapshotSerializers.items():
+            datastore = type("DatastoreBenchmark", (DatastoreJSON,), {"serializer": serializer})
+            filename = os.path.join(folder, f"snapshot{serializer.extension}")
+            saves, loads = [], []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                datastore.writeFile(filename, data)
+                saves.append(time.perf_counter() - start)
+
+                start = time.perf_counter()
+                loaded = datastore.readFile(filename)
+                loads.append(time.perf_counter() - start)
+            assert loaded == data
+
+            file_size = os.path.getsize(filename) / 1024 / 1024
+            click.echo(f"{name:>8} {file_size:>10.1f} {min(saves) * 1000:>10.0f} {min(loads) * 1000:>10.0f}")
+
+
+def stress_manager(backend: str, folder: None | str):
+    from pyconduit.shared.datastore import DatastoreManager
+
+    manager = DatastoreManager(backend, prefix="stress", shared=True)
+    if folder is not None:
+        # A subclass, so that the other datastores of the process keep their data folder
+        manager.accountCtor = type(manager.accountCtor.__name__, (manager.accountCtor,), {"baseDataFolder": folder})
+    return manager
+
+
+def stress_worker(
+    backend: str, folder: None | str, worker: int, sheet_count: int, operations: int, barrier, results
+) -> None:
+    from pyconduit.shared.datastore import deatomize
+
+    datastore = stress_manager(backend, folder).get("sheets")
+    barrier.wait()
+    start = time.perf_counter()
+    for i in range(operations):
+        with datastore.operation():
+            # Every worker writes its own keys, so no write is lost and all processes have to agree at the end
+            datastore.sheets[f"{i % sheet_count:03}"].conduit.content[f"worker_{worker}_{i}"] = [str(i)]
+            datastore.counters[str(worker)] = i + 1
+    datastore.flush()
+    elapsed = time.perf_counter() - start
+
+    barrier.wait()
+    datastore.refresh()
+    state = {"sheets": deatomize(datastore.sheets), "counters": deatomize(datastore.counters)}
+    results.put((worker, elapsed, json.dumps(state, sort_keys=True)))
+
+
+def stress(
+    backend: str, workers: int, operations: int, sheets: int, folder: None | str = None
+) -> tuple[str, list[tuple[int, float, str]], str]:
+    """
+    Edit a shared datastore in `folder`, the configured data folder by default, from several processes at once.
+    Returns the expected state, the (worker, seconds, state) every process ended with and the state
+    a fresh process loads, all as JSON.
+    """
+    import multiprocessing
+
+    from pyconduit.shared.datastore import deatomize
+
+    datastore = stress_manager(backend, folder).get("sheets")
+    with datastore.operation():
+        datastore.sheets = generate_sheets(sheets, user_count=0)
+        datastore.counters = {}
+    datastore.flush()
+
+    context = multiprocessing.get_context("spawn")
+    barrier = context.Barrier(workers)
+    results = context.Queue()
+    processes = [
+        context.Process(target=stress_worker, args=(backend, folder, worker, sheets, operations, barrier, results))
+        for worker in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    states = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+
+    expected = generate_sheets(sheets, user_count=0)
+    for worker in range(workers):
+        for i in range(operations):
+            expected[f"{i % sheets:03}"]["conduit"]["content"][f"worker_{worker}_{i}"] = [str(i)]
+    expected = json.dumps(
+        {"sheets": expected, "counters": {str(worker): operations for worker in range(workers)}}, sort_keys=True
+    )
+    reloaded = stress_manager(backend, folder).get("sheets")
+    state = json.dumps({"sheets": deatomize(reloaded.sheets), "counters": deatomize(reloaded.counters)}, sort_keys=True)
+    reloaded.wipe()
+    return expected, sorted(states), state
+
+
+@cli.command()
+@click.option("--backend", default="json", help="Datastore backend to stress")
+@click.option("--workers", default=4, help="Number of processes editing at the same time")
+@click.option("--operations", default=200, help="Number of operations per process")
+@click.option("--sheets", default=10, help="Number of sheets the operations are spread over")
+def stress_datastore(backend: str, workers: int, operations: int, sheets: int):
+    """
+    Edit a shared datastore from several processes at once and check that they all converge
+    to the same state, which is also what a fresh process loads.
+    """
+    expected, states, state = stress(backend, workers, operations, sheets)
+    for worker, elapsed, worker_state in states:
+        click.echo(f"worker {worker}: {operations / elapsed:.0f} operations/s, converged: {worker_state == expected}")
+    click.echo(f"reloaded from disk, converged: {state == expected}")
+    if state != expected or any(worker_state != expected for _, _, worker_state in states):
+        raise click.ClickException("Datastore processes diverged")
+
+
+@cli.command()
+@click.option("--server", default=None, help="Address of a running website to report on, a fresh local load by default")
+@click.option("--login", default=None, help="Admin account the request to the server is authorized as")
+@click.option("--memory", is_flag=True, help="Also measure the memory used by every category, which is slow")
+def datastore_report(server: None | str, login: None | str, memory: bool):
+    """
+    Show the datastore counters: load and commit latency, bytes written per category
+    and the operations, updates and payload of every route that saved something.
+    """
+    if server is not None:
+        import urllib.request
+
+        if login is None:
+            raise click.ClickException("--login is required with --server")
+        token = create_access_token(dict(sub=f"user:{login}"), expire=timedelta(minutes=5))
+        request = urllib.request.Request(
+            f"{server.rstrip('/')}/admin/datastore-stats?memory={str(memory).lower()}",
+            headers={"Authorization": f"Bearer {token}"},
+        )
+        with urllib.request.urlopen(request) as response:
+            stats = json.load(response)
+    else:
+        from pyconduit.shared.datastore import cfg, datastore_manager, find_categories
+
+        for category in find_categories(cfg["datastore"]["data-folder"], {".json", ".marshal", ".sqlite3"}):
+            datastore_manager.get(category)
+        stats = datastore_manager.stats(memory)
+
+    click.echo(
+        f"{'category':<24}{'load ms':>10}{'commits':>9}{'p50 ms':>9}{'p99 ms':>9}{'written MB':>12}{'memory MB':>11}"
+    )
+    for name, report in sorted(stats.items(), key=lambda item: -item[1]["bytes_written"]):
+        commits = report["commits"]
+        size = f"{report['memory'] / 1024 / 1024:.1f}" if "memory" in report else "-"
+        click.echo(
+            f"{name:<24}{report['loads']['total']:>10.1f}{commits['count']:>9}{commits['p50']:>9}{commits['p99']:>9}"
+            f"{report['bytes_written'] / 1024 / 1024:>12.2f}{size:>11}"
+        )
+
+    routes = {}
+    for name, report in stats.items():
+        for route, counters in report["routes"].items():
+            totals = routes.setdefault((route, name), {"operations": 0, "updates": 0, "payload": 0})
+            for key, value in counters.items():
+                totals[key] += value
+    if routes:
+        click.echo(f"\n{'route':<32}{'category':<24}{'operations':>11}{'updates':>9}{'payload KB':>12}")
+    for (route, name), totals in sorted(routes.items(), key=lambda item: -item[1]["payload"]):
+        click.echo(
+            f"{route:<32}{name:<24}{totals['operations']:>11}{totals['updates']:>9}{totals['payload'] / 1024:>12.1f}"
+        )
+
+
 if __name__ == "__main__":
     cli()
@@ -0,0 +1,112 @@
+import bisect
+import threading
+
+from pyconduit.models.user import UserSensitive, UserUnprivileged
+from pyconduit.shared.datastore import DatastoreHandle, TenantLocal, datastore_manager, deatomize
+
+
+class AccountIndex:
+    """
+    Parsed accounts with indexes by privilege and by name, and the roster of the accounts which take part
+    in conduits sorted by name. The change feed marks the changed accounts and they are indexed again
+    on the next read, a change of the whole root rebuilds everything.
+    """
+
+    def __init__(self, datastore: DatastoreHandle):
+        self.datastore = datastore
+        self.lock = threading.RLock()
+        # Ordered, so that new accounts are listed in the order they were added
+        self.dirty: None | dict[str, None] = None
+        self.users: dict[str, UserSensitive] = {}
+        self.privileges: dict[str, set[str]] = {}
+        self.names: dict[str, set[str]] = {}
+        self.roster_keys: list[tuple[str, str]] = []
+        self.roster_users: list[UserUnprivileged] = []
+        datastore.subscribe(("accounts",), self.invalidate)
+
+    def invalidate(self, op: str, path: tuple) -> None:
+        with self.lock:
+            if len(path) < 2:
+                self.dirty = None
+            elif self.dirty is not None:
+                self.dirty[path[1]] = None
+
+    def update(self) -> None:
+        with self.lock:
+            changed = None
+            if self.dirty is None:
+                self.dirty = {}
+                self.users, self.privileges, self.names = {}, {}, {}
+                self.roster_keys, self.roster_users = [], []
+            else:
+                changed, self.dirty = self.dirty, {}
+            if "accounts" not in self.datastore:
+                return
+
+            accounts = self.datastore.accounts
+            for login in accounts.keys() if changed is None else changed:
+                self.remove(login)
+                if login in accounts:
+                    self.add(UserSensitive.parse_obj(deatomize(accounts[login])))
+                else:
+                    self.users.pop(login, None)
+
+    def remove(self, login: str) -> None:
+        user = self.users.get(login)
+        if user is None:
+            return
+        # Kept in place, so that an updated account does not move to the end of the listing
+        for flag in user.privileges or ():
+            self.privileges[flag].discard(login)
+        self.names[user.name].discard(login)
+        if user.privileges and user.privileges.conduit_generation:
+            index = bisect.bisect_left(self.roster_keys, (user.name, login))
+            del self.roster_keys[index]
+            del self.roster_users[index]
+
+    def add(self, user: UserSensitive) -> None:
+        self.users[user.login] = user
+        for flag in user.privileges or ():
+            self.privileges.setdefault(flag, set()).add(user.login)
+        self.names.setdefault(user.name, set()).add(user.login)
+        if user.privileges and user.privileges.conduit_generation:
+            index = bisect.bisect_left(self.roster_keys, (user.name, user.login))
+            self.roster_keys.insert(index, (user.name, user.login))
+            self.roster_users.insert(index, UserUnprivileged(login=user.login, name=user.name))
+
+    def all(self) -> list[UserSensitive]:
+        with self.lock:
+            self.update()
+            return list(self.users.values())
+
+    def get(self, login: str) -> None | UserSensitive:
+        with self.lock:
+            self.update()
+            return self.users.get(login)
+
+    def with_privilege(self, flag: str) -> set[str]:
+        with self.lock:
+            self.update()
+            return set(self.privileges.get(flag, ()))
+
+    def login_by_name(self, name: str, virtual: bool = False) -> str:
+        """
+        Raises KeyError if no account (or no real account, unless `virtual`) has that name.
+        """
+        with self.lock:
+            self.update()
+            logins = sorted(login for login in self.names.get(name, ()) if virtual or not self.users[login].virtual)
+            if not logins:
+                raise KeyError(name)
+            return logins[0]
+
+    def roster(self) -> list[UserUnprivileged]:
+        """
+        Accounts which take part in conduits, sorted by name.
+        """
+        with self.lock:
+            self.update()
+            return list(self.roster_users)
+
+
+account_index = TenantLocal(lambda: AccountIndex(datastore_manager.get("accounts")))
@@ -0,0 +1,104 @@
+import contextlib
+import gzip
+import json
+import os
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from urllib.parse import quote
+
+from pyconduit.shared.datastore import DatastoreHandle, TenantLocal, datastore_manager, deatomize
+
+
+class Archive:
+    """
+    Cold storage for the values of one root of a datastore, such as the sheets of past terms.
+    Archived values leave the datastore for gzipped JSON files in the hidden `.archive` folder of the
+    data folder, which is not loaded. data[index][key] keeps the name and date of every archived value,
+    so the listing does not open the files and the other workers see it.
+    """
+
+    def __init__(self, datastore: DatastoreHandle, root: str, index: str, cached: int = 16):
+        self.datastore = datastore
+        self.root = root
+        self.index = index
+        self.folder = os.path.join(datastore.baseDataFolder, ".archive", datastore.category, root)
+        self.cached = cached
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    def filename(self, key: str) -> str:
+        return os.path.join(self.folder, f"{quote(key, safe='')}.json.gz")
+
+    def __contains__(self, key: str) -> bool:
+        return self.index in self.datastore and key in self.datastore[self.index]
+
+    def list(self) -> dict[str, dict]:
+        return deatomize(self.datastore[self.index]) if self.index in self.datastore else {}
+
+    def read(self, key: str):
+        """
+        Read an archived value, the last few are kept in memory. Raises KeyError if it is not archived.
+        """
+        # The archive date is in the cache key, so a value archived again by another worker is read again
+        version = (key, self.datastore[self.index][key]["archived"])
+        with self.lock:
+            if version in self.cache:
+                self.cache.move_to_end(version)
+                return self.cache[version]
+
+        with gzip.open(self.filename(key), "rt", encoding="utf-8") as f:
+            value = json.load(f)
+
+        with self.lock:
+            self.cache[version] = value
+            while len(self.cache) > self.cached:
+                self.cache.popitem(last=False)
+        return value
+
+    @contextlib.contextmanager
+    def operation(self, key: str):
+        """
+        An operation on data[root][key], which also holds data[index][key] as both are written.
+        The index is held until the operation is saved and always locked first, so archiving
+        and restoring do not deadlock each other.
+        """
+        with self.datastore.locks.hold((self.index, key)), self.datastore.operation(self.root, key):
+            yield
+
+    def archive(self, key: str, info: dict = None) -> None:
+        """
+        Move data[root][key] into the archive, `info` is listed along with it. Raises KeyError if there is no such value.
+        """
+        os.makedirs(self.folder, exist_ok=True)
+        with self.operation(key):
+            values = self.datastore[self.root]
+            if key not in values:
+                raise KeyError(key)
+
+            # Written before the value leaves the datastore, a crash in between leaves it in both places
+            temporary = f"{self.filename(key)}.tmp"
+            with gzip.open(temporary, "wt", encoding="utf-8") as f:
+                json.dump(deatomize(values[key]), f, ensure_ascii=False)
+            with open(temporary, "rb") as f:
+                os.fsync(f.fileno())
+            os.replace(temporary, self.filename(key))
+
+            self.datastore[self.index][key] = dict(info or {}, archived=datetime.now().isoformat(timespec="seconds"))
+            del values[key]
+
+    def restore(self, key: str) -> None:
+        """
+        Move an archived value back into data[root][key]. Raises KeyError if it is not archived.
+        """
+        value = self.read(key)
+        with self.operation(key):
+            if key not in self:
+                raise KeyError(key)
+            self.datastore[self.root][key] = value
+            del self.datastore[self.index][key]
+        self.datastore.flush()
+        os.remove(self.filename(key))
+
+
+sheet_archive = TenantLocal(lambda: Archive(datastore_manager.get("sheets"), "sheets", "archived"))
@@ -0,0 +1,295 @@
+import fcntl
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import time
+import zlib
+from datetime import datetime
+
+from pyconduit.shared.datastore import DatastoreJSON, cfg, find_categories, snapshotSerializers
+
+# Chunks end after a line whose hash is below a threshold proportional to its length, so they are
+# TargetChunkSize long on average, and an edit only changes the chunks around it
+MinChunkSize = 16 * 1024
+TargetChunkSize = 64 * 1024
+MaxChunkSize = 1024 * 1024
+CutThreshold = 2**32 // TargetChunkSize
+ReadSize = 4 * 1024 * 1024
+
+
+def content_chunks(f, size: int):
+    """
+    Split the first `size` bytes of a file into content-defined chunks. Boundaries only depend on the lines
+    before them, so unlike fixed offsets they stay in place when an edit changes the length of the file.
+    Binary files are split at their newline bytes too, and lines longer than MaxChunkSize where they are.
+    """
+    chunk, pending = bytearray(), b""
+    while size > 0:
+        block = f.read(min(ReadSize, size))
+        if not block:
+            break
+        size -= len(block)
+        pending += block
+        start = 0
+        while (end := pending.find(b"\n", start)) != -1:
+            line = pending[start : end + 1]
+            start = end + 1
+            chunk += line
+            if len(chunk) >= MaxChunkSize or (
+                len(chunk) >= MinChunkSize and zlib.crc32(line) < len(line) * CutThreshold
+            ):
+                yield bytes(chunk)
+                chunk = bytearray()
+        pending = pending[start:]
+        if len(chunk) + len(pending) >= MaxChunkSize:
+            chunk += pending
+            pending = b""
+            while len(chunk) >= MaxChunkSize:
+                yield bytes(chunk[:MaxChunkSize])
+                del chunk[:MaxChunkSize]
+    chunk += pending
+    if chunk:
+        yield bytes(chunk)
+
+
+def file_stamp(path: str) -> list[int]:
+    # Datastore files are replaced rather than rewritten, so an unchanged inode, size and mtime mean unchanged content
+    stat = os.stat(path)
+    return [stat.st_ino, stat.st_size, stat.st_mtime_ns]
+
+
+class BackupStore:
+    """
+    Backups are manifests listing every file of the datastore as a sequence of chunks.
+    Chunks are stored once by the SHA-256 of their content and compressed with gzip,
+    so a backup only adds the chunks which changed since any previous one.
+    """
+
+    def __init__(self, folder: str):
+        self.folder = folder
+        self.chunk_folder = os.path.join(folder, "chunks")
+        self.manifest_folder = os.path.join(folder, "manifests")
+
+    def chunk_path(self, digest: str) -> str:
+        return os.path.join(self.chunk_folder, digest[:2], f"{digest}.gz")
+
+    def write_chunk(self, data: bytes) -> tuple[str, int]:
+        """
+        Store a chunk unless it is already stored, returns the digest and the number of bytes written.
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.chunk_path(digest)
+        if os.path.exists(path):
+            return digest, 0
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        compressed = gzip.compress(data, mtime=0)
+        with open(f"{path}.tmp", "wb") as f:
+            f.write(compressed)
+        os.replace(f"{path}.tmp", path)
+        return digest, len(compressed)
+
+    def read_chunk(self, digest: str) -> bytes:
+        with open(self.chunk_path(digest), "rb") as f:
+            data = gzip.decompress(f.read())
+        if hashlib.sha256(data).hexdigest() != digest:
+            raise ValueError(f"Backup chunk {digest} is corrupted")
+        return data
+
+    def store_file(self, path: str, size: int) -> tuple[list[str], int]:
+        """
+        Store the first `size` bytes of a file, returns its chunks and the number of bytes written.
+        """
+        chunks, written = [], 0
+        with open(path, "rb") as f:
+            for chunk in content_chunks(f, size):
+                digest, chunk_written = self.write_chunk(chunk)
+                chunks.append(digest)
+                written += chunk_written
+        return chunks, written
+
+    def manifests(self) -> list[str]:
+        if not os.path.isdir(self.manifest_folder):
+            return []
+        return sorted(name[:-5] for name in os.listdir(self.manifest_folder) if name.endswith(".json"))
+
+    def read_manifest(self, name: str) -> dict:
+        if name == "latest":
+            manifests = self.manifests()
+            if not manifests:
+                raise FileNotFoundError(f"No backups in {self.folder}")
+            name = manifests[-1]
+        with open(os.path.join(self.manifest_folder, f"{name}.json"), "r") as f:
+            return json.load(f)
+
+    def write_manifest(self, manifest: dict) -> str:
+        os.makedirs(self.manifest_folder, exist_ok=True)
+        name = manifest["created"]
+        path = os.path.join(self.manifest_folder, f"{name}.json")
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(f"{path}.tmp", path)
+        return name
+
+    def collect(self, keep: int) -> tuple[int, int]:
+        """
+        Remove all but the newest `keep` backups and the chunks only they used.
+        Returns the number of removed backups and chunks.
+        """
+        manifests = self.manifests()
+        removed = manifests[:-keep] if keep > 0 else []
+        for name in removed:
+            os.remove(os.path.join(self.manifest_folder, f"{name}.json"))
+
+        used = set()
+        for name in self.manifests():
+            for entry in self.read_manifest(name)["files"].values():
+                used.update(entry["chunks"])
+
+        removed_chunks = 0
+        for directory, _, filenames in os.walk(self.chunk_folder):
+            for filename in filenames:
+                if filename.endswith(".gz") and filename[:-3] not in used:
+                    os.remove(os.path.join(directory, filename))
+                    removed_chunks += 1
+        return len(removed), removed_chunks
+
+
+def json_category_files(folder: str, category: str) -> list[str]:
+    files = [f"{category}{serializer.extension}" for serializer in snapshotSerializers.values()]
+    files.append(f"{category}.journal")
+    for root in DatastoreJSON.shardedCategories.get(os.path.basename(category), []):
+        shard_folder = os.path.join(category, root)
+        if os.path.isdir(os.path.join(folder, shard_folder)):
+            files += [
+                os.path.join(shard_folder, name)
+                for name in sorted(os.listdir(os.path.join(folder, shard_folder)))
+                if not name.endswith(".tmp")
+            ]
+    return [path for path in files if os.path.exists(os.path.join(folder, path))]
+
+
+def capture_json(folder: str, staging: str, previous: dict) -> dict:
+    """
+    Capture every category of the JSON backend while holding its lock for a moment, so the files
+    are between two saves. Files changed since the previous backup are hard linked into `staging`,
+    which keeps their content even after the datastore replaces them, and read after the lock is released.
+    The journal is appended in place, so only its size at the time of the capture is kept.
+    """
+    extensions = {serializer.extension for serializer in snapshotSerializers.values()}
+    files = {}
+    for category in sorted(set(find_categories(folder, extensions))):
+        with open(os.path.join(folder, f"{category}.lock"), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                for path in json_category_files(folder, category):
+                    stamp = file_stamp(os.path.join(folder, path))
+                    if path in previous and previous[path]["stamp"] == stamp:
+                        files[path] = previous[path]
+                        continue
+
+                    os.makedirs(os.path.dirname(os.path.join(staging, path)), exist_ok=True)
+                    os.link(os.path.join(folder, path), os.path.join(staging, path))
+                    files[path] = {"stamp": stamp, "size": stamp[1]}
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+    return files
+
+
+def capture_sqlite(folder: str, staging: str, previous: dict) -> dict:
+    """
+    Copy every changed database into `staging` with the SQLite online backup API,
+    which reads a consistent state without blocking the writers.
+    """
+    files = {}
+    for category in find_categories(folder, {".sqlite3"}):
+        path = f"{category}.sqlite3"
+        stamp = file_stamp(os.path.join(folder, path))
+        if os.path.exists(os.path.join(folder, f"{path}-wal")):
+            stamp += file_stamp(os.path.join(folder, f"{path}-wal"))
+        if path in previous and previous[path]["stamp"] == stamp:
+            files[path] = previous[path]
+            continue
+
+        os.makedirs(os.path.dirname(os.path.join(staging, path)), exist_ok=True)
+        source = sqlite3.connect(os.path.join(folder, path))
+        target = sqlite3.connect(os.path.join(staging, path))
+        try:
+            source.backup(target)
+        finally:
+            source.close()
+            target.close()
+        files[path] = {"stamp": stamp, "size": os.path.getsize(os.path.join(staging, path))}
+    return files
+
+
+def capture_archive(folder: str, staging: str, previous: dict) -> dict:
+    """
+    Archived values are written once and replaced as a whole, so they are hard linked without a lock.
+    """
+    files = {}
+    for directory, _, filenames in os.walk(os.path.join(folder, ".archive")):
+        for filename in sorted(filenames):
+            if filename.endswith(".tmp"):
+                continue
+            path = os.path.relpath(os.path.join(directory, filename), folder)
+            stamp = file_stamp(os.path.join(folder, path))
+            if path in previous and previous[path]["stamp"] == stamp:
+                files[path] = previous[path]
+                continue
+
+            os.makedirs(os.path.dirname(os.path.join(staging, path)), exist_ok=True)
+            os.link(os.path.join(folder, path), os.path.join(staging, path))
+            files[path] = {"stamp": stamp, "size": stamp[1]}
+    return files
+
+
+def create_backup(store: BackupStore) -> dict:
+    backend = cfg["datastore"]["backend"]
+    folder = cfg["datastore"]["data-folder"]
+    staging = os.path.join(folder, ".backup-staging")
+    shutil.rmtree(staging, ignore_errors=True)
+
+    manifests = store.manifests()
+    previous = store.read_manifest(manifests[-1]) if manifests else {}
+    if previous.get("backend") != backend:
+        previous = {}
+
+    start = time.perf_counter()
+    capture = capture_sqlite if backend == "sqlite" else capture_json
+    files = capture(folder, staging, previous.get("files", {}))
+    files.update(capture_archive(folder, staging, previous.get("files", {})))
+
+    written = 0
+    try:
+        for path, entry in files.items():
+            if "chunks" not in entry:
+                entry["chunks"], file_written = store.store_file(os.path.join(staging, path), entry["size"])
+                written += file_written
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+    manifest = {
+        "created": datetime.now().strftime("%Y%m%d-%H%M%S-%f"),
+        "backend": backend,
+        "files": files,
+        "size": sum(entry["size"] for entry in files.values()),
+        "written": written,
+        "seconds": round(time.perf_counter() - start, 3),
+    }
+    store.write_manifest(manifest)
+    return manifest
+
+
+def restore_backup(store: BackupStore, name: str, target: str) -> dict:
+    manifest = store.read_manifest(name)
+    for path, entry in manifest["files"].items():
+        filename = os.path.join(target, path)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, "wb") as f:
+            for digest in entry["chunks"]:
+                f.write(store.read_chunk(digest))
+    return manifest
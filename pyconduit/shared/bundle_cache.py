@@ -0,0 +1,31 @@
+from pyconduit.models.bundle import BundleDocument
+from pyconduit.shared.datastore import DatastoreHandle, TenantLocal, datastore_manager, deatomize
+
+
+class BundleCache:
+    """
+    Parsed BundleDocuments by sheet id, reparsed only after a save touches that sheet.
+    Cached documents are shared between requests, so callers that modify them must ask for a copy.
+    """
+
+    def __init__(self, datastore: DatastoreHandle):
+        self.datastore = datastore
+        self.documents: dict[str, tuple[tuple[int, int], BundleDocument]] = {}
+
+    def get(self, sheet_id: str, copy: bool = True) -> BundleDocument:
+        """
+        Raises KeyError if the sheet does not exist and ValidationError if it cannot be parsed.
+        """
+        if sheet_id not in self.datastore.sheets:
+            self.documents.pop(sheet_id, None)
+            raise KeyError(sheet_id)
+
+        version = self.datastore.version("sheets", sheet_id)
+        cached = self.documents.get(sheet_id)
+        if cached is None or cached[0] != version:
+            document = BundleDocument.parse_obj(deatomize(self.datastore.sheets[sheet_id]))
+            cached = self.documents[sheet_id] = (version, document)
+        return cached[1].copy(deep=True) if copy else cached[1]
+
+
+bundle_cache = TenantLocal(lambda: BundleCache(datastore_manager.get("sheets")))
@@ -5,12 +5,12 @@ from typing import Protocol, runtime_checkable
 from pyconduit.models.bundle import BundleDocument
 from pyconduit.models.conduit import Conduit, ConduitContent
 from pyconduit.models.user import UserUnprivileged
-from pyconduit.shared.datastore import datastore_manager, deatomize
-from pyconduit.shared.formulas import execute_formula
+from pyconduit.shared.account_index import account_index
+from pyconduit.shared.formula_cache import formula_cache
+from pyconduit.shared.formulas import PALETTE_REFERENCE, execute_formula, profile_formula
 from pyconduit.shared.helpers import get_config
 
 locale = get_config("localization")
-accounts = datastore_manager.get("accounts")
 logger = logging.getLogger("pyconduit.website.conduit")
 
 
@@ -25,18 +25,38 @@ class SupportsContains(Protocol):
         pass
 
 
-def calculate_with_formula(
-    conduit: Conduit, file_id: str, filename: str, users: list[UserUnprivileged], formula: str
-) -> ConduitContent:
-    conduit_document = ConduitContent(
+def new_document(conduit: Conduit, file_id: str, filename: str, users: list[UserUnprivileged]) -> ConduitContent:
+    return ConduitContent(
         id=file_id,
         conduit=dict(conduit.dict()),
         users=users,
         name=filename,
         real_indices=list(range(len(conduit.problem_names))),
     )
+
+
+def calculate_with_formula(
+    conduit: Conduit,
+    file_id: str,
+    filename: str,
+    users: list[UserUnprivileged],
+    formula: str,
+    previous: None | dict = None,
+    changed: list[tuple[str, str]] = (),
+) -> ConduitContent:
+    """
+    `previous` may be the result for the same conduit before the `changed` (login, problem) cells were edited,
+    which is then updated instead of computed again.
+    """
+    digest = formula_cache.digest(conduit, file_id, filename, users, formula)
+    if (cached := formula_cache.get(digest)) is not None:
+        return ConduitContent.parse_obj(cached)
+
+    conduit_document = new_document(conduit, file_id, filename, users)
     try:
-        data, answer = execute_formula(conduit_document, formula)
+        if previous is not None and previous["formula_error"]:
+            previous = None
+        data, answer = execute_formula(conduit_document, formula, previous, changed)
         if "Error" in answer or "Exception" in answer:
             logger.warning(answer)
             conduit_document.formula_error = answer
@@ -50,27 +70,90 @@ def calculate_with_formula(
                     real_indices.append(-1)
             conduit_document.real_indices = real_indices
     except RuntimeError as e:
+        # Timeouts and crashes depend on the load of the server, so they are not cached
         logger.warning("Failed to execute formula for '%s': %s", file_id, e)
         conduit_document.formula_error = str(e)
+        return conduit_document
+
+    formula_cache.put(digest, conduit_document.dict())
     return conduit_document
 
 
-def get_all_users(conduit: Conduit) -> list[UserUnprivileged]:
-    users = {
-        login: UserUnprivileged.parse_obj(deatomize(account))
-        for login, account in accounts.accounts.items()
-        if account["privileges"]["conduit_generation"]
+def profile_with_formula(
+    conduit: Conduit, file_id: str, filename: str, users: list[UserUnprivileged], formula: str
+) -> dict:
+    """
+    Run a formula with a FormulaProfiler, bypassing the cache. Returns the output of the run as `formula_error`
+    and the report as `profile`, which is None if the worker crashed or did not stop in time.
+    """
+    try:
+        _, answer, report = profile_formula(new_document(conduit, file_id, filename, users), formula)
+    except RuntimeError as e:
+        logger.warning("Failed to profile formula for '%s': %s", file_id, e)
+        answer, report = str(e), None
+    return {"formula_error": answer, "profile": report}
+
+
+def fill_rows(conduit: Conduit, users: list[UserUnprivileged]) -> None:
+    """
+    Add empty rows for the users who have none yet.
+    """
+    for user in users:
+        if user.login not in conduit.content:
+            conduit.content[user.login] = ["" for _ in range(len(conduit.problem_names))]
+
+
+def conduit_diff(previous: None | dict, current: ConduitContent) -> dict:
+    """
+    The changes from `previous` to `current` results of calculate_with_formula, for the conduit editor:
+    the new values of the changed cells by row and column index, and the changed styles, None where removed.
+    If the rows or columns differ, the whole document is sent instead.
+    """
+    if (
+        previous is None
+        or previous["conduit"]["problem_names"] != current.conduit.problem_names
+        or list(previous["conduit"]["content"]) != list(current.conduit.content)
+        or previous["real_indices"] != current.real_indices
+    ):
+        return {"document": current.dict()}
+
+    cells = {}
+    for row, values in current.conduit.content.items():
+        old_values = previous["conduit"]["content"][row]
+        changed = {
+            index: value for index, (value, old_value) in enumerate(zip(values, old_values)) if value != old_value
+        }
+        if changed:
+            cells[row] = changed
+
+    def changed_styles(old: dict, new: dict) -> dict:
+        return {key: new.get(key) for key in old.keys() | new.keys() if old.get(key) != new.get(key)}
+
+    styles = {}
+    for row in previous["styles"].keys() | current.styles.keys():
+        if changed := changed_styles(previous["styles"].get(row, {}), current.styles.get(row, {})):
+            styles[row] = changed
+    return {
+        "cells": cells,
+        "styles": styles,
+        "row_styles": changed_styles(previous["row_styles"], current.row_styles),
+        "column_styles": changed_styles(previous["column_styles"], current.column_styles),
+        "palette": changed_styles(previous.get("palette", {}), current.palette),
     }
 
+
+def get_all_users(conduit: Conduit) -> list[UserUnprivileged]:
+    users = account_index.roster()
+    logins = {user.login for user in users}
+    others = []
     for login in conduit.content.keys():
-        if login not in users:
-            if login in accounts.accounts:
-                username = accounts.accounts[login].name
-            else:
-                username = login
-            users[login] = UserUnprivileged(login=login, name=username)
+        if login not in logins:
+            account = account_index.get(login)
+            others.append(UserUnprivileged(login=login, name=account.name if account else login))
 
-    return sorted(users.values(), key=lambda user: user.name)
+    if not others:
+        return users
+    return sorted(users + others, key=lambda user: user.name)
 
 
 def postprocess_limited_conduit(
@@ -102,7 +185,10 @@ def postprocess_limited_conduit(
             if not (row_id.startswith("_") and row_id in precomputed.limited_rows) and row_id not in user_logins:
                 continue
             prob_append.append(conduit.content[row_id][index])
-            style_append.append(precomputed.styles.get(row_id, {}).get(problem, ""))
+            style = precomputed.styles.get(row_id, {}).get(problem, "")
+            if style.startswith(PALETTE_REFERENCE):
+                style = precomputed.palette.get(style[len(PALETTE_REFERENCE) :], "")
+            style_append.append(style)
         problems.append(prob_append)
         styles.append(style_append)
     return problems, styles, row_styles
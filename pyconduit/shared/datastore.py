@@ -1,29 +1,63 @@
 import abc
+import asyncio
+import atexit
 import contextlib
+import contextvars
+import fcntl
+import gc
+import hashlib
 import json
 import logging
+import marshal
 import os
+import shutil
+import sqlite3
+import sys
+import threading
+import time
 import traceback
+from collections.abc import Callable, MutableMapping
+from urllib.parse import quote, unquote
+
+import anyio
 
 from pyconduit.shared.helpers import get_environment_config
 
 DatastoreSentinel = object()
 cfg = get_environment_config()
-
-
-def atomize(parent, value, path):
-    if isinstance(value, dict):
-        return AtomicDict(parent, {k: atomize(parent, v, f"{path}{k}.") for k, v in value.items()}, path)
+# Set by the website middleware to the route being served, so the saves can be attributed to it
+datastore_route = contextvars.ContextVar("datastore_route", default="-")
+# The course served by the current request, its categories are kept in <data-folder>/<tenant>/
+datastore_tenant = contextvars.ContextVar("datastore_tenant", default=None)
+datastore_tenants = cfg["datastore"].get("tenants", [])
+# Functions giving a small summary of every value of a root by (category, root), see summarize_shards
+shardSummaries: dict[tuple[str, str], Callable[[dict], dict]] = {}
+
+
+def atomize(value, parent=None, key=None):
+    """
+    Wrap a raw dictionary or list so that the changes made through it are recorded. Other values are returned as is.
+    """
+    if isinstance(value, dict | ShardedDict):
+        return AtomicDict(value, parent, key)
     elif isinstance(value, list):
-        return AtomicList(parent, [atomize(parent, v, f"{path}{i}.") for i, v in enumerate(value)], path)
+        return AtomicList(value, parent, key)
     else:
         return value
 
 
+def summarize_shards(category: str, root: str, summary: Callable[[dict], dict]) -> None:
+    """
+    Summarize the values of data[root] of every datastore of `category`, see DatastoreHandle.summaries.
+    A sharded root keeps the summaries in its index, so they have to be small JSON values.
+    """
+    shardSummaries[(category, root)] = summary
+
+
 def deatomize(value):
     if isinstance(value, AtomicDict) or isinstance(value, AtomicList):
         return deatomize(value._data)
-    elif isinstance(value, dict):
+    elif isinstance(value, dict | ShardedDict):
         return {k: deatomize(v) for k, v in value.items()}
     elif isinstance(value, list):
         return [deatomize(v) for v in value]
@@ -31,66 +65,851 @@ def deatomize(value):
         return value
 
 
-class AtomicList:
-    def __init__(self, parent=None, data=None, path=""):
-        self.parent = parent if parent is not None else self
-        self._data = data
-        self.path = path
-        if parent is not None:
-            self.updates = parent.updates
+def detach(value):
+    """
+    Copy a value so that it does not share containers with the datastore. Scalars are returned as is.
+    """
+    if isinstance(value, str | int | float | bool | None):
+        return value
+    return deatomize(value)
+
+
+class JSONSerializer:
+    extension = ".json"
+
+    @staticmethod
+    def dumps(data) -> bytes:
+        return json.dumps(data, indent=2).encode()
+
+    @staticmethod
+    def loads(raw: bytes):
+        return json.loads(raw)
+
+
+class MarshalSerializer:
+    """
+    The interpreter's own binary format, several times faster to load and save than JSON.
+    It is only meant to be read by the same Python version, use `export-json` before upgrading.
+    """
+
+    extension = ".marshal"
+
+    @staticmethod
+    def dumps(data) -> bytes:
+        try:
+            # Saved values always come from deatomize or a loaded snapshot, so no container is referenced
+            # twice and the back-references of the current format only deduplicate strings
+            return marshal.dumps(data)
+        except ValueError as e:
+            # Raised as TypeError like json.dumps, so both are handled the same way by the callers
+            raise TypeError(e)
+
+    @staticmethod
+    def loads(raw: bytes):
+        return marshal.loads(raw)
+
+
+snapshotSerializers = {
+    "json": JSONSerializer,
+    "marshal": MarshalSerializer,
+}
+
+
+def find_categories(folder: str, extensions: set[str]) -> list[str]:
+    """
+    List the categories stored in a data folder by the files with one of the extensions,
+    skipping the folders of sharded roots and hidden folders.
+    """
+    categories = []
+    for directory, directories, filenames in os.walk(folder):
+        directories[:] = [x for x in directories if not x.startswith(".")]
+        for filename in sorted(filenames):
+            category, extension = os.path.splitext(os.path.relpath(os.path.join(directory, filename), folder))
+            if extension not in extensions:
+                continue
+
+            categories.append(category)
+            if os.path.basename(category) in cfg["datastore"].get("sharded", {}):
+                directories[:] = [x for x in directories if x != os.path.basename(category)]
+    return categories
+
+
+def deep_sizeof(value) -> int:
+    """
+    Approximate memory used by a value and everything it references, counting shared objects once.
+    Only the loaded part of a ShardedDict is counted.
+    """
+    size = 0
+    seen = set()
+    stack = [value]
+    while stack:
+        item = stack.pop()
+        if id(item) in seen:
+            continue
+        seen.add(id(item))
+        size += sys.getsizeof(item)
+        if isinstance(item, dict):
+            stack.extend(item.keys())
+            stack.extend(item.values())
+        elif isinstance(item, list):
+            stack.extend(item)
+        elif isinstance(item, ShardedDict):
+            stack.append(item.loaded)
+    return size
+
+
+class Histogram:
+    """
+    Counts values in fixed buckets, percentiles are reported as the upper bound of their bucket.
+    """
+
+    __slots__ = ("bounds", "counts", "count", "total", "max")
+
+    def __init__(self, bounds: tuple):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, value) -> None:
+        index = 0
+        while index < len(self.bounds) and value > self.bounds[index]:
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, fraction: float):
+        if not self.count:
+            return 0
+        remaining = fraction * self.count
+        for bound, count in zip(self.bounds, self.counts):
+            remaining -= count
+            if remaining <= 0:
+                return bound
+        return self.max
+
+    def dump(self) -> dict:
+        return {
+            "count": self.count,
+            "total": self.total,
+            "mean": self.total / self.count if self.count else 0,
+            "p50": self.percentile(0.5),
+            "p99": self.percentile(0.99),
+            "max": self.max,
+            "buckets": dict(zip(map(str, self.bounds + ("inf",)), self.counts)),
+        }
+
+
+class DatastoreStats:
+    """
+    Counters of a datastore handle. Loads and commits are timed in milliseconds, commits may run
+    in the group commit thread while operations are counted in the handlers.
+    """
+
+    TimeBounds = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+    SizeBounds = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+    CountBounds = (1, 2, 4, 8, 16, 32, 64, 128, 256, 1024)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.loads = Histogram(self.TimeBounds)
+        self.commits = Histogram(self.TimeBounds)
+        self.commitBytes = Histogram(self.SizeBounds)
+        self.updates = Histogram(self.CountBounds)
+        self.routes = {}
+        self.bytesWritten = 0
+
+    def written(self, size: int) -> None:
+        with self.lock:
+            self.bytesWritten += size
+
+    def load(self, milliseconds: float) -> None:
+        with self.lock:
+            self.loads.add(milliseconds)
+
+    def commit(self, milliseconds: float, size: int) -> None:
+        with self.lock:
+            self.commits.add(milliseconds)
+            self.commitBytes.add(size)
+
+    def route(self, route: str) -> dict:
+        return self.routes.setdefault(route, {"operations": 0, "updates": 0, "payload": 0})
+
+    def operation(self, updates: int) -> None:
+        with self.lock:
+            self.updates.add(updates)
+            route = self.route(datastore_route.get())
+            route["operations"] += 1
+            route["updates"] += updates
+
+    def payload(self, routes: dict[str, int], size: int) -> None:
+        """
+        Attribute the bytes a commit wrote to the routes of its operations, by their number of updates.
+        """
+        total = sum(routes.values())
+        with self.lock:
+            for route, updates in routes.items():
+                self.route(route)["payload"] += size * updates // total if total else 0
+
+    def dump(self) -> dict:
+        with self.lock:
+            return {
+                "loads": self.loads.dump(),
+                "commits": self.commits.dump(),
+                "commit_bytes": self.commitBytes.dump(),
+                "updates_per_operation": self.updates.dump(),
+                "bytes_written": self.bytesWritten,
+                "routes": {route: dict(counters) for route, counters in self.routes.items()},
+            }
+
+
+class Patch:
+    """
+    A set of changes to the datastore, recorded as typed operations on tuple paths.
+    The patch is a trie: writing to a path drops everything recorded below it, so every path
+    holds at most one operation and the whole patch is applied in a single pass from the root.
+    """
+
+    SET = "set"
+    DELETE = "delete"
+    APPEND = "append"
+
+    __slots__ = ("op", "value", "children")
+
+    def __init__(self):
+        self.op = None
+        self.value = None
+        self.children = {}
+
+    @classmethod
+    def from_records(cls, records) -> "Patch":
+        patch = cls()
+        for op, path, value in records:
+            patch.record(tuple(path), op, value)
+        return patch
+
+    def record(self, path: tuple, op: str, value=None) -> None:
+        node = self
+        for key in path:
+            child = node.children.get(key)
+            if child is None:
+                child = node.children[key] = Patch()
+            node = child
+
+        if op == self.SET and node.op == self.APPEND:
+            # the list element still has to be created by the append
+            op = self.APPEND
+        node.op = op
+        node.value = value
+        node.children = {}
+
+    def copy(self) -> "Patch":
+        return Patch.from_records((op, path, detach(value)) for op, path, value in self.records())
+
+    def merge(self, other: "Patch") -> None:
+        for op, path, value in other.records():
+            self.record(path, op, value)
+
+    def records(self, path: tuple = ()):
+        """
+        Iterate over (operation, path, value) in the order they have to be applied in.
+        """
+        for key, node in self.children.items():
+            childPath = path + (key,)
+            if node.op is not None:
+                yield node.op, childPath, node.value
+            yield from node.records(childPath)
+
+    def take(self) -> "Patch":
+        """
+        Move the recorded changes into a new patch and clear this one.
+        """
+        patch = Patch()
+        patch.children, self.children = self.children, {}
+        return patch
+
+    def subset(self, keys) -> "Patch":
+        patch = Patch()
+        patch.children = {key: node for key, node in self.children.items() if key in keys}
+        return patch
+
+    def apply(self, data) -> None:
+        for key, node in self.children.items():
+            node.applyTo(data, key)
+
+    def applyTo(self, parent, key) -> None:
+        # The children change the value in place, it is copied so that the patch can be applied again
+        value = detach(self.value) if self.children else self.value
+        if self.op == self.SET:
+            parent[key] = value
+        elif self.op == self.DELETE:
+            if isinstance(parent, list):
+                del parent[key]
+            else:
+                parent.pop(key, None)
+        elif self.op == self.APPEND:
+            parent.extend([None] * (key - len(parent) + 1))
+            parent[key] = value
+
+        if self.children:
+            self.apply(parent[key])
+
+    def dump(self) -> str:
+        return json.dumps([[op, path, value] for op, path, value in self.records()], separators=(",", ":"))
+
+    def __bool__(self):
+        return bool(self.children)
+
+    def __len__(self):
+        return sum(1 for _ in self.records())
+
+    def __repr__(self):
+        return f"Patch({list(self.records())})"
+
+
+class GroupCommitWriter:
+    """
+    Collects the updates of many operations and commits them as one batch every `interval` seconds
+    from a background thread. A batch is taken from `pending` and committed while holding `lock`.
+    A batch which fails to commit goes back under the newer updates to be committed with the next one,
+    and the waiters of its operations get the error.
+    """
+
+    logger = logging.getLogger("PyConduit.GroupCommitWriter")
+    # Seconds to wait after a failed commit, so a broken disk is not retried in a loop
+    retryInterval = 1
+
+    def __init__(self, name: str, commit, interval: float, lock: threading.RLock = None):
+        self.commit = commit
+        self.interval = interval
+        self.lock = lock if lock is not None else threading.RLock()
+        self.condition = threading.Condition()
+        self.pending = Patch()
+        self.pendingOperations = 0
+        # Updates of the pending operations by route, for the statistics
+        self.pendingRoutes: dict[str, int] = {}
+        self.flushRequested = False
+        self.submitted = 0
+        self.committed = 0
+        # The last operation of the last batch which failed to commit and its error
+        self.failed = 0
+        self.error = None
+        self.stats = {"commits": 0, "operations": 0, "last_batch": 0, "max_batch": 0, "failures": 0}
+        self.thread = threading.Thread(target=self.run, name=f"GroupCommitWriter({name})", daemon=True)
+        self.thread.start()
+        atexit.register(self.flush)
+
+    def submit(self, updates: Patch, route: str = "-") -> int:
+        """
+        Queue the updates of one operation, returns the sequence number to wait for with `flush`.
+        """
+        with self.condition:
+            self.pending.merge(updates)
+            self.pendingOperations += 1
+            self.pendingRoutes[route] = self.pendingRoutes.get(route, 0) + len(updates)
+            self.submitted += 1
+            self.condition.notify_all()
+            return self.submitted
+
+    def run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.pendingOperations)
+                self.condition.wait_for(lambda: self.flushRequested, timeout=self.interval)
+
+            with self.lock:
+                with self.condition:
+                    self.flushRequested = False
+                    updates = self.pending.take()
+                    operations, self.pendingOperations = self.pendingOperations, 0
+                    routes, self.pendingRoutes = self.pendingRoutes, {}
+                    sequence = self.submitted
+
+                try:
+                    self.commit(updates, routes)
+                    error = None
+                except Exception as e:
+                    self.logger.exception("Failed to commit %d operations", operations)
+                    error = e
+
+            if error is not None:
+                with self.condition:
+                    updates.merge(self.pending)
+                    self.pending = updates
+                    self.pendingOperations += operations
+                    for route, count in self.pendingRoutes.items():
+                        routes[route] = routes.get(route, 0) + count
+                    self.pendingRoutes = routes
+                    self.failed, self.error = sequence, error
+                    self.stats["failures"] += 1
+                    self.condition.notify_all()
+                time.sleep(self.retryInterval)
+                continue
+
+            with self.condition:
+                self.committed = sequence
+                self.stats["commits"] += 1
+                self.stats["operations"] += operations
+                self.stats["last_batch"] = operations
+                self.stats["max_batch"] = max(self.stats["max_batch"], operations)
+                self.condition.notify_all()
+
+    def flush(self, sequence: int = None) -> None:
+        """
+        Block until the given operation (or everything submitted so far) is committed.
+        Raises RuntimeError if an attempt to commit it fails while waiting.
+        """
+        with self.condition:
+            target = self.submitted if sequence is None else sequence
+            if self.committed < target:
+                self.flushRequested = True
+                self.condition.notify_all()
+            failures = self.stats["failures"]
+            self.condition.wait_for(
+                lambda: self.committed >= target or (self.stats["failures"] > failures and self.failed >= target)
+            )
+            if self.committed < target:
+                raise RuntimeError(f"Failed to commit operation {target}") from self.error
+
+    async def durable(self, sequence: int = None) -> None:
+        await anyio.to_thread.run_sync(self.flush, sequence)
+
+
+class ScopeLocks:
+    """
+    Exclusive locks on paths of the datastore. A path is locked together with everything below it,
+    so ("sheets",) waits for ("sheets", "01") and the other way around, while ("sheets", "01")
+    and ("sheets", "02") are held at the same time. The empty path locks the whole datastore.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.held = []
+        # Event loop tasks wait on futures, so that waiting does not take a thread from the pool
+        self.waiters = []
+
+    def conflicts(self, scope: tuple) -> bool:
+        return any(held[: len(scope)] == scope or scope[: len(held)] == held for held in self.held)
+
+    def release(self, scope: tuple) -> None:
+        with self.condition:
+            self.held.remove(scope)
+            self.condition.notify_all()
+            waiters, self.waiters = self.waiters, []
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(self.wake, future)
+
+    @staticmethod
+    def wake(future: asyncio.Future) -> None:
+        if not future.done():
+            future.set_result(None)
+
+    @contextlib.contextmanager
+    def hold(self, scope: tuple):
+        with self.condition:
+            self.condition.wait_for(lambda: not self.conflicts(scope))
+            self.held.append(scope)
+        try:
+            yield
+        finally:
+            self.release(scope)
+
+    @contextlib.asynccontextmanager
+    async def ahold(self, scope: tuple):
+        loop = asyncio.get_running_loop()
+        while True:
+            with self.condition:
+                if not self.conflicts(scope):
+                    self.held.append(scope)
+                    break
+                future = loop.create_future()
+                self.waiters.append((loop, future))
+            await future
+        try:
+            yield
+        finally:
+            self.release(scope)
+
+
+class ChangeFeed:
+    """
+    Tells subscribers which paths the saved and synced updates changed. A subscriber of a prefix
+    receives every change below it and every change of a path above it, which replaces the prefix too.
+    Callbacks get (operation, path) and run in the thread which saved, so they have to be quick.
+    """
+
+    # Sent to async subscribers which fell behind, everything below the path may have changed
+    RESET = "reset"
+
+    logger = logging.getLogger("PyConduit.ChangeFeed")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers = []
+
+    def subscribe(self, prefix: tuple, callback):
+        """
+        Call `callback(operation, path)` for every change that touches `prefix`, returns a function that unsubscribes.
+        """
+        subscriber = (tuple(prefix), callback)
+        with self.lock:
+            self.subscribers = self.subscribers + [subscriber]
+
+        def unsubscribe():
+            with self.lock:
+                self.subscribers = [other for other in self.subscribers if other is not subscriber]
+
+        return unsubscribe
+
+    def publish(self, changes) -> None:
+        subscribers = self.subscribers
+        if not subscribers:
+            return
+        for op, path in changes:
+            for prefix, callback in subscribers:
+                if path[: len(prefix)] == prefix or prefix[: len(path)] == path:
+                    try:
+                        callback(op, path)
+                    except Exception:
+                        self.logger.exception("Change feed subscriber failed on %s", path)
+
+    async def stream(self, prefix: tuple = (), maxsize: int = 1000):
+        """
+        Iterate over the (operation, path) changes of `prefix` from now on. A subscriber which is more than
+        `maxsize` changes behind gets a single RESET of the prefix instead.
+        """
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize)
+
+        def enqueue(change):
+            if queue.full():
+                while not queue.empty():
+                    queue.get_nowait()
+                change = (self.RESET, prefix)
+            queue.put_nowait(change)
+
+        unsubscribe = self.subscribe(prefix, lambda op, path: loop.call_soon_threadsafe(enqueue, (op, path)))
+        try:
+            while True:
+                yield await queue.get()
+        finally:
+            unsubscribe()
+
+
+class FingerprintNode:
+    __slots__ = ("digest", "children")
+
+    def __init__(self, digest: bytes = None):
+        self.digest = digest
+        self.children = {}
+
+
+class Fingerprints:
+    """
+    Content hashes of the subtrees of a datastore. Dictionaries and lists above `MaxDepth` are hashed
+    from the hashes of their children, which are kept, so after a change only the path above it is hashed
+    again. Deeper values are hashed from their canonical JSON. The change feed forgets the changed paths.
+    """
+
+    MaxDepth = 5
+    Missing = hashlib.blake2b(b"missing", digest_size=16).digest()
+
+    def __init__(self, datastore: "DatastoreHandle"):
+        self.datastore = datastore
+        self.lock = threading.Lock()
+        self.tree = FingerprintNode()
+        self.generation = 0
+        datastore.subscribe((), self.invalidate)
+
+    def invalidate(self, op: str, path: tuple) -> None:
+        with self.lock:
+            self.generation += 1
+            node = self.tree
+            node.digest = None
+            for key in path[:-1]:
+                node = node.children.get(key)
+                if node is None:
+                    return
+                node.digest = None
+            if path:
+                node.children.pop(path[-1], None)
+            else:
+                node.children = {}
+
+    def lookup(self, path: tuple) -> None | FingerprintNode:
+        node = self.tree
+        for key in path:
+            node = node.children.get(key)
+            if node is None:
+                return None
+        return node
+
+    def store(self, path: tuple, computed: FingerprintNode) -> None:
+        node = self.tree
+        for key in path[:-1]:
+            node = node.children.setdefault(key, FingerprintNode())
+        if path:
+            node.children[path[-1]] = computed
         else:
-            self.updates = {}
+            self.tree = computed
+
+    def hash(self, value, node: None | FingerprintNode, depth: int) -> FingerprintNode:
+        if node is not None and node.digest is not None:
+            return node
+
+        if depth < self.MaxDepth and isinstance(value, (dict, list, MutableMapping)):
+            computed = FingerprintNode()
+            digest = hashlib.blake2b(b"list" if isinstance(value, list) else b"dict", digest_size=16)
+            items = enumerate(value) if isinstance(value, list) else ((key, value[key]) for key in sorted(value))
+            for key, child in items:
+                computed.children[key] = self.hash(child, node.children.get(key) if node else None, depth + 1)
+                digest.update(json.dumps(key).encode())
+                digest.update(computed.children[key].digest)
+            computed.digest = digest.digest()
+            return computed
+
+        serialized = json.dumps(value, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+        return FingerprintNode(hashlib.blake2b(serialized.encode(), digest_size=16).digest())
+
+    def get(self, path: tuple) -> str:
+        with self.lock:
+            generation = self.generation
+            node = self.lookup(path)
+        if node is not None and node.digest is not None:
+            return node.digest.hex()
+
+        value = self.datastore.data._data
+        try:
+            for key in path:
+                value = value[key]
+        except (KeyError, IndexError, TypeError):
+            return self.Missing.hex()
+
+        computed = self.hash(value, node, len(path))
+        with self.lock:
+            # A change during hashing may not be in the result, which is then only returned
+            if generation == self.generation:
+                self.store(path, computed)
+        return computed.digest.hex()
+
+
+class ShardedDict(MutableMapping):
+    """
+    A dictionary which keeps every value in its own file inside `folder` and reads it on first access.
+    The `.index` file of the folder keeps the keys in the order they were added, with a small summary
+    of every value (see summarize_shards) so that listing them does not read every file.
+    """
+
+    def __init__(self, folder: str, load, extension: str = ".json"):
+        self.folder = folder
+        self.load = load
+        self.extension = extension
+        self.loaded = {}
+        files = {unquote(name[: -len(extension)]) for name in os.listdir(folder) if name.endswith(extension)}
+        try:
+            with open(self.indexFilename, "rb") as f:
+                index = json.loads(f.read())
+        except FileNotFoundError:
+            index = {}
+        # The summary of every key if it is known, in the order the keys were added
+        self.shardKeys: dict[str, None | dict] = {key: summary for key, summary in index.items() if key in files}
+        # Shards written before there was an index follow in the order they were written
+        for key in sorted(files - self.shardKeys.keys(), key=lambda key: os.stat(self.filename(key)).st_mtime_ns):
+            self.shardKeys[key] = None
+
+    @property
+    def indexFilename(self) -> str:
+        return f"{self.folder}/.index"
+
+    def filename(self, key: str) -> str:
+        return f"{self.folder}/{quote(key, safe='')}{self.extension}"
+
+    def writeIndex(self) -> int:
+        out = json.dumps(self.shardKeys, ensure_ascii=False).encode()
+        temporary = f"{self.indexFilename}.tmp"
+        with open(temporary, "wb") as f:
+            f.write(out)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, self.indexFilename)
+        return len(out)
+
+    def summaries(self, summary: Callable[[dict], dict]) -> dict[str, dict]:
+        """
+        The summary of every value by key. Loaded values are summarized as they are now,
+        the others are only read if the index has no summary for them.
+        """
+        summaries = {}
+        for key, known in list(self.shardKeys.items()):
+            if key in self.loaded:
+                known = summary(self.loaded[key])
+            elif known is None:
+                known = self.shardKeys[key] = summary(self.load(self.filename(key)))
+            summaries[key] = known
+        return summaries
+
+    def __getitem__(self, key):
+        if key not in self.loaded:
+            if key not in self.shardKeys:
+                raise KeyError(key)
+            self.loaded[key] = self.load(self.filename(key))
+        return self.loaded[key]
+
+    def __setitem__(self, key, value):
+        self.loaded[key] = value
+        # A key which is already there keeps its position
+        self.shardKeys[key] = None
+
+    def __delitem__(self, key):
+        del self.shardKeys[key]
+        self.loaded.pop(key, None)
+
+    def pop(self, key, default=None):
+        # Unlike MutableMapping.pop, this does not read a file which may already be removed
+        if key not in self.shardKeys:
+            return default
+        del self.shardKeys[key]
+        return self.loaded.pop(key, default)
+
+    def __contains__(self, key):
+        return key in self.shardKeys
+
+    def __iter__(self):
+        return iter(list(self.shardKeys))
+
+    def __len__(self):
+        return len(self.shardKeys)
+
+    def __repr__(self):
+        return f"ShardedDict({self.folder}, {len(self.loaded)}/{len(self.shardKeys)} loaded)"
+
+
+class AtomicNode:
+    """
+    A lightweight view over a part of the raw data. Children are wrapped only when they are accessed,
+    and the dotted path of a node is built from its parents only when a change is recorded.
+    """
+
+    __slots__ = ("_data", "_parent", "_key", "updates")
+
+    def __init__(self, data, parent=None, key=None):
+        self._data = data
+        self._parent = parent
+        self._key = key
+        self.updates = parent.updates if parent is not None else Patch()
+
+    @property
+    def path(self) -> tuple:
+        if self._parent is None:
+            return ()
+        return self._parent.path + (self._key,)
+
+    def record(self, key, op: str, value=None):
+        # The patch keeps its own copy, so a background commit never reads what the handlers are changing
+        self.updates.record(self.path + (key,), op, detach(value))
 
     def direct_set(self, key, value):
         self._data[key] = value
 
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, item):
+        return item in self._data
+
+
+class OperationUpdates:
+    """
+    Where the views of one datastore record their changes. Every running operation records into
+    a patch of its own, found through a context variable, so concurrent operations never save
+    each other's changes. Changes made outside of any operation go to a common patch.
+    """
+
+    __slots__ = ("current", "common", "running", "lock")
+
+    def __init__(self, name: str):
+        self.current = contextvars.ContextVar(f"operation({name})", default=None)
+        self.common = Patch()
+        self.running = []
+        self.lock = threading.Lock()
+
+    def record(self, path: tuple, op: str, value=None) -> None:
+        patch = self.current.get()
+        with self.lock:
+            (self.common if patch is None else patch).record(path, op, value)
+
+    def begin(self) -> tuple[Patch, contextvars.Token]:
+        patch = Patch()
+        with self.lock:
+            self.running.append(patch)
+        return patch, self.current.set(patch)
+
+    def end(self, patch: Patch, token: contextvars.Token) -> None:
+        self.current.reset(token)
+        with self.lock:
+            self.running.remove(patch)
+
+    def take(self) -> Patch:
+        with self.lock:
+            return self.common.take()
+
+    def unsaved(self) -> Patch:
+        """
+        Return a copy of the changes recorded by the running operations and outside of them.
+        """
+        updates = Patch()
+        with self.lock:
+            for patch in self.running:
+                updates.merge(patch)
+            updates.merge(self.common)
+            return updates.copy()
+
+
+class AtomicList(AtomicNode):
+    __slots__ = ()
+
     def direct_append(self, value):
         self._data.append(value)
 
     def append(self, value):
         dataLen = len(self._data)
-        self._data.append(atomize(self.parent, value, f"{self.path}{dataLen}."))
-        self.updates[f"{self.path}append[{dataLen}]"] = value
+        value = detach(value)
+        self._data.append(value)
+        self.record(dataLen, Patch.APPEND, value)
 
     def __getitem__(self, item):
-        return self._data[item]
+        if isinstance(item, slice):
+            return [self[i] for i in range(*item.indices(len(self._data)))]
+        value = self._data[item]
+        return atomize(value, self, item % len(self._data))
 
     def __setitem__(self, key, value):
-        self._data[key] = atomize(self.parent, value, f"{self.path}{key}.")
-        self.updates[f"{self.path}{key}"] = value
+        value = detach(value)
+        self._data[key] = value
+        self.record(key % len(self._data), Patch.SET, value)
 
     def __iter__(self):
-        return iter(self._data)
-
-    def __len__(self):
-        return len(self._data)
-
-    def __contains__(self, item):
-        return item in self._data
+        for index, value in enumerate(self._data):
+            yield atomize(value, self, index)
 
     def __repr__(self):
         return f"AtomicList({self._data})"
 
 
-class AtomicDict:
-    ExistingAttrs = {"path", "_data", "parent", "updates", "ExistingAttrs"}
-
-    def __init__(self, parent=None, data=None, path=""):
-        self.path = path
-        self._data = data or {}
-        self.parent = parent if parent is not None else self
-        if parent is not None:
-            self.updates = parent.updates
-        else:
-            self.updates = {}
-        assert self.updates is self.parent.updates
+class AtomicDict(AtomicNode):
+    __slots__ = ()
+    ExistingAttrs = {"path", "_data", "_parent", "_key", "updates", "ExistingAttrs"}
 
     def __getitem__(self, key):
-        return self._data[key]
+        return atomize(self._data[key], self, key)
 
     def __setitem__(self, key, value):
-        self._data[key] = atomize(self.parent, value, f"{self.path}{key}.")
-        self.updates[f"{self.path}{key}"] = deatomize(value)
+        value = detach(value)
+        self._data[key] = value
+        self.record(key, Patch.SET, value)
 
     def __getattr__(self, key):
         if key not in self.ExistingAttrs:
@@ -106,7 +925,7 @@ class AtomicDict:
 
     def __delitem__(self, key):
         del self._data[key]
-        self.updates[f"{self.path}{key}"] = None
+        self.record(key, Patch.DELETE)
 
     def __iter__(self):
         return iter(self._data)
@@ -115,35 +934,23 @@ class AtomicDict:
         return self._data.keys()
 
     def items(self):
-        return self._data.items()
+        return ((key, atomize(value, self, key)) for key, value in self._data.items())
 
     def values(self):
-        return self._data.values()
-
-    def __len__(self):
-        return len(self._data)
-
-    def __contains__(self, item):
-        return item in self._data
+        return (atomize(value, self, key) for key, value in self._data.items())
 
     def get(self, key, defaultValue=None):
-        sent = self._data.get(key, DatastoreSentinel)
-        if sent is not DatastoreSentinel:
-            return atomize(self.parent, sent, f"{self.path}{key}.")
-        self[key] = defaultValue
+        if key not in self._data:
+            self[key] = defaultValue
         return self[key]
 
     def pop(self, key, default=None):
         value = self._data.pop(key, default)
-        self.updates[f"{self.path}{key}"] = None
+        self.record(key, Patch.DELETE)
         return value
 
     def direct_update(self, **kwargs):
-        for k, v in kwargs.items():
-            self._data[k] = atomize(self.parent, v, f"{self.path}{k}.")
-
-    def direct_set(self, key, value):
-        self._data[key] = value
+        self._data.update(kwargs)
 
     def __repr__(self):
         return f"AtomicDict({self._data})"
@@ -151,13 +958,42 @@ class AtomicDict:
 
 class DatastoreHandle(abc.ABC):
     logger = logging.getLogger("PyConduit.Datastore")
-    ExistingAttrs = {"category", "data", "shared", "ExistingAttrs"}
+    groupCommitInterval = cfg["datastore"].get("group-commit-ms", 0) / 1000
+    ExistingAttrs = {
+        "category",
+        "data",
+        "shared",
+        "writer",
+        "versions",
+        "commitLock",
+        "feed",
+        "fingerprints",
+        "locks",
+        "stats",
+        "groupCommitInterval",
+        "ExistingAttrs",
+    }
 
     def __init__(self, category: str, shared: bool = False):
+        """
+        A shared datastore is used by several processes at once. Writes are serialized between them
+        and `refresh` applies the changes saved by the other processes.
+        """
         self.category = category
-        self.data = atomize(None, {}, "")
-        self.data.direct_update(**self.requestLoad())
         self.shared = shared
+        self.versions = {}
+        # Held while a batch goes from memory to the backend, so that refresh sees it in exactly one of them
+        self.commitLock = threading.RLock()
+        self.locks = ScopeLocks()
+        self.feed = ChangeFeed()
+        self.fingerprints = None
+        self.stats = DatastoreStats()
+        self.data = AtomicDict({})
+        self.data.updates = OperationUpdates(category)
+        self.data.direct_update(**self.timedLoad())
+        self.writer = None
+        if self.groupCommitInterval:
+            self.writer = GroupCommitWriter(category, self.commit, self.groupCommitInterval, self.commitLock)
 
     def __setitem__(self, key, value):
         self.data[key] = value
@@ -184,11 +1020,7 @@ class DatastoreHandle(abc.ABC):
         del self.data[key]
 
     def get(self, key, defaultValue=None):
-        sent = self.data.get(key, DatastoreSentinel)
-        if sent is not DatastoreSentinel:
-            return atomize(self.data, sent, f"{key}.")
-        self.data[key] = atomize(self.data, defaultValue, f"{key}.")
-        return self.data[key]
+        return self.data.get(key, defaultValue)
 
     def keys(self):
         return self.data.keys()
@@ -197,41 +1029,11 @@ class DatastoreHandle(abc.ABC):
         return self.data.items()
 
     @staticmethod
-    def updateAtomic(fullData, changes):
-        changes = {k: v for k, v in sorted(changes.items(), key=lambda x: x[0].count("."))}
-        for key, value in changes.items():
-            data = fullData
-
-            path = key.split(".")
-            for k in path[:-1]:
-                if isinstance(data, list) or isinstance(data, AtomicList):
-                    k = int(k)
-                data = data[k]
-
-            if value is None:
-                del data[path[-1]]
-            elif path[-1].startswith("append["):
-                k = int(path[-1][7:-1])
-                for i in range(k - len(data) + 1):
-                    if isinstance(data, AtomicList):
-                        data.direct_append(None)
-                    else:
-                        data.append(None)
-
-                if isinstance(data, AtomicList):
-                    data.direct_set(k, value)
-                else:
-                    data[k] = value
-            else:
-                if isinstance(data, AtomicList) or isinstance(data, list):
-                    key = int(path[-1])
-                else:
-                    key = path[-1]
-
-                if isinstance(data, AtomicList) or isinstance(data, AtomicDict):
-                    data.direct_set(key, value)
-                else:
-                    data[key] = value
+    def updateAtomic(fullData, changes: Patch):
+        # Updates are applied to the raw data, so they are not recorded again
+        if isinstance(fullData, AtomicNode):
+            fullData = fullData._data
+        changes.apply(fullData)
 
     def updateAtomicSafe(self, data, changes):
         try:
@@ -242,23 +1044,207 @@ class DatastoreHandle(abc.ABC):
             return False
         return True
 
-    def save(self, otherUpdates=None):
-        updates = dict(self.data.updates)
+    def version(self, root: str, key: str) -> tuple[int, int]:
+        """
+        Return a counter that changes whenever a saved or synced update touches data[root][key].
+        """
+        return self.versions.get((root,), 0), self.versions.get((root, key), 0)
+
+    def bumpVersions(self, updates: Patch):
+        for root, node in updates.children.items():
+            if node.op is not None:
+                self.versions[(root,)] = self.versions.get((root,), 0) + 1
+            for key in node.children:
+                self.versions[(root, key)] = self.versions.get((root, key), 0) + 1
+
+    def changed(self, updates: Patch):
+        # Every update which reaches the data, saved here or synced from another process
+        self.bumpVersions(updates)
+        self.feed.publish((op, path) for op, path, _ in updates.records())
+
+    def subscribe(self, prefix: tuple, callback):
+        return self.feed.subscribe(prefix, callback)
+
+    def fingerprint(self, *path) -> str:
+        """
+        Hex content hash of data[path[0]][path[1]]..., which changes whenever that value does.
+        """
+        if self.fingerprints is None:
+            self.fingerprints = Fingerprints(self)
+        return self.fingerprints.get(path)
+
+    def summaries(self, root: str) -> dict[str, dict]:
+        """
+        The summary of every value of data[root] by key in order, see summarize_shards.
+        The values of a sharded root are only read when its index has no summary of them.
+        """
+        summary = shardSummaries[(os.path.basename(self.category), root)]
+        values = self.data._data.get(root, {})
+        if isinstance(values, ShardedDict):
+            return values.summaries(summary)
+        return {key: summary(value) for key, value in list(values.items())}
+
+    def changes(self, prefix: tuple = ()):
+        """
+        Async iterator over the changes of `prefix`, see ChangeFeed.stream.
+        """
+        return self.feed.stream(prefix)
+
+    def save(self, otherUpdates: Patch = None) -> None | int:
+        """
+        Commit the changes recorded outside of operations together with `otherUpdates`,
+        returns the sequence number to wait for when they go through the writer.
+        """
+        updates = self.data.updates.take()
         if otherUpdates:
-            updates.update(otherUpdates)
-        self.data.updates.clear()
+            updates.merge(otherUpdates)
         if not updates:
-            return
-
+            return None
+        self.changed(updates)
+        # The payload is only known once the updates are serialized, which is up to the commit
+        self.stats.operation(len(updates))
+
+        if self.writer is not None:
+            return self.writer.submit(updates, datastore_route.get())
+        with self.commitLock:
+            self.commit(updates)
+        return None
+
+    def commit(self, updates: Patch, routes: dict[str, int] = None):
+        start, written = time.perf_counter(), self.stats.bytesWritten
         self.saveAtomic(updates)
+        size = self.stats.bytesWritten - written
+        self.stats.commit((time.perf_counter() - start) * 1000, size)
+        self.stats.payload({datastore_route.get(): len(updates)} if routes is None else routes, size)
+
+    def timedLoad(self) -> dict:
+        start = time.perf_counter()
+        data = self.requestLoad()
+        self.stats.load((time.perf_counter() - start) * 1000)
+        return data
+
+    def report(self, memory: bool = False) -> dict:
+        report = self.stats.dump()
+        if self.writer is not None:
+            report["group_commit"] = dict(self.writer.stats)
+        if memory:
+            report["memory"] = deep_sizeof(self.data._data)
+        return report
+
+    def flush(self, sequence: int = None):
+        """
+        Wait until the given operation (or every saved operation) is written by the backend.
+        """
+        if self.writer is not None:
+            self.writer.flush(sequence)
+
+    async def durable(self, sequence: int = None):
+        if self.writer is not None:
+            await self.writer.durable(sequence)
 
-    def sync(self, updates):
+    def backgroundWriter(self) -> GroupCommitWriter:
+        # Without group commit, a writer that commits right away keeps the async operations in order.
+        # From then on every save goes through it, so the sync operations stay ordered with the async ones.
+        if self.writer is None:
+            self.writer = GroupCommitWriter(self.category, self.commit, 0, self.commitLock)
+        return self.writer
+
+    def sync(self, updates: Patch):
         self.updateAtomicSafe(self.data, updates)
+        self.changed(updates)
+
+    def unwrittenUpdates(self) -> Patch:
+        """
+        Return a copy of the updates which are in memory but not in the backend yet.
+        """
+        updates = Patch()
+        if self.writer is not None:
+            with self.writer.condition:
+                updates.merge(self.writer.pending)
+            updates = updates.copy()
+        updates.merge(self.data.updates.unsaved())
+        return updates
+
+    def refresh(self):
+        """
+        Apply the changes saved by other processes since the last refresh. The backend returns
+        every change in the order it was written, including our own, so the updates which are not
+        written yet are applied once more on top of them.
+        """
+        if not self.shared:
+            return
+
+        with self.commitLock:
+            changes = self.readChanges()
+            if changes is None:
+                data = self.timedLoad()
+            elif not changes:
+                return
+            unwritten = self.unwrittenUpdates()
+
+        if changes is None:
+            self.logger.info(f"Reloading {self.category}, the changes since the last refresh are not available")
+            roots = self.data._data.keys() | data.keys()
+            for root in roots:
+                self.versions[(root,)] = self.versions.get((root,), 0) + 1
+            self.data._data.clear()
+            self.data._data.update(data)
+            self.feed.publish((ChangeFeed.RESET, (root,)) for root in roots)
+        else:
+            for updates in changes:
+                self.sync(updates)
+        if unwritten:
+            self.updateAtomicSafe(self.data, unwritten)
 
     @contextlib.contextmanager
-    def operation(self):
-        yield self
-        self.save()
+    def operation(self, *scope):
+        """
+        Run the block as one operation on the path `scope`, for example ("sheets", sheet_id).
+        Operations on the same or nested paths run one at a time, the others run in parallel;
+        without a scope the whole datastore is locked. Locks are not reentrant.
+        The changes of the block are recorded separately and saved when it exits, even on an error,
+        as they are already in memory.
+        """
+        with self.locks.hold(scope):
+            updates, token = self.data.updates.begin()
+            try:
+                self.refresh()
+                yield self
+            finally:
+                sequence = self.endOperation(updates, token)
+                if sequence is not None and not self.groupCommitInterval:
+                    self.flush(sequence)
+
+    @contextlib.asynccontextmanager
+    async def aoperation(self, *scope):
+        """
+        Like `operation`, but the updates are serialized and written by the writer thread
+        and the event loop is free until they are durable. The updates are in memory
+        as soon as the block exits, in the order the operations exit in.
+        The scope is released once the updates are queued, so that the operations on one scope
+        which wait for the same commit are written in one batch.
+        """
+        sequence = None
+        try:
+            async with self.locks.ahold(scope):
+                updates, token = self.data.updates.begin()
+                try:
+                    if self.shared:
+                        await anyio.to_thread.run_sync(self.refresh)
+                    yield self
+                finally:
+                    self.backgroundWriter()
+                    sequence = self.endOperation(updates, token)
+        finally:
+            if sequence is not None:
+                await self.durable(sequence)
+
+    def endOperation(self, updates: Patch, token) -> None | int:
+        # Saved before the patch stops running, so refresh always finds it in one of the two places
+        try:
+            return self.save(updates)
+        finally:
+            self.data.updates.end(updates, token)
 
     @abc.abstractmethod
     def requestLoad(self):
@@ -269,7 +1255,14 @@ class DatastoreHandle(abc.ABC):
     @abc.abstractmethod
     def saveAtomic(self, data):
         """
-        Request the list of the given updates to be saved. May run in background.
+        Request the given patch to be saved. May run in background.
+        """
+
+    @abc.abstractmethod
+    def readChanges(self) -> None | list[Patch]:
+        """
+        Return the changes written by any process since the last call, or None when they can not
+        be read anymore and the data has to be loaded again. Only used by shared datastores.
         """
 
     @abc.abstractmethod
@@ -280,44 +1273,567 @@ class DatastoreHandle(abc.ABC):
 
 
 class DatastoreJSON(DatastoreHandle):
+    """
+    Stores every category as a snapshot in the `snapshot-format`, JSON by default. When the journal
+    is enabled, saves are appended to a write-ahead log instead of rewriting the snapshot, and the log
+    is folded into the snapshot every `checkpointInterval` records and on startup.
+
+    Roots listed in the `sharded` config are kept out of the snapshot, one file per key
+    in `<category>/<root>/`, and every file is only read when its key is first accessed.
+    The order of the keys and their summaries are kept in the `.index` of the folder, see ShardedDict.
+
+    Writers hold an exclusive lock on `<category>.lock`, so other processes (and backups) see
+    the files between two saves. A shared datastore always uses the journal, every record
+    is appended to it (including the sharded roots, whose files are written first),
+    and the other processes tail the journal to pick the records up. A checkpoint replaces the journal
+    with a new file that starts with `{"generation": N}`, so a reader notices it by the inode.
+    """
+
     baseDataFolder = cfg["datastore"]["data-folder"]
-    ExistingAttrs = DatastoreHandle.ExistingAttrs | {"filename", "baseDataFolder"}
+    serializer = snapshotSerializers[cfg["datastore"].get("snapshot-format", "json")]
+    useJournal = cfg["datastore"].get("journal", True)
+    checkpointInterval = cfg["datastore"].get("checkpoint-interval", 200)
+    shardedCategories = cfg["datastore"].get("sharded", {})
+    ExistingAttrs = DatastoreHandle.ExistingAttrs | {
+        "filename",
+        "journalFilename",
+        "journalRecords",
+        "journal",
+        "journalGeneration",
+        "lockFile",
+        "shardedRoots",
+        "baseDataFolder",
+        "serializer",
+        "useJournal",
+        "checkpointInterval",
+        "shardedCategories",
+    }
 
-    def __init__(self, category: str, sharedLock: bool = None):
-        self.filename = f"{self.baseDataFolder}/{category}.json"
+    def __init__(self, category: str, shared: bool = False):
+        self.filename = f"{self.baseDataFolder}/{category}{self.serializer.extension}"
+        self.journalFilename = f"{self.baseDataFolder}/{category}.journal"
+        self.journalRecords = 0
+        self.journal = None
+        self.journalGeneration = 0
+        self.shardedRoots = set(self.shardedCategories.get(os.path.basename(category), []))
         os.makedirs(os.path.dirname(self.filename), exist_ok=True)
-        super().__init__(category, sharedLock)
+        self.lockFile = open(f"{self.baseDataFolder}/{category}.lock", "a")
+        if shared:
+            self.useJournal = True
+        super().__init__(category, shared)
 
-    def requestLoad(self) -> dict:
+    def shardFolder(self, root: str) -> str:
+        return f"{self.baseDataFolder}/{self.category}/{root}"
+
+    def shards(self, root: str) -> ShardedDict:
+        return ShardedDict(self.shardFolder(root), self.readFile, self.serializer.extension)
+
+    @contextlib.contextmanager
+    def fileLock(self):
+        fcntl.flock(self.lockFile, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self.lockFile, fcntl.LOCK_UN)
+
+    @classmethod
+    def readFile(cls, filename: str, serializer=None):
+        with open(filename, "rb") as f:
+            raw = f.read()
+        # Loading creates millions of containers and none of them can be garbage yet,
+        # so the collector only slows it down
+        gcEnabled = gc.isenabled()
+        gc.disable()
+        try:
+            return (serializer or cls.serializer).loads(raw)
+        finally:
+            if gcEnabled:
+                gc.enable()
+
+    def readSnapshot(self) -> dict:
         try:
-            with open(self.filename, "r") as f:
-                return json.load(f)
+            return self.readFile(self.filename)
         except FileNotFoundError:
-            with open(self.filename, "w") as f:
-                f.write("{}")
+            self.writeSnapshot({})
             return {}
 
-    def saveAtomic(self, updates: dict) -> None:
-        # Dumping into string instead of the stream to prevent partial writes which corrupt the file
-        with open(self.filename, "r") as f:
-            data = json.load(f)
+    @classmethod
+    def writeFile(cls, filename: str, data) -> int:
+        # Dumping into bytes instead of the stream to prevent partial writes which corrupt the file
+        out = cls.serializer.dumps(data)
+        temporary = f"{filename}.tmp"
+        with open(temporary, "wb") as f:
+            f.write(out)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, filename)
+        return len(out)
+
+    def writeSnapshot(self, data: dict) -> None:
+        self.stats.written(self.writeFile(self.filename, data))
 
+    def convertSnapshots(self) -> None:
+        """
+        Rewrite the snapshot and the shards left in another format after `snapshot-format` was changed.
+        """
+        for name, serializer in snapshotSerializers.items():
+            if serializer is self.serializer:
+                continue
+
+            filename = f"{self.baseDataFolder}/{self.category}{serializer.extension}"
+            if os.path.exists(filename) and not os.path.exists(self.filename):
+                self.logger.info(f"Converting {filename} from {name}")
+                self.writeSnapshot(self.readFile(filename, serializer))
+                os.remove(filename)
+
+            for root in self.shardedRoots:
+                if not os.path.isdir(self.shardFolder(root)):
+                    continue
+                source, target = ShardedDict(self.shardFolder(root), None, serializer.extension), self.shards(root)
+                for key in source:
+                    self.writeFile(target.filename(key), self.readFile(source.filename(key), serializer))
+                    os.remove(source.filename(key))
+
+    @classmethod
+    def readFolder(cls, folder: str, category: str) -> dict:
+        """
+        Read a category of another data folder as loading it would, without writing anything there:
+        the snapshot in any format, the complete records of its journal and its sharded roots.
+        """
+        data = {}
+        for serializer in snapshotSerializers.values():
+            if os.path.exists(f"{folder}/{category}{serializer.extension}"):
+                data = cls.readFile(f"{folder}/{category}{serializer.extension}", serializer)
+                break
+
+        shardedRoots = set(cls.shardedCategories.get(os.path.basename(category), []))
+        with contextlib.suppress(FileNotFoundError), open(f"{folder}/{category}.journal", "rb") as journal:
+            for line in journal:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    records = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                # Records are lists, the generation header is the only dictionary
+                if isinstance(records, list):
+                    record = Patch.from_records(records)
+                    record.subset(record.children.keys() - shardedRoots).apply(data)
+
+        for root in shardedRoots:
+            # A root still inline in the snapshot replaces its shards when it is loaded
+            if isinstance(data.get(root), dict) or not os.path.isdir(f"{folder}/{category}/{root}"):
+                continue
+            data[root] = {}
+            for serializer in snapshotSerializers.values():
+                shards = ShardedDict(f"{folder}/{category}/{root}", None, serializer.extension)
+                for key in shards:
+                    data[root][key] = cls.readFile(shards.filename(key), serializer)
+        return data
+
+    def openJournal(self):
+        """
+        Open the journal for reading and return it with its generation. Journals written before
+        the generation header was added are generation 0.
+        """
+        journal = open(self.journalFilename, "rb")
+        header = journal.readline()
+        if header.startswith(b"{") and header.endswith(b"\n"):
+            return journal, json.loads(header)["generation"]
+        journal.seek(0)
+        return journal, 0
+
+    def startJournal(self, generation: int) -> None:
+        temporary = f"{self.journalFilename}.tmp"
+        with open(temporary, "w") as f:
+            f.write(json.dumps({"generation": generation}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, self.journalFilename)
+
+    def readRecords(self, journal) -> list[Patch]:
+        """
+        Read the complete records from the current position of the journal. The position is left
+        before an incomplete record, which is either still being appended or torn by a crash.
+        """
+        records = []
+        while True:
+            position = journal.tell()
+            line = journal.readline()
+            if not line.endswith(b"\n"):
+                journal.seek(position)
+                break
+            try:
+                records.append(Patch.from_records(json.loads(line)))
+            except json.JSONDecodeError:
+                self.logger.warning(f"Discarding a torn journal record in {self.journalFilename}")
+        return records
+
+    def readJournal(self) -> list[Patch]:
+        try:
+            journal, generation = self.openJournal()
+        except FileNotFoundError:
+            return []
+        with journal:
+            return self.readRecords(journal)
+
+    def checkpoint(self) -> dict:
+        """
+        Fold the journal into the snapshot. If the process dies between replacing the snapshot
+        and replacing the journal, the journal is replayed once more on startup, which converges
+        to the same state because every record only sets or removes values.
+        Shared datastores must hold the file lock.
+        """
+        data = self.readSnapshot()
+        generation = 0
+        with contextlib.suppress(FileNotFoundError):
+            journal, generation = self.openJournal()
+            with journal:
+                for record in self.readRecords(journal):
+                    if self.shardedRoots:
+                        # A shared journal also carries the changes of the sharded roots, which are in their own files
+                        record = record.subset(record.children.keys() - self.shardedRoots)
+                    self.updateAtomicSafe(data, record)
+        self.writeSnapshot(data)
+        self.startJournal(generation + 1)
+        self.journalRecords = 0
+        return data
+
+    def requestLoad(self) -> dict:
+        with self.fileLock():
+            self.convertSnapshots()
+            if self.useJournal and self.readJournal():
+                data = self.checkpoint()
+            else:
+                data = self.readSnapshot()
+
+            for root in self.shardedRoots:
+                if isinstance(data.get(root), dict):
+                    # The root is still inline from before it was sharded, move it out of the snapshot
+                    self.writeShards(root, data.pop(root))
+                    self.writeSnapshot(data)
+                if os.path.isdir(self.shardFolder(root)):
+                    data[root] = self.shards(root)
+
+            if self.shared:
+                if not os.path.exists(self.journalFilename):
+                    self.startJournal(0)
+                if self.journal is not None:
+                    self.journal.close()
+                # Everything written before this point is in the data, the other processes' changes are read from here
+                self.journal, self.journalGeneration = self.openJournal()
+                self.readRecords(self.journal)
+        return data
+
+    def readChanges(self) -> None | list[Patch]:
+        try:
+            replaced = os.stat(self.journalFilename).st_ino != os.fstat(self.journal.fileno()).st_ino
+        except FileNotFoundError:
+            return None
+
+        # After a checkpoint replaced the journal nothing is appended to the old one, so it is read to the end first
+        changes = self.readRecords(self.journal)
+        if replaced:
+            self.journal.close()
+            self.journal, generation = self.openJournal()
+            if generation != self.journalGeneration + 1:
+                return None
+            self.journalGeneration = generation
+            changes += self.readRecords(self.journal)
+        return changes
+
+    def sync(self, updates: Patch):
+        for root in self.shardedRoots & updates.children.keys():
+            shards = self.data._data.get(root)
+            if isinstance(shards, ShardedDict):
+                # A shard which is not loaded yet will be read from its file, which already has the change
+                node = updates.children[root]
+                for key in node.children.keys() - shards.loaded.keys():
+                    if key in shards.shardKeys:
+                        shards.shardKeys[key] = None
+                node.children = {
+                    key: child for key, child in node.children.items() if child.op is not None or key in shards.loaded
+                }
+        super().sync(updates)
+
+    def writeShards(self, root: str, value: None | dict) -> None:
+        shutil.rmtree(self.shardFolder(root), ignore_errors=True)
+        if value is None:
+            return
+
+        os.makedirs(self.shardFolder(root))
+        shards = self.shards(root)
+        for key, shard in value.items():
+            self.stats.written(self.writeFile(shards.filename(key), shard))
+            shards.shardKeys[key] = self.summarize(root, shard)
+        self.stats.written(shards.writeIndex())
+
+    def summarize(self, root: str, value) -> None | dict:
+        summary = shardSummaries.get((os.path.basename(self.category), root))
+        return None if summary is None else summary(value)
+
+    def saveShards(self, updates: Patch) -> None:
+        for root, node in updates.children.items():
+            if node.op is not None:
+                self.writeShards(root, node.value if node.op == Patch.SET else None)
+            if not node.children:
+                continue
+
+            # Only the shards below the changed keys are read, patched and written back
+            shards = self.shards(root)
+            documents = {key: shards[key] for key in node.children if key in shards}
+            self.updateAtomicSafe(documents, node)
+            summaries = {key: self.summarize(root, document) for key, document in documents.items()}
+            stale = [key for key, summary in summaries.items() if shards.shardKeys.get(key) not in (None, summary)]
+            if stale:
+                # Until the index is written again the changed shards are read to summarize them,
+                # so a crash in between does not leave an outdated summary
+                shards.shardKeys.update(dict.fromkeys(stale))
+                self.stats.written(shards.writeIndex())
+
+            index = dict(shards.shardKeys)
+            for key in node.children:
+                if key in documents:
+                    self.stats.written(self.writeFile(shards.filename(key), documents[key]))
+                    shards.shardKeys[key] = summaries[key]
+                else:
+                    shards.shardKeys.pop(key, None)
+                    try:
+                        os.remove(shards.filename(key))
+                    except FileNotFoundError:
+                        pass
+            if shards.shardKeys != index:
+                self.stats.written(shards.writeIndex())
+
+    def appendJournal(self, record: str) -> None:
+        with open(self.journalFilename, "ab+") as f:
+            if f.tell():
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    # A process died in the middle of an append, cut the torn record off before appending after it.
+                    # The journal is only checkpointed at load if it has complete records, so this is in any mode
+                    f.seek(0)
+                    f.truncate(f.read().rfind(b"\n") + 1)
+            data = record.encode() + b"\n"
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        self.stats.written(len(data))
+
+    def saveAtomic(self, updates: Patch) -> None:
+        with self.fileLock():
+            if not self.shardedRoots.isdisjoint(updates.children):
+                self.saveShards(updates.subset(self.shardedRoots))
+                if not self.shared:
+                    updates = updates.subset(updates.children.keys() - self.shardedRoots)
+                    if not updates:
+                        return
+
+            if not self.useJournal:
+                self.saveSnapshot(updates)
+                return
+
+            try:
+                record = updates.dump()
+            except TypeError:
+                self.logger.warning(f"Invalid data: {updates}")
+                traceback.print_exc()
+                return
+
+            self.appendJournal(record)
+            self.journalRecords += 1
+            if self.journalRecords >= self.checkpointInterval:
+                self.checkpoint()
+
+    def saveSnapshot(self, updates: Patch) -> None:
+        data = self.readSnapshot()
         self.updateAtomicSafe(data, updates)
         try:
-            out = json.dumps(data, indent=2)
+            self.writeSnapshot(data)
         except TypeError:
             self.logger.warning(f"Invalid data: {data}")
             traceback.print_exc()
-            return
 
-        with open(self.filename, "w") as f:
-            f.write(out)
+    def wipe(self) -> None:
+        for filename in (self.filename, self.journalFilename):
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+        for root in self.shardedRoots:
+            shutil.rmtree(self.shardFolder(root), ignore_errors=True)
+
+
+class DatastoreSQLite(DatastoreHandle):
+    """
+    Stores every category in its own SQLite database. Top-level values which are dictionaries
+    are split into one row per child, so an update under `sheets.<id>` only rewrites that row.
+
+    A shared datastore also writes every patch into the `changes` table in the same transaction,
+    and the other processes read the rows after the last one they have seen. Only the last
+    `retainedChanges` rows are kept, a process which falls further behind loads everything again.
+    """
+
+    baseDataFolder = cfg["datastore"]["data-folder"]
+    retainedChanges = 10000
+    ExistingAttrs = DatastoreHandle.ExistingAttrs | {
+        "filename",
+        "connection",
+        "connectionLock",
+        "lastChange",
+        "baseDataFolder",
+        "retainedChanges",
+    }
+
+    def __init__(self, category: str, shared: bool = False):
+        self.filename = f"{self.baseDataFolder}/{category}.sqlite3"
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        self.connection = sqlite3.connect(self.filename, timeout=30, check_same_thread=False)
+        self.connectionLock = threading.Lock()
+        self.lastChange = 0
+        with self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            # value is NULL for the roots which are split into documents
+            self.connection.execute("CREATE TABLE IF NOT EXISTS roots (root TEXT PRIMARY KEY, value TEXT)")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS documents "
+                "(root TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, PRIMARY KEY (root, key))"
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS changes (id INTEGER PRIMARY KEY AUTOINCREMENT, patch TEXT NOT NULL)"
+            )
+        super().__init__(category, shared)
+
+    def requestLoad(self) -> dict:
+        data = {}
+        with self.connectionLock:
+            # One read transaction, so the data and the position in the changes come from the same state
+            self.connection.execute("BEGIN")
+            try:
+                for root, value in self.connection.execute("SELECT root, value FROM roots"):
+                    data[root] = {} if value is None else json.loads(value)
+                # In the order the keys were added
+                for root, key, value in self.connection.execute(
+                    "SELECT root, key, value FROM documents ORDER BY rowid"
+                ):
+                    data[root][key] = json.loads(value)
+                self.lastChange = self.connection.execute("SELECT COALESCE(MAX(id), 0) FROM changes").fetchone()[0]
+            finally:
+                self.connection.commit()
+        return data
+
+    def readChanges(self) -> None | list[Patch]:
+        with self.connectionLock:
+            rows = self.connection.execute(
+                "SELECT id, patch FROM changes WHERE id > ? ORDER BY id", (self.lastChange,)
+            ).fetchall()
+        if not rows:
+            return []
+        if rows[0][0] != self.lastChange + 1:
+            return None
+        self.lastChange = rows[-1][0]
+        return [Patch.from_records(json.loads(patch)) for _, patch in rows]
+
+    def loadRoot(self, root: str):
+        row = self.connection.execute("SELECT value FROM roots WHERE root = ?", (root,)).fetchone()
+        if row is None:
+            return DatastoreSentinel
+        if row[0] is not None:
+            return json.loads(row[0])
+        documents = self.connection.execute("SELECT key, value FROM documents WHERE root = ? ORDER BY rowid", (root,))
+        return {key: json.loads(value) for key, value in documents}
+
+    def isSplitRoot(self, root: str) -> bool:
+        row = self.connection.execute("SELECT value FROM roots WHERE root = ?", (root,)).fetchone()
+        return row is not None and row[0] is None
+
+    def encode(self, value) -> str:
+        out = json.dumps(value)
+        self.stats.written(len(out))
+        return out
+
+    def writeRoot(self, root: str, value) -> None:
+        self.connection.execute("DELETE FROM documents WHERE root = ?", (root,))
+        if isinstance(value, dict):
+            self.connection.execute("INSERT OR REPLACE INTO roots VALUES (?, NULL)", (root,))
+            self.connection.executemany(
+                "INSERT INTO documents VALUES (?, ?, ?)", [(root, k, self.encode(v)) for k, v in value.items()]
+            )
+        else:
+            self.connection.execute("INSERT OR REPLACE INTO roots VALUES (?, ?)", (root, self.encode(value)))
+
+    def saveAtomic(self, updates: Patch) -> None:
+        # Only the rows touched by the updates are loaded, patched and written back
+        partial = {}
+        fullRoots = set()
+        with self.connectionLock:
+            if self.shared:
+                # Take the write lock before reading, so no other process changes these rows in between
+                self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                for root, node in updates.children.items():
+                    if node.op is not None or not self.isSplitRoot(root):
+                        fullRoots.add(root)
+                        if node.op is None and (value := self.loadRoot(root)) is not DatastoreSentinel:
+                            partial[root] = value
+                        continue
+
+                    documents = partial[root] = {}
+                    for key in node.children:
+                        row = self.connection.execute(
+                            "SELECT value FROM documents WHERE root = ? AND key = ?", (root, key)
+                        ).fetchone()
+                        if row is not None:
+                            documents[key] = json.loads(row[0])
+
+                self.updateAtomicSafe(partial, updates)
+                with self.connection:
+                    for root, node in updates.children.items():
+                        if root not in fullRoots:
+                            for key in node.children:
+                                if key in partial[root]:
+                                    self.connection.execute(
+                                        # An upsert keeps the rowid, and with it the position of the key
+                                        "INSERT INTO documents VALUES (?, ?, ?) "
+                                        "ON CONFLICT (root, key) DO UPDATE SET value = excluded.value",
+                                        (root, key, self.encode(partial[root][key])),
+                                    )
+                                else:
+                                    self.connection.execute(
+                                        "DELETE FROM documents WHERE root = ? AND key = ?", (root, key)
+                                    )
+                        elif root in partial:
+                            self.writeRoot(root, partial[root])
+                        else:
+                            self.connection.execute("DELETE FROM roots WHERE root = ?", (root,))
+                            self.connection.execute("DELETE FROM documents WHERE root = ?", (root,))
+                    if self.shared:
+                        change = self.connection.execute(
+                            "INSERT INTO changes (patch) VALUES (?)", (self.encodePatch(updates),)
+                        )
+                        self.connection.execute(
+                            "DELETE FROM changes WHERE id <= ?", (change.lastrowid - self.retainedChanges,)
+                        )
+            except TypeError:
+                self.logger.warning(f"Invalid data: {updates}")
+                traceback.print_exc()
+            finally:
+                if self.connection.in_transaction:
+                    self.connection.rollback()
+
+    def encodePatch(self, updates: Patch) -> str:
+        out = updates.dump()
+        self.stats.written(len(out))
+        return out
 
     def wipe(self) -> None:
-        try:
-            os.remove(f"{self.baseDataFolder}/{self.category}.json")
-        except FileNotFoundError:
-            pass
+        with self.connectionLock, self.connection:
+            self.connection.execute("DELETE FROM roots")
+            self.connection.execute("DELETE FROM documents")
+            # The old changes must not be replayed onto the wiped data, and the skipped id
+            # makes the other processes see a gap and load everything again
+            self.connection.execute("DELETE FROM changes")
+            self.connection.execute("UPDATE sqlite_sequence SET seq = seq + 1 WHERE name = 'changes'")
 
 
 class DatastoreManager:
@@ -325,24 +1841,106 @@ class DatastoreManager:
 
     dbBackends = {
         "json": DatastoreJSON,
+        "sqlite": DatastoreSQLite,
     }
 
-    def __init__(self, dbBackend: str, prefix: str = None):
+    def __init__(self, dbBackend: str, prefix: str = None, shared: bool = None):
         self.datastores = {}
-        self.sharedLocks = {}
         self.prefix = prefix
+        self.lock = threading.Lock()
+        self.shared = cfg["datastore"].get("shared", False) if shared is None else shared
 
         assert dbBackend in self.dbBackends, f"Invalid datastore backend: {dbBackend}"
         self.accountCtor = self.dbBackends[dbBackend]
 
+    def qualify(self, name: str) -> str:
+        """
+        The full name of a category in the current tenant, names with a slash are taken as they are.
+        """
+        if "/" in name:
+            return name
+        return "/".join(part for part in (self.prefix, datastore_tenant.get(), name) if part is not None)
+
     def get(self, name: str) -> DatastoreHandle:
-        usesOverride = True
-        if "/" not in name and self.prefix is not None:
-            usesOverride = False
-            name = f"{self.prefix}/{name}"
+        name = self.qualify(name)
         if name not in self.datastores:
-            self.datastores[name] = self.accountCtor(name, usesOverride)
+            with self.lock:
+                if name not in self.datastores:
+                    self.datastores[name] = self.accountCtor(name, self.shared)
         return self.datastores[name]
 
+    def scoped(self, name: str) -> "TenantDatastore":
+        return TenantDatastore(self, name)
+
+    def refresh(self):
+        # Runs in a thread, while requests may add categories
+        with self.lock:
+            datastores = list(self.datastores.values())
+        for datastore in datastores:
+            datastore.refresh()
+
+    def stats(self, memory: bool = False) -> dict:
+        return {name: datastore.report(memory) for name, datastore in self.datastores.items()}
+
+
+class TenantDatastore:
+    """
+    Stands for a category in the tenant of the current request, so that a module can keep it in a global.
+    Everything is forwarded to the handle DatastoreManager.get returns at the time of use.
+    """
+
+    __slots__ = ("manager", "name")
+
+    def __init__(self, manager: DatastoreManager, name: str):
+        object.__setattr__(self, "manager", manager)
+        object.__setattr__(self, "name", name)
+
+    def handle(self) -> DatastoreHandle:
+        return self.manager.get(self.name)
+
+    def __getattr__(self, key):
+        return getattr(self.handle(), key)
+
+    def __setattr__(self, key, value):
+        setattr(self.handle(), key, value)
+
+    def __getitem__(self, key):
+        return self.handle()[key]
+
+    def __setitem__(self, key, value):
+        self.handle()[key] = value
+
+    def __delitem__(self, key):
+        del self.handle()[key]
+
+    def __contains__(self, key):
+        return key in self.handle()
+
+
+class TenantLocal:
+    """
+    One object per tenant, made by `factory` on first use in that tenant.
+    Attributes and `in` are forwarded to the object of the current tenant.
+    """
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.objects = {}
+        self.lock = threading.Lock()
+
+    def current(self):
+        tenant = datastore_tenant.get()
+        if tenant not in self.objects:
+            with self.lock:
+                if tenant not in self.objects:
+                    self.objects[tenant] = self.factory()
+        return self.objects[tenant]
+
+    def __getattr__(self, key):
+        return getattr(self.current(), key)
+
+    def __contains__(self, key):
+        return key in self.current()
+
 
 datastore_manager = DatastoreManager(cfg["datastore"]["backend"])
@@ -0,0 +1,124 @@
+import hashlib
+import json
+import marshal
+import os
+import threading
+from collections import OrderedDict
+
+from pyconduit.models.conduit import Conduit
+from pyconduit.models.user import UserUnprivileged
+from pyconduit.shared.datastore import cfg, deep_sizeof
+
+# Part of every digest, bump it when the formulas of the same inputs start to give different results
+FormulaCacheVersion = 2
+
+
+class FormulaCache:
+    """
+    Results of calculate_with_formula by a digest of all of its inputs, so a changed input is simply
+    a different key and nothing has to be invalidated. The most recently used results are kept in memory
+    up to `memory_limit` bytes, every result is also written to `folder` to survive restarts,
+    which keeps the most recently written ones up to `disk_limit` bytes.
+    """
+
+    def __init__(self, folder: str, memory_limit: int, disk_limit: int):
+        self.folder = folder
+        self.memory_limit = memory_limit
+        self.disk_limit = disk_limit
+        self.lock = threading.Lock()
+        self.entries: OrderedDict[str, tuple[int, dict]] = OrderedDict()
+        self.memory = 0
+        # Sizes of the files by digest, oldest first, read from the folder on first use
+        self.files: None | OrderedDict[str, int] = None
+        self.disk = 0
+
+    @staticmethod
+    def digest(conduit: Conduit, file_id: str, filename: str, users: list[UserUnprivileged], formula: str) -> str:
+        # Not sorted, the order of the rows and columns is part of the result
+        inputs = [FormulaCacheVersion, file_id, filename, formula, conduit.dict(), [user.dict() for user in users]]
+        return hashlib.blake2b(json.dumps(inputs, ensure_ascii=False).encode(), digest_size=20).hexdigest()
+
+    def filename(self, digest: str) -> str:
+        return os.path.join(self.folder, f"{digest}.marshal")
+
+    def scan(self) -> None:
+        if self.files is not None:
+            return
+        self.files = OrderedDict()
+        if not os.path.isdir(self.folder):
+            return
+        stats = []
+        for name in os.listdir(self.folder):
+            if name.endswith(".marshal"):
+                try:
+                    stats.append((os.stat(os.path.join(self.folder, name)), name[: -len(".marshal")]))
+                except FileNotFoundError:
+                    pass
+        for stat, digest in sorted(stats, key=lambda item: item[0].st_mtime_ns):
+            self.files[digest] = stat.st_size
+            self.disk += stat.st_size
+
+    def remember(self, digest: str, value: dict) -> None:
+        size = deep_sizeof(value)
+        if digest in self.entries:
+            self.memory -= self.entries.pop(digest)[0]
+        self.entries[digest] = (size, value)
+        self.memory += size
+        while self.memory > self.memory_limit and self.entries:
+            self.memory -= self.entries.popitem(last=False)[1][0]
+
+    def get(self, digest: str) -> None | dict:
+        """
+        The cached result, callers get their own copy. None if there is none.
+        """
+        with self.lock:
+            if digest in self.entries:
+                self.entries.move_to_end(digest)
+                return marshal.loads(marshal.dumps(self.entries[digest][1]))
+
+        try:
+            with open(self.filename(digest), "rb") as f:
+                value = marshal.load(f)
+        except FileNotFoundError:
+            return None
+        except (EOFError, ValueError, TypeError):
+            # Written by another Python version or cut short, computed again and replaced
+            return None
+
+        with self.lock:
+            self.remember(digest, value)
+        return marshal.loads(marshal.dumps(value))
+
+    def put(self, digest: str, value: dict) -> None:
+        data = marshal.dumps(value)
+        with self.lock:
+            self.remember(digest, marshal.loads(data))
+            self.scan()
+
+        os.makedirs(self.folder, exist_ok=True)
+        # Other worker processes may write the same result at the same time
+        temporary = f"{self.filename(digest)}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temporary, "wb") as f:
+            f.write(data)
+        os.replace(temporary, self.filename(digest))
+
+        with self.lock:
+            self.disk += len(data) - self.files.pop(digest, 0)
+            self.files[digest] = len(data)
+            removed = []
+            while self.disk > self.disk_limit and len(self.files) > 1:
+                old, size = self.files.popitem(last=False)
+                self.disk -= size
+                removed.append(old)
+        for old in removed:
+            try:
+                os.remove(self.filename(old))
+            except FileNotFoundError:
+                pass
+
+
+formula_cache = FormulaCache(
+    os.path.join(cfg["datastore"]["data-folder"], ".formula-cache"),
+    cfg.get("formulas", {}).get("cache-memory-mb", 64) * 1024 * 1024,
+    cfg.get("formulas", {}).get("cache-disk-mb", 256) * 1024 * 1024,
+)
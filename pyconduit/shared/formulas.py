@@ -1,16 +1,30 @@
+import ast
+import hashlib
+import io
 import logging
+import marshal
+import math
 import multiprocessing
+import os
 import resource
+import signal
+import sys
+import threading
+import time
+import tracemalloc
+from array import array
+from collections import OrderedDict
+from functools import lru_cache
 from typing import Callable, TypeVar
 
-import _queue
 from asteval import Interpreter
 from coloraide import Color
 
 from pyconduit.models.conduit import ConduitContent
 from pyconduit.models.user import UserUnprivileged
+from pyconduit.shared.helpers import get_environment_config
 
-formula_lock = multiprocessing.Lock()
+cfg = get_environment_config().get("formulas", {})
 Position = int | None
 # (position to insert into, row/column id, row/column name, list of values) -> value in the new cell
 ConduitCallback = Callable[[Position, str | int, str, list[str]], str]
@@ -22,10 +36,39 @@ Range = tuple[str, str]
 ColorTuple = tuple[int, int, int]
 T = TypeVar("T")
 logger = logging.getLogger("pyconduit.shared.formulas")
-# Experimentally figured the least amount of memory needed is 30M, but setting it higher
-# because server can be loaded differently in different requests
-# Also, numbers near 70 often cause ASGI errors for no reason so should avoid these
-MEMORY_LIMIT = 1024 * 1024 * 150
+# Address space a formula may take on top of what the worker has after its imports
+MEMORY_LIMIT = 1024 * 1024 * cfg.get("memory-limit-mb", 150)
+# Seconds a formula may run before its worker is killed
+TIME_LIMIT = cfg.get("timeout-ms", 500) / 1000
+# Seconds a profiled formula may run before it is stopped with what has been measured so far
+PROFILE_TIME_LIMIT = cfg.get("profile-timeout-ms", 5000) / 1000
+# Seconds the forkserver gets to start a worker
+START_TIMEOUT = 10
+# Parsed formulas kept by every worker
+COMPILED_FORMULAS = 16
+# Colors of every gradient, cells get the nearest one
+GRADIENT_LEVELS = 64
+# Prefix of the cell styles which are keys of ConduitContent.palette
+PALETTE_REFERENCE = "@"
+# The provider methods formulas may use for IncrementalFormulaProvider to give the result of a full run
+ProviderInterface = {
+    "add_column",
+    "add_row",
+    "add_formatter",
+    "add_row_formatter",
+    "add_column_formatter",
+    "add_gradient_formatter",
+    "add_column_values",
+    "add_row_values",
+    "add_mask_formatter",
+    "scores",
+    "problem_names",
+    "base_value",
+    "is_solved",
+    "is_real",
+}
+SandboxOptions = dict(builtins_readonly=True, no_assert=True, no_delete=True, no_raise=True, no_print=True)
+compiled_formulas: OrderedDict[bytes, ast.Module] = OrderedDict()
 
 
 def insert_into(values: list[T], value: T, position: Position):
@@ -35,14 +78,166 @@ def insert_into(values: list[T], value: T, position: Position):
         values.insert(position, value)
 
 
-def read_queue(queue: multiprocessing.Queue) -> str:
-    if "provider" in globals():
-        raise RuntimeError("Don't try to execute inside the sandbox")
-    while True:
+@lru_cache(maxsize=64)
+def gradient_palette(from_color: ColorTuple, to_color: ColorTuple, mid_color: None | ColorTuple) -> tuple[str, ...]:
+    """
+    The styles of GRADIENT_LEVELS evenly spaced positions from `from_color` through `mid_color` to `to_color`.
+    """
+    interpolations = [Color(f"rgb{from_color}"), Color(f"rgb{to_color}")]
+    if mid_color is not None:
+        interpolations.insert(1, Color(f"rgb{mid_color}"))
+    inter = Color.interpolate(interpolations)
+    return tuple(
+        f"background-color: {inter(level / (GRADIENT_LEVELS - 1)).to_string()}" for level in range(GRADIENT_LEVELS)
+    )
+
+
+class CellMask:
+    """
+    A set of cells of a ScoreMatrix, one byte per cell row by row. Masks combine with &, | and ~.
+    """
+
+    def __init__(self, matrix: "ScoreMatrix", bits: bytes):
+        self.matrix = matrix
+        self.bits = bits
+
+    def combine(self, other: "CellMask", operation: Callable[[int, int], int]) -> "CellMask":
+        if other.matrix is not self.matrix:
+            raise ValueError("Masks of different score matrices cannot be combined")
+        # Every byte is 0 or 1, so the bitwise operations of the whole masks as integers work on every cell at once
+        value = operation(int.from_bytes(self.bits, "big"), int.from_bytes(other.bits, "big"))
+        return CellMask(self.matrix, value.to_bytes(len(self.bits), "big"))
+
+    def __and__(self, other: "CellMask") -> "CellMask":
+        return self.combine(other, int.__and__)
+
+    def __or__(self, other: "CellMask") -> "CellMask":
+        return self.combine(other, int.__or__)
+
+    def __invert__(self) -> "CellMask":
+        return self.combine(self.matrix.everything(), int.__xor__)
+
+    def __len__(self) -> int:
+        return self.bits.count(1)
+
+    def cells(self) -> list[tuple[str, str]]:
+        width = len(self.matrix.columns)
+        cells = []
+        index = self.bits.find(1)
+        while index != -1:
+            cells.append((self.matrix.rows[index // width], self.matrix.columns[index % width]))
+            index = self.bits.find(1, index + 1)
+        return cells
+
+
+class ScoreMatrix:
+    """
+    The cells of a conduit as numbers, for formulas which work on whole rows and columns at once instead of
+    a callback per cell. A score is the integer before the first ';' of a cell and 0 if there is none.
+    Scores and solved flags are kept row by row in flat arrays, `rows` and `columns` are in the order of the document.
+    """
+
+    def __init__(self, rows: list[str], columns: list[str], content: dict[str, list[str]]):
+        self.rows = rows
+        self.columns = columns
+        self.row_index = {row: index for index, row in enumerate(rows)}
+        self.column_index = {column: index for index, column in enumerate(columns)}
+        scores = []
+        solved = bytearray()
+        for row in rows:
+            for value in content[row]:
+                value = FormulaProvider.base_value(value)
+                solved.append(value != "" and value != "0")
+                try:
+                    scores.append(int(value))
+                except ValueError:
+                    scores.append(0)
+        # Scores which do not fit into 64 bits are kept as a list of Python integers instead
         try:
-            yield queue.get_nowait()
-        except _queue.Empty:
-            break
+            self.scores = array("q", scores)
+        except OverflowError:
+            self.scores = scores
+        self.solved_bits = bytes(solved)
+
+    def indices(self, names: None | list[str], index: dict[str, int]) -> list[int]:
+        return list(index.values()) if names is None else [index[name] for name in names]
+
+    def score(self, row: str, column: str) -> int:
+        return self.scores[self.row_index[row] * len(self.columns) + self.column_index[column]]
+
+    def row(self, row: str) -> list[int]:
+        start = self.row_index[row] * len(self.columns)
+        return list(self.scores[start : start + len(self.columns)])
+
+    def column(self, column: str) -> list[int]:
+        return list(self.scores[self.column_index[column] :: len(self.columns)])
+
+    def row_sums(self, columns: list[str] = None) -> list[int]:
+        """
+        The sum of every row over `columns`, all of them by default.
+        """
+        width = len(self.columns)
+        if columns is None:
+            return [sum(self.scores[start : start + width]) for start in range(0, len(self.scores), width)]
+        indices = self.indices(columns, self.column_index)
+        return [sum(self.scores[start + index] for index in indices) for start in range(0, len(self.scores), width)]
+
+    def column_sums(self, rows: list[str] = None) -> list[int]:
+        """
+        The sum of every column over `rows`, all of them by default.
+        """
+        width = len(self.columns)
+        if rows is None:
+            return [sum(self.scores[index::width]) for index in range(width)]
+        starts = [index * width for index in self.indices(rows, self.row_index)]
+        return [sum(self.scores[start + index] for start in starts) for index in range(width)]
+
+    def row_solved(self, columns: list[str] = None) -> list[int]:
+        """
+        The number of solved cells of every row among `columns`, all of them by default.
+        """
+        width = len(self.columns)
+        bits = self.solved_bits
+        if columns is None:
+            return [bits.count(1, start, start + width) for start in range(0, len(bits), width)]
+        indices = self.indices(columns, self.column_index)
+        return [sum(bits[start + index] for index in indices) for start in range(0, len(bits), width)]
+
+    def column_solved(self, rows: list[str] = None) -> list[int]:
+        """
+        The number of solved cells of every column among `rows`, all of them by default.
+        """
+        width = len(self.columns)
+        if rows is None:
+            return [self.solved_bits[index::width].count(1) for index in range(width)]
+        starts = [index * width for index in self.indices(rows, self.row_index)]
+        return [sum(self.solved_bits[start + index] for start in starts) for index in range(width)]
+
+    def everything(self) -> CellMask:
+        return CellMask(self, bytes([1]) * len(self.scores))
+
+    def solved(self) -> CellMask:
+        return CellMask(self, self.solved_bits)
+
+    def at_least(self, minimum: int) -> CellMask:
+        return CellMask(self, bytes(score >= minimum for score in self.scores))
+
+    def at_most(self, maximum: int) -> CellMask:
+        return CellMask(self, bytes(score <= maximum for score in self.scores))
+
+    def in_rows(self, rows: list[str]) -> CellMask:
+        width = len(self.columns)
+        bits = bytearray(len(self.scores))
+        for index in self.indices(rows, self.row_index):
+            bits[index * width : (index + 1) * width] = bytes([1]) * width
+        return CellMask(self, bytes(bits))
+
+    def in_columns(self, columns: list[str]) -> CellMask:
+        width = len(self.columns)
+        bits = bytearray(len(self.scores))
+        for index in self.indices(columns, self.column_index):
+            bits[index::width] = bytes([1]) * len(self.rows)
+        return CellMask(self, bytes(bits))
 
 
 class FormulaProvider:
@@ -53,6 +248,16 @@ class FormulaProvider:
         self.problem_name_set = set(self.problem_names)
         self.limited_rows = []
         self.limited_columns = []
+        self.matrix: None | ScoreMatrix = None
+        # Numbers of the gradients by their colors, in the order the formula adds them
+        self.gradients: dict[tuple, int] = {}
+
+    def finish(self):
+        self.doc.limited_rows = self.limited_rows
+        self.doc.limited_columns = self.limited_columns
+        # Only what is left after all formatters, overwritten gradient cells may have added more
+        used = {style for styles in self.doc.styles.values() for style in styles.values()}
+        self.doc.palette = {key: style for key, style in self.doc.palette.items() if PALETTE_REFERENCE + key in used}
 
     @staticmethod
     def base_value(value: str) -> str:
@@ -94,6 +299,46 @@ class FormulaProvider:
         if is_limited:
             self.limited_rows.append(row_id)
 
+    def scores(self) -> ScoreMatrix:
+        """
+        The ScoreMatrix of all rows and columns there are now.
+        """
+        rows, columns = list(self.doc.conduit.content), self.doc.conduit.problem_names
+        if self.matrix is None or self.matrix.rows != rows or self.matrix.columns != columns:
+            self.matrix = ScoreMatrix(rows, list(columns), self.doc.conduit.content)
+        return self.matrix
+
+    def add_column_values(self, position: Position, name: str, values: list, is_limited: bool = False):
+        """
+        Add a column with one value for each row, in the order of ScoreMatrix.rows.
+        """
+        if len(values) != len(self.doc.conduit.content):
+            raise ValueError(f"Expected {len(self.doc.conduit.content)} values, got {len(values)}")
+        insert_into(self.doc.conduit.problem_names, name, position)
+        for row, value in zip(self.doc.conduit.content.values(), values):
+            insert_into(row, str(value), position)
+
+        if is_limited:
+            self.limited_columns.append(name)
+
+    def add_row_values(self, position: Position, row_id: str, row_name: str, values: list, is_limited: bool = False):
+        """
+        Add a row with one value for each column, in the order of ScoreMatrix.columns.
+        """
+        if len(values) != len(self.doc.conduit.problem_names):
+            raise ValueError(f"Expected {len(self.doc.conduit.problem_names)} values, got {len(values)}")
+        row_id = f"_{row_id}"
+        insert_into(self.doc.users, UserUnprivileged(login=row_id, name=row_name), position)
+        self.usernames[row_id] = row_name
+        self.doc.conduit.content[row_id] = [str(value) for value in values]
+
+        if is_limited:
+            self.limited_rows.append(row_id)
+
+    def add_mask_formatter(self, mask: CellMask, style: str):
+        for row, column in mask.cells():
+            self.doc.styles.setdefault(row, {})[column] = style
+
     def add_formatter(self, callback: FormatterCallback):
         for index, problem in enumerate(self.doc.conduit.problem_names):
             for user in self.doc.conduit.content:
@@ -124,14 +369,36 @@ class FormulaProvider:
         max_value_override: int = None,
         mid_value_override: int = None,
     ):
+        cells, style = self.gradient(
+            rg, from_color, to_color, mid_color, min_value_override, max_value_override, mid_value_override
+        )
+        for index, (row, column) in enumerate(cells):
+            self.doc.styles.setdefault(row, {})[column] = style(index)
+
+    def gradient(
+        self,
+        rg: Range,
+        from_color: ColorTuple,
+        to_color: ColorTuple,
+        mid_color: ColorTuple = None,
+        min_value_override: int = None,
+        max_value_override: int = None,
+        mid_value_override: int = None,
+    ) -> tuple[list[tuple[str, str]], Callable[[int], str]]:
+        """
+        The (row, column) cells of the range and the style of the cell with a given index, which is
+        a reference to the nearest color of the gradient, added to the palette only when asked for.
+        """
         if rg[0] not in ("column", "row"):
             raise ValueError("Invalid range: first argument has to be 'column' or 'row'")
 
         if rg[0] == "column":
             problem_index = self.doc.conduit.problem_names.index(rg[1])
             values = [self.doc.conduit.content[user][problem_index] for user in self.doc.conduit.content]
+            cells = [(user, rg[1]) for user in self.doc.conduit.content]
         else:
             values = self.doc.conduit.content[rg[1]]
+            cells = [(rg[1], problem) for problem in self.doc.conduit.problem_names]
 
         values_ints = []
         for i in values:
@@ -144,97 +411,621 @@ class FormulaProvider:
         max_value = max(values_ints) if max_value_override is None else max_value_override
         mid_value = (min_value + max_value) // 2 if mid_value_override is None else mid_value_override
 
+        colors = (tuple(from_color), tuple(to_color), None if mid_color is None else tuple(mid_color))
+        number = self.gradients.setdefault(colors, len(self.gradients))
+        palette = gradient_palette(*colors)
+
+        def reference(level: int) -> str:
+            key = f"{number}.{level}"
+            self.doc.palette[key] = palette[level]
+            return PALETTE_REFERENCE + key
+
         if min_value >= max_value:
-            color_str = f"rgb{from_color}"
-            colors = [color_str for _ in values_ints]
-        else:
-            interpolations = [Color(f"rgb{from_color}"), Color(f"rgb{to_color}")]
-            if mid_color is not None:
-                interpolations.insert(1, Color(f"rgb{mid_color}"))
-            inter = Color.interpolate(interpolations)
-
-            values_recalc = []
-            for i in values_ints:
-                if i <= min_value:
-                    values_recalc.append(0)
-                elif i >= max_value:
-                    values_recalc.append(1)
-                elif i <= mid_value:
-                    values_recalc.append(1 / 2 * (i - min_value) / (mid_value - min_value))
-                else:
-                    values_recalc.append(1 / 2 * (i - mid_value) / (max_value - mid_value) + 1 / 2)
-
-            colors = [inter(i).to_string() for i in values_recalc]
+            return cells, lambda index: reference(0)
 
-        if rg[0] == "column":
-            for user, color in zip(self.doc.conduit.content, colors):
-                self.doc.styles.setdefault(user, {})[rg[1]] = f"background-color: {color}"
-        else:
-            for problem, color in zip(self.doc.conduit.problem_names, colors):
-                self.doc.styles.setdefault(rg[1], {})[problem] = f"background-color: {color}"
+        def style(index: int) -> str:
+            i = values_ints[index]
+            if i <= min_value:
+                position = 0
+            elif i >= max_value:
+                position = 1
+            elif i <= mid_value:
+                position = 1 / 2 * (i - min_value) / (mid_value - min_value)
+            else:
+                position = 1 / 2 * (i - mid_value) / (max_value - mid_value) + 1 / 2
+            return reference(round(position * (GRADIENT_LEVELS - 1)))
+
+        return cells, style
+
+
+class StaleResult(Exception):
+    pass
+
+
+class IncrementalFormulaProvider(FormulaProvider):
+    """
+    Runs formulas again after a few cells have changed, reusing the result of the previous run.
+    A new column reads its row, a new row reads its column and a formatter reads its cell, so the callbacks
+    are only called where what they read is dirty, and a new cell which comes out different makes its row and
+    column dirty. Formatters are applied at the end, only to the cells in both a dirty row and a dirty column
+    and to the rows and columns of recomputed gradients. If the rows and columns turn out different from
+    the previous run, `stale` is set and the formulas have to be run in full.
+    """
+
+    def __init__(self, doc: ConduitContent, previous: dict, changed: list[tuple[str, str]]):
+        super().__init__(doc)
+        self.previous = previous
+        self.previous_content = previous["conduit"]["content"]
+        self.previous_columns = {name: index for index, name in enumerate(previous["conduit"]["problem_names"])}
+        self.dirty_rows = {row for row, _ in changed}
+        self.dirty_columns = {column for _, column in changed}
+        # Cell formatters with the rows and columns there were, gradients with the positions of their cells
+        self.formatters: list[tuple[FormatterCallback, set[str], set[str]] | tuple[None, dict, Callable]] = []
+        self.restyled: set[tuple[str, str]] = set()
+        self.stale = False
+
+    def previous_value(self, row_id: str, column: str) -> str:
+        try:
+            return self.previous_content[row_id][self.previous_columns[column]]
+        except (KeyError, IndexError):
+            self.stale = True
+            raise StaleResult(f"Cell ({row_id}, {column}) is not in the previous result")
+
+    def add_column(self, position: Position, name: str, callback: ConduitCallback, is_limited: bool = False):
+        insert_into(self.doc.conduit.problem_names, name, position)
+        changed = False
+        for user, row in self.doc.conduit.content.items():
+            if user in self.dirty_rows:
+                value = str(callback(position, user, self.usernames.get(user, user), list(row)))
+                changed = changed or value != self.previous_value(user, name)
+            else:
+                value = self.previous_value(user, name)
+            insert_into(row, value, position)
+
+        if changed:
+            self.dirty_columns.add(name)
+        if is_limited:
+            self.limited_columns.append(name)
+
+    def add_row(
+        self, position: Position, row_id: str, row_name: str, callback: ConduitCallback, is_limited: bool = False
+    ):
+        row_id = f"_{row_id}"
+        insert_into(self.doc.users, UserUnprivileged(login=row_id, name=row_name), position)
+        self.usernames[row_id] = row_name
+        values = []
+        changed = False
+        for index, problem in enumerate(self.doc.conduit.problem_names):
+            if problem in self.dirty_columns:
+                column = [self.doc.conduit.content[x][index] for x in self.doc.conduit.content]
+                value = str(callback(position, index, problem, column))
+                changed = changed or value != self.previous_value(row_id, problem)
+            else:
+                value = self.previous_value(row_id, problem)
+            values.append(value)
+        self.doc.conduit.content[row_id] = values
 
+        if changed:
+            self.dirty_rows.add(row_id)
+        if is_limited:
+            self.limited_rows.append(row_id)
 
-def run_formula(aev: Interpreter, formula: str, return_dict: dict[str, str]):
-    aev(formula)
-    document = aev.symtable["provider"].doc
-    document.limited_rows = aev.symtable["provider"].limited_rows
-    document.limited_columns = aev.symtable["provider"].limited_columns
-    return_dict["value"] = document.dict()
+    def add_column_values(self, position: Position, name: str, values: list, is_limited: bool = False):
+        super().add_column_values(position, name, values, is_limited)
+        # Computed from any cells, so every value is compared
+        changed = [
+            row for row, value in zip(self.doc.conduit.content, values) if str(value) != self.previous_value(row, name)
+        ]
+        if changed:
+            self.dirty_rows.update(changed)
+            self.dirty_columns.add(name)
 
+    def add_row_values(self, position: Position, row_id: str, row_name: str, values: list, is_limited: bool = False):
+        super().add_row_values(position, row_id, row_name, values, is_limited)
+        row_id = f"_{row_id}"
+        changed = [
+            column
+            for column, value in zip(self.doc.conduit.problem_names, values)
+            if str(value) != self.previous_value(row_id, column)
+        ]
+        if changed:
+            self.dirty_columns.update(changed)
+            self.dirty_rows.add(row_id)
 
-class Interstream:
-    def __init__(self):
-        self.__data = multiprocessing.Queue()
+    def add_mask_formatter(self, mask: CellMask, style: str):
+        # The cells which left the mask are among those which had its style
+        cells = mask.cells()
+        self.restyled.update(cells)
+        for row, styles in self.previous["styles"].items():
+            self.restyled.update((row, column) for column, value in styles.items() if value == style)
+        self.formatters.append((None, dict.fromkeys(cells, 0), lambda index: style))
 
-    def write(self, data):
-        self.__data.put(data)
+    def add_formatter(self, callback: FormatterCallback):
+        self.formatters.append((callback, set(self.doc.conduit.content), set(self.doc.conduit.problem_names)))
 
-    def flush(self):
+    def add_row_formatter(self, callback: BorderFormatterCallback):
+        # Row and column styles only depend on the id, they are kept from the previous run
         pass
 
-    def get(self):
-        answer = read_queue(self.__data)
-        return "".join(answer)
+    def add_column_formatter(self, callback: BorderFormatterCallback):
+        pass
+
+    def add_gradient_formatter(self, rg: Range, *args, **kwargs):
+        cells, style = self.gradient(rg, *args, **kwargs)
+        if rg[1] in (self.dirty_columns if rg[0] == "column" else self.dirty_rows):
+            self.restyled.update(cells)
+        self.formatters.append((None, {cell: index for index, cell in enumerate(cells)}, style))
+
+    def finish(self):
+        content = self.doc.conduit.content
+        names = self.doc.conduit.problem_names
+        if (
+            self.stale
+            or list(content) != list(self.previous_content)
+            or names != self.previous["conduit"]["problem_names"]
+        ):
+            self.stale = True
+            return
+
+        self.doc.styles = {row: dict(styles) for row, styles in self.previous["styles"].items()}
+        self.doc.palette = {}
+        self.doc.row_styles = dict(self.previous["row_styles"])
+        self.doc.column_styles = dict(self.previous["column_styles"])
+
+        # In the order a full run styles them, by column and then by row
+        columns = {name: index for index, name in enumerate(names)}
+        rows = {row: index for index, row in enumerate(content)}
+        cells = {
+            (row, column) for row in self.dirty_rows & rows.keys() for column in self.dirty_columns & columns.keys()
+        }
+        cells = sorted(cells | self.restyled, key=lambda cell: (columns[cell[1]], rows[cell[0]]))
+        for row, column in cells:
+            self.doc.styles.get(row, {}).pop(column, None)
+
+        for callback, *formatted in self.formatters:
+            for row, column in cells:
+                style = None
+                if callback is None:
+                    positions, gradient = formatted
+                    if (row, column) in positions:
+                        style = gradient(positions[row, column])
+                elif row in formatted[0] and column in formatted[1]:
+                    style = callback(row, column, content[row][columns[column]])
+                if style is not None:
+                    self.doc.styles.setdefault(row, {})[column] = style
+        self.doc.styles = {row: styles for row, styles in self.doc.styles.items() if styles}
+
+        # The gradients are numbered the same as long as the formula adds them the same way
+        previous_palette = self.previous.get("palette", {})
+        if any(previous_palette.get(key, style) != style for key, style in self.doc.palette.items()):
+            self.stale = True
+            return
+        self.doc.palette = previous_palette | self.doc.palette
+        super().finish()
+
+
+class FormulaTimeout(Exception):
+    pass
+
+
+class FormulaProfiler:
+    """
+    Measures a formula run statement by statement: the time of every top-level statement, and the time,
+    the number of calls and the number of callbacks of the provider methods by method and statement.
+    The methods call back into the formula, so their time includes the time of the callbacks.
+    """
+
+    def __init__(self, fp: FormulaProvider, time_limit: float):
+        self.time_limit = time_limit
+        self.statements: list[dict] = []
+        self.calls: dict[tuple[str, int], dict] = {}
+        self.line = 0
+        self.timed_out = False
+        for name in ProviderInterface:
+            if name.startswith("add_") or name == "scores":
+                setattr(fp, name, self.timed(name, getattr(fp, name)))
+
+    def timed(self, name: str, method: Callable) -> Callable:
+        def call(*args, **kwargs):
+            key = (name, self.line)
+            if key not in self.calls:
+                self.calls[key] = dict(method=name, line=self.line, calls=0, callbacks=0, ms=0.0)
+            entry = self.calls[key]
+            args = [self.counted(arg, entry) if callable(arg) else arg for arg in args]
+            kwargs = {keyword: self.counted(arg, entry) if callable(arg) else arg for keyword, arg in kwargs.items()}
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                entry["calls"] += 1
+                entry["ms"] += (time.perf_counter() - start) * 1000
+
+        return call
+
+    @staticmethod
+    def counted(callback: Callable, entry: dict) -> Callable:
+        def call(*args, **kwargs):
+            entry["callbacks"] += 1
+            return callback(*args, **kwargs)
+
+        return call
+
+    def interrupt(self, signum, frame):
+        self.timed_out = True
+        raise FormulaTimeout(f"Formula execution stopped after {self.time_limit:g} s")
+
+    def run(self, aev: Interpreter, tree: ast.Module, formula: str):
+        """
+        What aev.run(tree) does, one statement at a time. Only works in the main thread, which is
+        interrupted after `time_limit` seconds by SIGALRM. The formula may catch the timeout, so after it
+        every node the interpreter evaluates raises it again.
+        """
+        evaluate = aev.run
+
+        def checked(node, *args, **kwargs):
+            if self.timed_out:
+                raise FormulaTimeout(f"Formula execution stopped after {self.time_limit:g} s")
+            return evaluate(node, *args, **kwargs)
+
+        aev.run = checked
+        lines = formula.splitlines()
+        handler = signal.signal(signal.SIGALRM, self.interrupt)
+        signal.setitimer(signal.ITIMER_REAL, self.time_limit)
+        try:
+            for node in tree.body:
+                self.line = node.lineno
+                start = time.perf_counter()
+                try:
+                    aev.run(node, expr=formula)
+                finally:
+                    milliseconds = (time.perf_counter() - start) * 1000
+                    self.statements.append(dict(line=node.lineno, text=lines[node.lineno - 1].strip(), ms=milliseconds))
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, handler)
+
+    def report(self, seconds: float, peak_memory: int) -> dict:
+        calls = sorted(self.calls.values(), key=lambda call: call["ms"], reverse=True)
+        return {
+            "ms": round(seconds * 1000, 1),
+            "timed_out": self.timed_out,
+            "peak_memory": peak_memory,
+            "callbacks": sum(call["callbacks"] for call in calls),
+            "statements": [dict(statement, ms=round(statement["ms"], 1)) for statement in self.statements],
+            "calls": [dict(call, ms=round(call["ms"], 1)) for call in calls],
+        }
+
+
+def compile_formula(formula: str) -> ast.Module:
+    """
+    Parse a formula, the last few trees are kept by the hash of their text. Raises SyntaxError.
+    """
+    digest = hashlib.blake2b(formula.encode(), digest_size=16).digest()
+    if digest in compiled_formulas:
+        compiled_formulas.move_to_end(digest)
+        return compiled_formulas[digest]
+
+    tree = compiled_formulas[digest] = ast.parse(formula)
+    while len(compiled_formulas) > COMPILED_FORMULAS:
+        compiled_formulas.popitem(last=False)
+    return tree
+
+
+def check_formula(formula: str) -> None | str:
+    """
+    Return why the sandbox would refuse to run a formula, or None if it would run it.
+    """
+    try:
+        tree = ast.parse(formula)
+    except SyntaxError as e:
+        return f"SyntaxError: {e.msg} (line {e.lineno})"
+
+    aev = Interpreter(**SandboxOptions)
+    for node in ast.walk(tree):
+        if not isinstance(node, (ast.stmt, ast.expr)):
+            continue
+        name = type(node).__name__.lower()
+        if aev.node_handlers.get(name, aev.unimplemented) == aev.unimplemented:
+            return f"'{type(node).__name__}' is not supported (line {node.lineno})"
+    return None
+
+
+@lru_cache(maxsize=1)
+def sandbox_symbols() -> frozenset[str]:
+    """
+    The names every formula has besides its own: the builtins of the sandbox and the provider symbols.
+    """
+    return frozenset(Interpreter(**SandboxOptions).symtable) | {"provider", "is_solved", "is_real", "sheet_id"}
+
 
+def reads_only_arguments(tree: ast.Module) -> bool:
+    """
+    Whether the callbacks of a formula only see what they are given, so that a new cell only depends on
+    what its callback is called with. Every function may only read its arguments, its own variables,
+    the sandbox symbols and the functions defined once at the top level, which rules out state shared
+    between the calls, such as a dictionary of totals filled by one column and read by the next.
+    The defaults have to be constants, the provider is only used through the ProviderInterface methods
+    and the cells are not read all at once through scores().
+    """
+    names = [node for node in ast.walk(tree) if isinstance(node, ast.Name) and node.id == "provider"]
+    attributes = [
+        node
+        for node in ast.walk(tree)
+        if isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name) and node.value.id == "provider"
+    ]
+    if len(names) != len(attributes) or any(node.attr not in ProviderInterface for node in attributes):
+        return False
+    if any(isinstance(node, ast.Attribute) and node.attr == "scores" for node in ast.walk(tree)):
+        return False
 
-def execute_formula(doc: ConduitContent, formula: str) -> tuple[dict, str]:
-    fp = FormulaProvider(doc)
-    stream = Interstream()
+    # The top-level statements outside of the functions, and the functions which are not inside another one
+    functions, statements = [], list(tree.body)
+    while statements:
+        statement = statements.pop()
+        if isinstance(statement, ast.FunctionDef):
+            functions.append(statement)
+        else:
+            statements.extend(node for node in ast.iter_child_nodes(statement) if isinstance(node, ast.stmt))
+    bound = [node.id for node in ast.walk(tree) if isinstance(node, ast.Name) and not isinstance(node.ctx, ast.Load)]
+    bound += [node.name for node in ast.walk(tree) if isinstance(node, ast.FunctionDef)]
+    defined_once = {function.name for function in functions if bound.count(function.name) == 1}
+
+    for function in functions:
+        nodes = list(ast.walk(function))
+        if any(isinstance(node, (ast.Global, ast.Nonlocal)) for node in nodes):
+            return False
+        local = {node.id for node in nodes if isinstance(node, ast.Name) and not isinstance(node.ctx, ast.Load)}
+        for node in nodes:
+            if isinstance(node, ast.FunctionDef):
+                local.add(node.name)
+            elif isinstance(node, ast.arg):
+                local.add(node.arg)
+            elif isinstance(node, ast.ExceptHandler) and node.name:
+                local.add(node.name)
+            elif isinstance(node, ast.arguments):
+                if not all(
+                    isinstance(default, ast.Constant) for default in node.defaults + node.kw_defaults if default
+                ):
+                    return False
+        loaded = {node.id for node in nodes if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Load)}
+        if not loaded <= local | defined_once | sandbox_symbols():
+            return False
+    return True
+
+
+def run_formula(
+    doc: dict, formula: str, previous: None | dict = None, changed: list[tuple[str, str]] = ()
+) -> tuple[dict, str]:
+    """
+    Given the result of the same formula over a document which only differed in the `changed` cells,
+    the callbacks are only called for the cells which may depend on them.
+    """
+    if previous is not None and reads_only_arguments(compile_formula(formula)):
+        fp = IncrementalFormulaProvider(ConduitContent.parse_obj(doc), previous, changed)
+        result = interpret(fp, formula)
+        if not fp.stale:
+            return result
+    return interpret(FormulaProvider(ConduitContent.parse_obj(doc)), formula)
+
+
+def run_profiled(doc: dict, formula: str, time_limit: float) -> tuple[dict, str, dict]:
+    """
+    Run a formula in full with a FormulaProfiler, also returns its report with the peak memory the run took.
+    """
+    fp = FormulaProvider(ConduitContent.parse_obj(doc))
+    profiler = FormulaProfiler(fp, time_limit)
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        result, output = interpret(fp, formula, profiler)
+        peak_memory = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return result, output, profiler.report(time.perf_counter() - start, peak_memory)
+
+
+def interpret(fp: FormulaProvider, formula: str, profiler: None | FormulaProfiler = None) -> tuple[dict, str]:
+    stream = io.StringIO()
     aev = Interpreter(
-        usersyms={"provider": fp, "is_solved": fp.is_solved, "is_real": fp.is_real, "sheet_id": doc.id},
-        builtins_readonly=True,
+        usersyms={"provider": fp, "is_solved": fp.is_solved, "is_real": fp.is_real, "sheet_id": fp.doc.id},
         writer=stream,
         err_writer=stream,
-        no_assert=True,
-        no_delete=True,
-        no_raise=True,
-        no_print=True,
+        **SandboxOptions,
     )
+    # What aev(formula) does, with a tree that is parsed once per worker
+    try:
+        if profiler is None:
+            aev.run(compile_formula(formula), expr=formula)
+        else:
+            profiler.run(aev, compile_formula(formula), formula)
+    except Exception:
+        print("\n".join(aev.error[0].get_error()) if aev.error else sys.exc_info()[1], file=stream)
+    fp.finish()
+    return fp.doc.dict(), stream.getvalue()
+
+
+def address_space() -> int:
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[0]) * resource.getpagesize()
+    except OSError:
+        return 0
+
+
+def formula_worker(connection, memory_limit: int, cpu_limit: int):
+    """
+    Runs in a process of its own: limits itself, then answers run_formula requests, or run_profiled ones
+    if they have a time limit, until the pipe closes. Requests and replies are marshalled,
+    so nothing but plain data crosses the pipe.
+    """
+    for limit, value in (
+        (resource.RLIMIT_AS, address_space() + memory_limit),
+        (resource.RLIMIT_CPU, math.ceil(time.process_time()) + cpu_limit),
+    ):
+        hard = resource.getrlimit(limit)[1]
+        resource.setrlimit(limit, (value if hard == resource.RLIM_INFINITY else min(value, hard), hard))
+    connection.send_bytes(b"")
+
+    while True:
+        try:
+            doc, formula, previous, changed, profile = marshal.loads(connection.recv_bytes())
+        except EOFError:
+            return
+        try:
+            if profile is None:
+                reply = run_formula(doc, formula, previous, changed)
+            else:
+                reply = run_profiled(doc, formula, profile)
+        except Exception as e:
+            reply = ({}, f"{type(e).__name__}: {e}") + (() if profile is None else (None,))
+        connection.send_bytes(marshal.dumps(reply))
+
+
+class FormulaWorker:
+    def __init__(self, context, memory_limit: int, cpu_limit: int):
+        self.connection, child = context.Pipe()
+        self.process = context.Process(
+            target=formula_worker, args=(child, memory_limit, cpu_limit), name="formula-worker", daemon=True
+        )
+        self.process.start()
+        child.close()
+        self.tasks = 0
+        if not self.connection.poll(START_TIMEOUT):
+            self.stop()
+            raise RuntimeError("Formula worker did not start")
+        try:
+            self.connection.recv_bytes()
+        except EOFError:
+            self.stop()
+            raise RuntimeError("Formula worker did not start")
+
+    def run(
+        self,
+        doc: dict,
+        formula: str,
+        previous: None | dict,
+        changed: list[tuple[str, str]],
+        timeout: float,
+        profile: None | float = None,
+    ) -> tuple:
+        """
+        Raises RuntimeError if the worker is gone, crashed or timed out, the worker cannot be used after that.
+        """
+        self.tasks += 1
+        try:
+            self.connection.send_bytes(marshal.dumps((doc, formula, previous, changed, profile)))
+        except OSError:
+            raise RuntimeError("Formula worker is not running")
+        if not self.connection.poll(timeout):
+            raise RuntimeError("Formula execution timed out")
+        try:
+            return marshal.loads(self.connection.recv_bytes())
+        except (EOFError, OSError):
+            raise RuntimeError("Formula execution crashed")
+
+    def stop(self):
+        self.process.kill()
+        self.process.join()
+        self.connection.close()
+
+
+class FormulaPool:
+    """
+    Warm workers forked from a forkserver which only imports this module, so that starting one is cheap
+    and none of them shares memory with the website. Up to `size` formulas run at once, a worker
+    is replaced after it crashes, times out or has run `tasks_per_worker` formulas.
+    """
+
+    def __init__(self, size: int, memory_limit: int, timeout: float, tasks_per_worker: int):
+        self.size = size
+        self.memory_limit = memory_limit
+        self.timeout = timeout
+        self.tasks_per_worker = tasks_per_worker
+        # A worker never runs a formula longer than the timeout, so this is only reached by a runaway worker
+        self.cpu_limit = math.ceil(timeout * tasks_per_worker) + 1
+        self.context = None
+        self.idle: list[FormulaWorker] = []
+        self.slots = threading.BoundedSemaphore(size)
+        self.lock = threading.Lock()
+
+    def spawn(self) -> FormulaWorker:
+        with self.lock:
+            if self.context is None:
+                self.context = multiprocessing.get_context("forkserver")
+                self.context.set_forkserver_preload([__name__])
+        return FormulaWorker(self.context, self.memory_limit, self.cpu_limit)
+
+    def start(self):
+        """
+        Start the workers ahead of the first formula.
+        """
+        workers = [self.spawn() for _ in range(self.size - len(self.idle))]
+        with self.lock:
+            self.idle += workers
+
+    def execute(
+        self,
+        doc: ConduitContent,
+        formula: str,
+        previous: None | dict = None,
+        changed: list[tuple[str, str]] = (),
+        profile: None | float = None,
+    ) -> tuple:
+        """
+        Run a formula in a worker, see run_formula. If `profile` is a time limit, see run_profiled instead.
+        """
+        # A profiled formula stops itself, the worker has the time of a formula to finish and reply
+        timeout = self.timeout if profile is None else max(self.timeout, profile + TIME_LIMIT)
+        with self.slots:
+            with self.lock:
+                worker = self.idle.pop() if self.idle else None
+            if worker is not None and not worker.process.is_alive():
+                # Killed while it was idle, for example by the OOM killer
+                worker.stop()
+                worker = None
+            if worker is None:
+                worker = self.spawn()
 
-    with formula_lock:
-        with multiprocessing.Manager() as mgr:
-            # cannot safely do it because ASGI crashes
-            current_limits = resource.getrlimit(resource.RLIMIT_AS)
-            limit_value = min(current_limits[0], MEMORY_LIMIT) if current_limits[0] != -1 else MEMORY_LIMIT
-            data = mgr.dict()
-            proc = multiprocessing.Process(target=run_formula, args=(aev, formula, data))
             try:
-                resource.setrlimit(resource.RLIMIT_AS, (limit_value, current_limits[1]))
-                proc.start()
-                proc.join(0.5)
-
-                answer = stream.get()
-                result_value = data.get("value", {})
-
-                if proc.exitcode:
-                    proc.terminate()
-                    raise RuntimeError("Formula execution crashed")
-                if proc.is_alive():
-                    proc.terminate()
-                    proc.join()
-                    raise RuntimeError("Formula execution timed out")
-            finally:
-                proc.terminate()
-                resource.setrlimit(resource.RLIMIT_AS, current_limits)
+                result = worker.run(doc.dict(), formula, previous, list(changed), timeout, profile)
+            except BaseException:
+                worker.stop()
+                raise
+
+            if worker.tasks >= self.tasks_per_worker:
+                worker.stop()
+            else:
+                with self.lock:
+                    self.idle.append(worker)
+            return result
+
+    def close(self):
+        with self.lock:
+            workers, self.idle = self.idle, []
+        for worker in workers:
+            worker.stop()
+
+
+formula_pool = FormulaPool(
+    cfg.get("workers", os.cpu_count() or 1), MEMORY_LIMIT, TIME_LIMIT, cfg.get("tasks-per-worker", 200)
+)
+# Profiled formulas run for much longer, so they have workers of their own and do not hold up the others
+profile_pool = FormulaPool(
+    cfg.get("profile-workers", 1), MEMORY_LIMIT, PROFILE_TIME_LIMIT + TIME_LIMIT, cfg.get("tasks-per-worker", 200)
+)
+
+
+def execute_formula(
+    doc: ConduitContent, formula: str, previous: None | dict = None, changed: list[tuple[str, str]] = ()
+) -> tuple[dict, str]:
+    """
+    Run a formula in the pool, see run_formula for `previous` and `changed`.
+    """
+    return formula_pool.execute(doc, formula, previous, changed)
+
 
-    return result_value, answer
+def profile_formula(doc: ConduitContent, formula: str) -> tuple[dict, str, None | dict]:
+    """
+    Run a formula in the profiling pool with a FormulaProfiler, see run_profiled.
+    """
+    return profile_pool.execute(doc, formula, profile=PROFILE_TIME_LIMIT)
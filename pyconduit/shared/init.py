@@ -1,10 +1,30 @@
-from pyconduit.shared.datastore import datastore_manager
+from pyconduit.shared.datastore import datastore_manager, datastore_tenant, datastore_tenants, summarize_shards
+
+
+def sheet_summary(sheet: dict) -> dict:
+    """
+    What the sheet lists show of a sheet.
+    """
+    return {"name": sheet.get("latex", {}).get("sheet_name", ""), "has_conduit": "conduit" in sheet}
+
+
+summarize_shards("sheets", "sheets", sheet_summary)
 
 
 def init_databases():
+    for tenant in [None, *datastore_tenants]:
+        token = datastore_tenant.set(tenant)
+        try:
+            init_tenant()
+        finally:
+            datastore_tenant.reset(token)
+
+
+def init_tenant():
     with datastore_manager.get("sheets").operation() as ds:
         ds.get("sheets", {})
         ds.get("formulas", "")
+        ds.get("archived", {})
 
     with datastore_manager.get("accounts").operation() as ds:
         ds.get("accounts", {})
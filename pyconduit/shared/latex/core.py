@@ -14,7 +14,7 @@ first_problem_character = cfg["iterators"]["first-letter"]
 problem_skips = cfg["iterators"]["letter-skips"]
 problem_skip_indices = [ord(c) - ord(first_problem_character) - 1 for c in problem_skips]
 priority_cap = 10000
-image_datastore = datastore_manager.get("images")
+image_datastore = datastore_manager.scoped("images")
 
 
 class MetadataNode:
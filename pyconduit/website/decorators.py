@@ -1,4 +1,5 @@
 import functools
+import hashlib
 import json
 from datetime import datetime, timedelta
 
@@ -7,11 +8,12 @@ from fastapi import Depends, HTTPException
 from fastapi.security import OAuth2PasswordBearer
 from jose import jwt
 from starlette.requests import Request
+from starlette.responses import Response
 from starlette.templating import Jinja2Templates
 from starlette.websockets import WebSocket, WebSocketDisconnect
 
 from pyconduit.models.user import User
-from pyconduit.shared.datastore import datastore_manager, deatomize
+from pyconduit.shared.datastore import datastore_manager, datastore_tenant, deatomize
 from pyconduit.shared.helpers import get_config
 
 templates = Jinja2Templates(directory="templates")
@@ -27,7 +29,7 @@ def get_flashed_messages(request: Request) -> None | dict:
 
 templates.env.globals["get_flashed_messages"] = get_flashed_messages
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token", auto_error=False)
-user_datastore = datastore_manager.get("accounts")
+user_datastore = datastore_manager.scoped("accounts")
 locale = get_config("localization")
 
 
@@ -59,6 +61,9 @@ async def get_user_by_token(token: str) -> None | User:
     subject: str = payload.get("sub")
     if not subject:
         return None
+    # Accounts of different courses may share a login, a token is only valid in its own course
+    if payload.get("tenant") != datastore_tenant.get():
+        return None
 
     username_pair = subject.split(":")
     if len(username_pair) != 2 or username_pair[0] != "user":
@@ -101,12 +106,31 @@ class RequireScope:
 
 def create_access_token(data: dict, expire: timedelta = timedelta(hours=192)) -> str:
     to_encode = data.copy()
+    if datastore_tenant.get() is not None:
+        to_encode["tenant"] = datastore_tenant.get()
     expire_time = datetime.utcnow() + expire
     to_encode.update({"exp": expire_time})
     encoded_jwt = jwt.encode(to_encode, get_config("secrets")["jwt_salt"], algorithm="HS256")
     return encoded_jwt
 
 
+def make_etag(*parts) -> str:
+    """
+    A strong ETag for a response built from the given parts, usually datastore fingerprints.
+    """
+    return '"%s"' % hashlib.blake2b("\0".join(map(str, parts)).encode(), digest_size=16).hexdigest()
+
+
+def not_modified(request: Request, etag: str) -> None | Response:
+    """
+    Return a 304 response if the client already has the version with this ETag.
+    """
+    tags = {tag.strip() for tag in request.headers.get("If-None-Match", "").split(",")}
+    if etag in tags or "*" in tags:
+        return Response(status_code=304, headers={"ETag": etag})
+    return None
+
+
 async def make_template_data(request: Request, user: None | User = None, **kwargs) -> dict:
     def check_scope(scope: str):
         if user is None:
@@ -148,21 +172,23 @@ class SocketHandle:
 
 class SocketManager:
     def __init__(self):
-        self.active_connections: set[WebSocket] = set()
+        # The tenant of every connection, broadcasts only reach the connections of the current one
+        self.active_connections: dict[WebSocket, None | str] = {}
         self.allocated = 0
 
     async def connect(self, websocket: WebSocket) -> SocketHandle:
         await websocket.accept()
-        self.active_connections.add(websocket)
+        self.active_connections[websocket] = datastore_tenant.get()
         self.allocated += 1
         return SocketHandle(self, websocket, self.allocated)
 
     def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
+        del self.active_connections[websocket]
 
     async def __broadcast(self, message: str, exclusions: set[WebSocket] = None):
-        for connection in self.active_connections:
-            if not exclusions or connection not in exclusions:
+        tenant = datastore_tenant.get()
+        for connection, connection_tenant in list(self.active_connections.items()):
+            if connection_tenant == tenant and (not exclusions or connection not in exclusions):
                 await connection.send_text(message)
 
     @functools.singledispatchmethod
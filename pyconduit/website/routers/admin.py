@@ -1,18 +1,20 @@
-from http import HTTPStatus
+import json
 import os
+from http import HTTPStatus
 
-from fastapi import Body, Depends, FastAPI, HTTPException
+from fastapi import Body, Depends, FastAPI, HTTPException, Query
 from starlette.requests import Request
-from starlette.responses import HTMLResponse, PlainTextResponse
+from starlette.responses import HTMLResponse, PlainTextResponse, StreamingResponse
 
 from pyconduit.models.user import BulkRegister, Privileges, User, UserSensitive
-from pyconduit.shared.datastore import datastore_manager, deatomize
+from pyconduit.shared.account_index import account_index
+from pyconduit.shared.datastore import datastore_manager
 from pyconduit.shared.helpers import get_config, partition, transform_to_login
 from pyconduit.website.decorators import RequireScope, get_current_user, make_template_data, require_login, templates
 from pyconduit.website.routers.login import default_hash
 
 admin_app = FastAPI(dependencies=[Depends(RequireScope("admin"))])
-accounts = datastore_manager.get("accounts")
+accounts = datastore_manager.scoped("accounts")
 locale = get_config("localization")
 
 
@@ -34,8 +36,7 @@ async def admin_page(request: Request, user: User = Depends(get_current_user)):
 
 @admin_app.get("/users")
 async def get_users():
-    all_users = accounts.accounts
-    user_list = [UserSensitive.parse_obj(deatomize(user)) for user in all_users.values()]
+    user_list = account_index.all()
     admins, teachers, students, misc = partition(user_list, 3, get_key)
     users = [
         {"name": locale["user_category"]["admin"], "users": admins},
@@ -46,9 +47,30 @@ async def get_users():
     return {"partition": users}
 
 
+@admin_app.get("/datastore-stats")
+async def datastore_stats(memory: bool = Query(False)):
+    return datastore_manager.stats(memory)
+
+
+@admin_app.get("/datastore-feed/{category}")
+async def datastore_feed(category: str, path: list[str] = Query([])):
+    """
+    Server-sent events with the changes of a datastore below `path`, for example ?path=sheets&path=<sheet id>.
+    """
+    datastore = datastore_manager.datastores.get(datastore_manager.qualify(category))
+    if datastore is None:
+        raise HTTPException(status_code=404, detail="Datastore not found")
+
+    async def events():
+        async for op, changed in datastore.changes(tuple(path)):
+            yield f"data: {json.dumps({'op': op, 'path': changed})}\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
 @admin_app.post("/update-user")
 async def update_privileges(user_data: UserSensitive = Body(...)):
-    with accounts.operation():
+    async with accounts.aoperation("accounts", user_data.login):
         all_users = accounts.accounts
         old_data = dict(all_users.get(user_data.login, {}))
         old_data.update(user_data.dict())
@@ -60,7 +82,7 @@ async def update_privileges(user_data: UserSensitive = Body(...)):
 async def delete_user(user: User = Depends(require_login), login: str = Body(...)):
     if login == user.login:
         raise HTTPException(HTTPStatus.BAD_REQUEST, "Нельзя удалить своего пользователя!")
-    with accounts.operation():
+    async with accounts.aoperation("accounts", login):
         all_users = accounts.accounts
         del all_users[login]
     return {"success": True}
@@ -73,7 +95,7 @@ async def reset_password(login: str):
 
     new_password = os.urandom(10).hex()
     password, salt = default_hash(new_password)
-    with accounts.operation():
+    async with accounts.aoperation("accounts", login):
         accounts.accounts[login].password = password
         accounts.accounts[login].salt = salt
     return {"success": True, "password": new_password}
@@ -106,7 +128,7 @@ def create_users(users: BulkRegister = Body(...)):
         return_text.append(f"{user} (login: {login}, password: {password_base})")
         users.append(User(login=login, password=password, salt=salt, name=user, privileges=privilege_doc).dict())
 
-    with accounts.operation():
+    with accounts.operation("accounts"):
         for user in users:
             account_dict[user["login"]] = user
 
@@ -1,22 +1,31 @@
 import logging
 
+import anyio
 from fastapi import Body, Depends, FastAPI, HTTPException
 from pydantic import ValidationError
 from starlette.requests import Request
-from starlette.responses import HTMLResponse
+from starlette.responses import HTMLResponse, Response
 
-from pyconduit.models.bundle import BundleDocument
 from pyconduit.models.conduit import Conduit, ConduitContent
-from pyconduit.models.user import User
-from pyconduit.shared.conduit_postprocessing import calculate_with_formula, get_all_users
+from pyconduit.models.user import User, UserUnprivileged
+from pyconduit.shared.bundle_cache import bundle_cache
+from pyconduit.shared.conduit_postprocessing import (
+    calculate_with_formula,
+    conduit_diff,
+    fill_rows,
+    get_all_users,
+    profile_with_formula,
+)
 from pyconduit.shared.datastore import datastore_manager, deatomize
+from pyconduit.shared.formula_cache import formula_cache
+from pyconduit.shared.formulas import check_formula
 from pyconduit.shared.helpers import get_config
-from pyconduit.website.decorators import RequireScope, make_template_data, templates
+from pyconduit.website.decorators import RequireScope, make_etag, make_template_data, not_modified, templates
 from pyconduit.website.routers.sheets import socket_manager
 
 conduit_app = FastAPI()
-datastore = datastore_manager.get("sheets")
-accounts = datastore_manager.get("accounts")
+datastore = datastore_manager.scoped("sheets")
+accounts = datastore_manager.scoped("accounts")
 locale = get_config("localization")
 logger = logging.getLogger("pyconduit.website.conduit")
 
@@ -27,14 +36,15 @@ async def conduit_editor(request: Request, user: User = Depends(RequireScope("co
     return templates.TemplateResponse("modules/conduit_editor.html", data)
 
 
-# This one is sync because execute_formula can be quite slow if a malicious person puts an infinite loop there
-@conduit_app.get("/content/{file_id}", dependencies=[Depends(RequireScope("conduit_edit"))])
-def get_file(file_id: str) -> ConduitContent:
+def load_conduit(file_id: str) -> tuple[Conduit, str, list[UserUnprivileged]]:
+    """
+    The conduit of a sheet with rows for all users, the name of the sheet and the users, raises HTTPException.
+    """
     if file_id not in datastore.sheets:
         raise HTTPException(status_code=404, detail=locale["exceptions"]["file_not_found"] % dict(filename=file_id))
 
     try:
-        document = BundleDocument.parse_obj(deatomize(datastore.sheets[file_id]))
+        document = bundle_cache.get(file_id)
     except ValidationError:
         logger.exception("Failed to parse document '%s'", file_id)
         raise HTTPException(status_code=500, detail=locale["exceptions"]["file_corrupted"] % dict(filename=file_id))
@@ -43,23 +53,40 @@ def get_file(file_id: str) -> ConduitContent:
         raise HTTPException(status_code=404, detail=locale["exceptions"]["no_conduit"] % dict(filename=file_id))
 
     users = get_all_users(document.conduit)
-    for user in users:
-        if user.login not in document.conduit.content:
-            document.conduit.content[user.login] = ["" for _ in range(len(document.conduit.problem_names))]
-
+    fill_rows(document.conduit, users)
     filename = document.latex.sheet_name if document.latex else file_id
+    return document.conduit, filename, users
+
+
+# This one is sync because execute_formula can be quite slow if a malicious person puts an infinite loop there
+@conduit_app.get("/content/{file_id}", dependencies=[Depends(RequireScope("conduit_edit"))])
+def get_file(file_id: str) -> ConduitContent:
+    conduit, filename, users = load_conduit(file_id)
     formula = datastore.formulas
-    return calculate_with_formula(document.conduit, file_id, filename, users, formula)
+    return calculate_with_formula(conduit, file_id, filename, users, formula)
+
+
+# Sync for the same reason, profiled formulas may run even longer
+@conduit_app.get("/profile/{file_id}", dependencies=[Depends(RequireScope("formula_edit"))])
+def profile_file(file_id: str) -> dict:
+    conduit, filename, users = load_conduit(file_id)
+    return profile_with_formula(conduit, file_id, filename, users, datastore.formulas)
 
 
 @conduit_app.get("/formulas", dependencies=[Depends(RequireScope("formula_edit"))])
-async def get_conduit_formulas() -> str:
+async def get_conduit_formulas(request: Request, response: Response) -> str:
+    etag = make_etag(datastore.fingerprint("formulas"))
+    if (cached := not_modified(request, etag)) is not None:
+        return cached
+    response.headers["ETag"] = etag
     return datastore.formulas
 
 
 @conduit_app.post("/formulas", dependencies=[Depends(RequireScope("formula_edit"))])
 async def set_conduit_formulas(file_content: str = Body(..., embed=True)):
-    with datastore.operation():
+    if (error := check_formula(file_content)) is not None:
+        raise HTTPException(status_code=400, detail=locale["exceptions"]["formula_invalid"] % dict(message=error))
+    async with datastore.aoperation("formulas"):
         datastore.formulas = file_content
 
 
@@ -71,8 +98,10 @@ async def save_file(file_id: str, unsaved_changes: dict = Body(..., embed=True))
     if "conduit" not in datastore.sheets[file_id]:
         raise HTTPException(status_code=404, detail=locale["exceptions"]["no_conduit"] % dict(filename=file_id))
 
+    # The values the edited cells had, to find the result for the conduit before the edit
+    old_values = {}
     try:
-        with datastore.operation():
+        async with datastore.aoperation("sheets", file_id):
             conduit_data = datastore.sheets[file_id].conduit
             for username, problems in unsaved_changes.items():
                 if not problems:
@@ -80,6 +109,7 @@ async def save_file(file_id: str, unsaved_changes: dict = Body(..., embed=True))
 
                 user_row = conduit_data.content.get(username, ["" for _ in conduit_data.problem_names])
                 for problem, value in problems.items():
+                    old_values.setdefault((username, int(problem)), user_row[int(problem)])
                     user_row[int(problem)] = value
     except ValueError:
         logger.exception("Failed to save conduit '%s'", file_id)
@@ -87,38 +117,25 @@ async def save_file(file_id: str, unsaved_changes: dict = Body(..., embed=True))
     else:
         conduit = Conduit.parse_obj(deatomize(conduit_data))
         formula = datastore.formulas
+        filename = datastore.sheets[file_id].latex.sheet_name
         users = get_all_users(conduit)
-        conduit_doc = calculate_with_formula(
-            conduit, file_id, datastore.sheets[file_id].latex.sheet_name, users, formula
+        # Same rows as the editor has, so the result before the edit is the one cached when it was opened
+        fill_rows(conduit, users)
+        before = conduit.copy(deep=True)
+        for (username, problem), value in old_values.items():
+            before.content[username][problem] = value
+
+        # The cache may read from disk and the formula may run for long, neither should block the event loop
+        digest = formula_cache.digest(before, file_id, filename, users, formula)
+        previous = await anyio.to_thread.run_sync(formula_cache.get, digest)
+        changed = [(username, conduit.problem_names[problem]) for username, problem in old_values]
+        conduit_doc = await anyio.to_thread.run_sync(
+            calculate_with_formula, conduit, file_id, filename, users, formula, previous, changed
         )
-
-        # now we need to get any virtual rows/columns
-        real_problem_names = set(conduit.problem_names)
-        virtual_rows = {}
-        real_rows = {}
-        for user_login, row in conduit_doc.conduit.content.items():
-            if user_login.startswith("_"):
-                virtual_rows[user_login] = row
-            else:
-                data = []
-                for problem_name, value in zip(conduit_doc.conduit.problem_names, row):
-                    if problem_name not in real_problem_names:
-                        data.append(value)
-                real_rows[user_login] = data
-
         await socket_manager.broadcast(
-            {
-                "action": "ConduitUpdate",
-                "file_id": file_id,
-                "changes": unsaved_changes,
-                "styles": conduit_doc.styles,
-                "row_styles": conduit_doc.row_styles,
-                "column_styles": conduit_doc.column_styles,
-                "virtual_rows": virtual_rows,
-                "real_rows": real_rows,
-            }
+            {"action": "ConduitUpdate", "file_id": file_id, **conduit_diff(previous, conduit_doc)}
         )
 
-        with datastore.operation():
+        async with datastore.aoperation("sheets", file_id):
             datastore.sheets[file_id].precomputed = conduit_doc.dict()
     return {"success": True}
@@ -14,7 +14,7 @@ from pyconduit.website.decorators import RequireScope, create_access_token, find
 login_app = FastAPI()
 secrets = get_config("secrets")
 locale = get_config("localization")
-datastore = datastore_manager.get("accounts")
+datastore = datastore_manager.scoped("accounts")
 require_admin = RequireScope("admin")
 
 
@@ -77,7 +77,7 @@ async def change_password(user: User = Depends(require_login), password: ChangeP
         raise HTTPException(status_code=401, detail=locale["exceptions"]["invalid_credentials"])
 
     new_password, salt = default_hash(password.new_password)
-    with datastore.operation():
+    async with datastore.aoperation("accounts", user.login):
         accounts = datastore.accounts
         user_acc = accounts.get(user.login, {})
         user_acc.password = new_password
@@ -91,7 +91,7 @@ async def conduit_settings(user: User = Depends(require_login), settings: Condui
     if not hmac.compare_digest(password_hash, user.password):
         raise HTTPException(status_code=401, detail=locale["exceptions"]["invalid_credentials"])
 
-    with datastore.operation():
+    async with datastore.aoperation("accounts", user.login):
         accounts = datastore.accounts
         user_acc = accounts.get(user.login, {})
         if user.privileges.conduit_generation and settings.allow_conduit_view is not None:
@@ -102,7 +102,7 @@ async def conduit_settings(user: User = Depends(require_login), settings: Condui
 
 
 def register(user: RegisterUser):
-    with datastore.operation():
+    with datastore.operation("accounts", user.login):
         accounts = datastore.accounts
         if user.login in accounts:
             raise HTTPException(status_code=400, detail=locale["exceptions"]["account_already_exists"])
@@ -2,19 +2,22 @@ import logging
 import pathlib
 import uuid
 
+import anyio
 from fastapi import Body, Depends, FastAPI, HTTPException, UploadFile
 from pydantic import ValidationError
 from starlette.requests import Request
-from starlette.responses import FileResponse, HTMLResponse, PlainTextResponse
+from starlette.responses import FileResponse, HTMLResponse, PlainTextResponse, Response
 from starlette.websockets import WebSocket, WebSocketDisconnect
 from websockets.exceptions import WebSocketException
 
 from pyconduit.models.bundle import BundleDocument
-from pyconduit.models.latex import LatexRequest
+from pyconduit.models.latex import LatexInclude, LatexRequest
 from pyconduit.models.user import User
+from pyconduit.shared.archive import sheet_archive
+from pyconduit.shared.bundle_cache import bundle_cache
 from pyconduit.shared.conduit_postprocessing import postprocess_limited_conduit
 from pyconduit.shared.conduit_regeneration import regen_strategies
-from pyconduit.shared.datastore import datastore_manager, deatomize
+from pyconduit.shared.datastore import TenantLocal, datastore_manager, deatomize
 from pyconduit.shared.helpers import get_config
 from pyconduit.shared.latex.converter import build_latex, generate_html
 from pyconduit.website.decorators import (
@@ -22,15 +25,17 @@ from pyconduit.website.decorators import (
     SocketManager,
     get_current_user,
     get_user_by_token,
+    make_etag,
     make_template_data,
+    not_modified,
     templates,
 )
 
 sheets_app = FastAPI()
-datastore = datastore_manager.get("sheets")
-images = datastore_manager.get("images")
+datastore = datastore_manager.scoped("sheets")
+images = datastore_manager.scoped("images")
 socket_manager = SocketManager()
-socket_context = {}
+socket_contexts = TenantLocal(dict)
 socket_current_sheet_per_user = {}
 locale = get_config("localization")
 logger = logging.getLogger("pyconduit.website.sheets")
@@ -53,14 +58,19 @@ async def index_page(request: Request, sheet_id: str = "", user: None | User = D
 
 @sheets_app.get("/list")
 async def sheet_list():
-    file_dict = [{"id": key, "name": value["latex"]["sheet_name"]} for key, value in datastore.sheets.items()]
+    file_dict = [{"id": key, "name": summary["name"]} for key, summary in datastore.summaries("sheets").items()]
     return list(reversed(file_dict))
 
 
 @sheets_app.get("/content/{file_id}", response_class=PlainTextResponse)
-async def get_latex_content(file_id: str):
+async def get_latex_content(file_id: str, request: Request, response: Response):
     if file_id not in datastore.sheets:
         raise HTTPException(status_code=404, detail=locale["exceptions"]["file_not_found"] % dict(filename=file_id))
+
+    etag = make_etag(datastore.fingerprint("sheets", file_id, "latex"))
+    if (cached := not_modified(request, etag)) is not None:
+        return cached
+    response.headers["ETag"] = etag
     return datastore.sheets[file_id].latex.orig_doc
 
 
@@ -72,7 +82,7 @@ async def create_file(file_data: LatexRequest = Body(...), user: User = Depends(
         compiled_latex = build_latex(file_data.file_content)
 
         if compiled_latex.sheet_id in datastore.sheets:
-            bundle_data = BundleDocument.parse_obj(deatomize(datastore.sheets[compiled_latex.sheet_id]))
+            bundle_data = bundle_cache.get(compiled_latex.sheet_id)
         else:
             bundle_data = BundleDocument(latex=compiled_latex)
 
@@ -95,6 +105,11 @@ async def create_file(file_data: LatexRequest = Body(...), user: User = Depends(
         logger.exception("Latex semantic error")
         raise HTTPException(status_code=422, detail=locale["exceptions"]["latex_semantic_error"] % dict(message=e))
 
+    if compiled_latex.sheet_id in sheet_archive:
+        raise HTTPException(
+            status_code=409, detail=locale["exceptions"]["file_archived"] % dict(filename=compiled_latex.sheet_id)
+        )
+
     if file_data.expected_sheet and compiled_latex.sheet_id != file_data.expected_sheet:
         raise HTTPException(
             status_code=400,
@@ -102,7 +117,7 @@ async def create_file(file_data: LatexRequest = Body(...), user: User = Depends(
             % dict(expected=file_data.expected_sheet, got=compiled_latex.sheet_id),
         )
 
-    with datastore.operation():
+    async with datastore.aoperation("sheets", compiled_latex.sheet_id):
         bundle = datastore.sheets.get(compiled_latex.sheet_id, {})
         if not bundle:
             await socket_manager.broadcast(
@@ -116,12 +131,19 @@ async def create_file(file_data: LatexRequest = Body(...), user: User = Depends(
 
 
 @sheets_app.get("/file/{file_id}")
-async def read_file(file_id: str, user: User = Depends(get_current_user)):
-    if file_id not in datastore.sheets:
+async def read_file(file_id: str, request: Request, response: Response, user: User = Depends(get_current_user)):
+    archived = file_id not in datastore.sheets
+    if archived and file_id not in sheet_archive:
         raise HTTPException(status_code=404, detail=locale["exceptions"]["file_not_found"] % dict(filename=file_id))
 
     try:
-        bundle_document = BundleDocument.parse_obj(deatomize(datastore.sheets[file_id]))
+        if archived:
+            # Archived sheets are read from the archive without returning to the datastore
+            bundle_document = BundleDocument.parse_obj(await anyio.to_thread.run_sync(sheet_archive.read, file_id))
+        else:
+            bundle_document = bundle_cache.get(file_id, copy=False)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=locale["exceptions"]["file_not_found"] % dict(filename=file_id))
     except ValidationError as e:
         logger.error("Invalid bundle document: %s", e)
         raise HTTPException(status_code=500, detail=locale["exceptions"]["latex_invariant_error"])
@@ -129,6 +151,20 @@ async def read_file(file_id: str, user: User = Depends(get_current_user)):
     if bundle_document.latex is None:
         raise HTTPException(status_code=404, detail=locale["exceptions"]["no_latex_sheet"] % dict(filename=file_id))
 
+    # The html also renders the included sheets and the solved problems depend on the user, so the tag does too
+    includes = sorted({obj.path for obj in bundle_document.latex.objects if isinstance(obj, LatexInclude)})
+    etag = make_etag(
+        *(datastore.fingerprint("sheets", file_id, part) for part in ("latex", "conduit", "precomputed")),
+        datastore.fingerprint("archived", file_id),
+        *(datastore.fingerprint("sheets", path) for path in includes),
+        images.fingerprint("images"),
+        user.login if user else "",
+        user.privileges.conduit_generation if user else False,
+    )
+    if (cached := not_modified(request, etag)) is not None:
+        return cached
+    response.headers["ETag"] = etag
+
     solved_problems = {}
     problems = []
     styles = []
@@ -160,12 +196,42 @@ async def read_file(file_id: str, user: User = Depends(get_current_user)):
 async def delete_file(file_id: str):
     if file_id not in datastore.sheets:
         raise HTTPException(status_code=404, detail=locale["exceptions"]["file_not_found"] % dict(filename=file_id))
-    with datastore.operation():
+    async with datastore.aoperation("sheets", file_id):
         del datastore.sheets[file_id]
     await socket_manager.broadcast({"action": "DeleteSheet", "id": file_id})
     return {"success": True}
 
 
+@sheets_app.get("/archived", dependencies=[Depends(RequireScope("sheets_edit"))])
+async def archived_list():
+    return [{"id": key, **info} for key, info in reversed(sheet_archive.list().items())]
+
+
+@sheets_app.post("/archive/{sheet_id}", dependencies=[Depends(RequireScope("sheets_edit"))])
+async def archive_sheet(sheet_id: str):
+    if sheet_id not in datastore.sheets:
+        raise HTTPException(status_code=404, detail=locale["exceptions"]["file_not_found"] % dict(filename=sheet_id))
+
+    info = {"name": datastore.sheets[sheet_id]["latex"]["sheet_name"]}
+    try:
+        await anyio.to_thread.run_sync(sheet_archive.archive, sheet_id, info)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=locale["exceptions"]["file_not_found"] % dict(filename=sheet_id))
+    await socket_manager.broadcast({"action": "DeleteSheet", "id": sheet_id})
+    return {"success": True}
+
+
+@sheets_app.post("/unarchive/{sheet_id}", dependencies=[Depends(RequireScope("sheets_edit"))])
+async def unarchive_sheet(sheet_id: str):
+    try:
+        await anyio.to_thread.run_sync(sheet_archive.restore, sheet_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=locale["exceptions"]["file_not_found"] % dict(filename=sheet_id))
+    name = datastore.sheets[sheet_id]["latex"]["sheet_name"]
+    await socket_manager.broadcast({"action": "NewSheet", "id": sheet_id, "name": name})
+    return {"success": True}
+
+
 @sheets_app.post("/figure/{figure_id}")
 async def create_figure(figure_id: str, file: UploadFile):
     if file.content_type not in ("image/png", "image/jpeg"):
@@ -176,7 +242,7 @@ async def create_figure(figure_id: str, file: UploadFile):
     if figure_id in images.images:
         raise HTTPException(status_code=409, detail=locale["exceptions"]["image_already_exists"] % dict(name=figure_id))
 
-    file_content = file.file.read(MaxFileSize + 1)
+    file_content = await file.read(MaxFileSize + 1)
     if len(file_content) > MaxFileSize:
         raise HTTPException(status_code=400, detail=locale["exceptions"]["image_too_large"])
 
@@ -186,10 +252,9 @@ async def create_figure(figure_id: str, file: UploadFile):
         raise HTTPException(status_code=409, detail=locale["exceptions"]["error_while_randomname"])
 
     upload_path.parent.mkdir(parents=True, exist_ok=True)
-    with open(upload_path, "wb") as f:
-        f.write(file_content)
+    await anyio.to_thread.run_sync(upload_path.write_bytes, file_content)
 
-    with images.operation():
+    async with images.aoperation("images", figure_id):
         images.images[figure_id] = {"filename": str(upload_path)}
     return {"success": True}
 
@@ -216,6 +281,7 @@ async def image_editor(request: Request, user: User = Depends(RequireScope("shee
 
 @sheets_app.post("/unbrick/{sheet_id}", dependencies=[Depends(RequireScope("admin"))])
 async def unbrick_sheet(sheet_id: str):
+    socket_context = socket_contexts.current()
     data = socket_context.pop(sheet_id, None)
     if not data:
         return {"success": False}
@@ -249,12 +315,10 @@ async def editor_websocket(websocket: WebSocket):
         raise WebSocketDisconnect(code=1008)
 
     handle = await socket_manager.connect(websocket)
+    socket_context = socket_contexts.current()
 
     try:
-        file_dict = [
-            {"id": key, "name": value["latex"]["sheet_name"], "has_conduit": "conduit" in value}
-            for key, value in datastore.sheets.items()
-        ]
+        file_dict = [{"id": key, **summary} for key, summary in datastore.summaries("sheets").items()]
 
         await websocket.send_json(
             {"action": "Init", "files": list(reversed(file_dict)), "open_sheets": socket_context, "handle": handle.id}
@@ -1,8 +1,13 @@
-from fastapi import Depends, FastAPI
+import anyio
+from fastapi import Depends, FastAPI, HTTPException
 from starlette.middleware import Middleware
 from starlette.middleware.sessions import SessionMiddleware
+from starlette.requests import HTTPConnection, Request
+from starlette.responses import RedirectResponse
 from starlette.staticfiles import StaticFiles
 
+from pyconduit.shared.datastore import datastore_manager, datastore_route, datastore_tenant, datastore_tenants
+from pyconduit.shared.formulas import formula_pool, profile_pool
 from pyconduit.shared.helpers import get_config
 from pyconduit.shared.init import init_databases
 from pyconduit.website.decorators import get_current_user
@@ -21,6 +26,65 @@ app = FastAPI(
     middleware=[Middleware(SessionMiddleware, secret_key=cfg["session_salt"])],
 )
 
+
+@app.on_event("startup")
+def start_formula_pool():
+    formula_pool.start()
+
+
+@app.on_event("shutdown")
+def stop_formula_pool():
+    formula_pool.close()
+    profile_pool.close()
+
+
+@app.middleware("http")
+async def refresh_datastores(request: Request, call_next):
+    # Picks up the changes written by the other worker processes, does nothing with a single worker.
+    # Reading them waits for the disk and for commits in progress, so it is kept off the event loop
+    if datastore_manager.shared:
+        await anyio.to_thread.run_sync(datastore_manager.refresh)
+    # Saves are counted per route in the datastore stats, ids further down the path are left out
+    datastore_route.set("/".join(request.url.path.split("/")[:3]))
+    return await call_next(request)
+
+
+class TenantMiddleware:
+    """
+    Selects the course of every request and websocket: the first label of the host when it names a tenant,
+    otherwise the tenant cookie set by /t/<name>. Everything else runs in the default course.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] not in ("http", "websocket"):
+            return await self.app(scope, receive, send)
+
+        connection = HTTPConnection(scope)
+        tenant = connection.headers.get("host", "").split(".")[0]
+        if tenant not in datastore_tenants:
+            tenant = connection.cookies.get("tenant")
+        token = datastore_tenant.set(tenant if tenant in datastore_tenants else None)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            datastore_tenant.reset(token)
+
+
+app.add_middleware(TenantMiddleware)
+
+
+@app.get("/t/{tenant}")
+async def select_tenant(tenant: str):
+    if tenant not in datastore_tenants:
+        raise HTTPException(status_code=404)
+    response = RedirectResponse("/", status_code=303)
+    response.set_cookie("tenant", tenant, samesite="lax")
+    return response
+
+
 app.mount("/static", StaticFiles(directory="static"), name="static")
 app.mount("/conduit", conduit_app)
 app.mount("/login", login_app)
@@ -6,5 +6,8 @@ if [ -f PIDlock ]; then
   exit 1
 fi
 
+# More than one worker needs `shared: true` in the datastore config
+WORKERS=${WORKERS:-1}
+
 source venv/bin/activate
-python3 venv/bin/uvicorn --port 7554 --host 0.0.0.0 --workers 1 pyconduit.website.website:app
+python3 venv/bin/uvicorn --port 7554 --host 0.0.0.0 --workers "$WORKERS" pyconduit.website.website:app
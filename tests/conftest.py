@@ -0,0 +1,17 @@
+import os
+import sys
+
+import pytest
+
+# The config is read relative to the working directory, as when the website is started from the repository
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.chdir(root)
+sys.path.insert(0, root)
+
+
+@pytest.fixture
+def datastore_class(tmp_path, monkeypatch):
+    from pyconduit.shared.datastore import DatastoreJSON, GroupCommitWriter
+
+    monkeypatch.setattr(GroupCommitWriter, "retryInterval", 0.01)
+    return type("DatastoreTest", (DatastoreJSON,), {"baseDataFolder": str(tmp_path), "groupCommitInterval": 0.01})
@@ -0,0 +1,40 @@
+from pyconduit.shared.account_index import AccountIndex
+
+
+def account(login: str, name: str, **privileges) -> dict:
+    return dict(login=login, name=name, privileges=dict(privileges))
+
+
+def test_changed_accounts_are_indexed_again(datastore_class):
+    datastore = datastore_class("accounts")
+    with datastore.operation():
+        datastore["accounts"] = {
+            "bob": account("bob", "Bob"),
+            "alice": account("alice", "Alice", admin=True),
+            "teacher": account("teacher", "Teacher", conduit_generation=False),
+        }
+    index = AccountIndex(datastore)
+    assert [user.login for user in index.all()] == ["bob", "alice", "teacher"]
+    assert [user.login for user in index.roster()] == ["alice", "bob"]
+    assert index.with_privilege("admin") == {"alice"}
+
+    parsed = index.get("teacher")
+    with datastore.operation("accounts", "bob"):
+        datastore.accounts["bob"]["name"] = "Zed"
+        datastore.accounts["bob"]["privileges"]["admin"] = True
+    with datastore.operation("accounts", "carol"):
+        datastore.accounts["carol"] = account("carol", "Bob")
+    with datastore.operation("accounts", "alice"):
+        del datastore.accounts["alice"]
+
+    assert [user.login for user in index.all()] == ["bob", "teacher", "carol"]
+    assert [user.login for user in index.roster()] == ["carol", "bob"]
+    assert index.with_privilege("admin") == {"bob"}
+    assert index.login_by_name("Bob") == "carol" and index.get("alice") is None
+    # Only the changed accounts were parsed again
+    assert index.get("teacher") is parsed
+
+    with datastore.operation():
+        datastore["accounts"] = {"dave": account("dave", "Dave")}
+    assert [user.login for user in index.roster()] == ["dave"]
+    assert index.with_privilege("admin") == set()
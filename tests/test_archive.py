@@ -0,0 +1,36 @@
+import os
+
+import pytest
+
+from pyconduit.shared.archive import Archive
+from pyconduit.shared.datastore import deatomize
+
+
+def test_archived_values_leave_the_datastore_and_come_back(datastore_class):
+    datastore = datastore_class("archive")
+    sheet = {"name": "Past term", "users": ["alice"]}
+    with datastore.operation():
+        datastore["sheets"] = {"01": sheet, "02": {"name": "Current"}}
+        datastore["archived"] = {}
+    archive = Archive(datastore, "sheets", "archived")
+
+    archive.archive("01", {"name": "Past term"})
+    with pytest.raises(KeyError):
+        archive.archive("01")
+    assert "01" not in datastore.sheets and "01" in archive
+    assert os.path.exists(archive.filename("01"))
+    datastore.flush()
+
+    # Another process lists it from the index and reads it from the file
+    other = Archive(datastore_class("archive"), "sheets", "archived")
+    assert list(other.datastore.sheets) == ["02"]
+    assert other.list()["01"]["name"] == "Past term" and "archived" in other.list()["01"]
+    assert other.read("01") == sheet
+
+    archive.restore("01")
+    with pytest.raises(KeyError):
+        archive.restore("01")
+    assert not os.path.exists(archive.filename("01"))
+    reloaded = datastore_class("archive")
+    assert deatomize(reloaded.data) == {"sheets": {"02": {"name": "Current"}, "01": sheet}, "archived": {}}
+    assert list(reloaded.sheets) == ["02", "01"]
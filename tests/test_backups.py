@@ -0,0 +1,33 @@
+import io
+import json
+import random
+
+from pyconduit.shared.backups import BackupStore, MaxChunkSize, content_chunks
+
+
+def lines(count: int, seed: int = 0) -> bytes:
+    rng = random.Random(seed)
+    return b"".join(json.dumps({"login": f"user{i}", "score": rng.random()}).encode() + b"\n" for i in range(count))
+
+
+def test_chunks_keep_the_bytes():
+    data = lines(20000) + b"partial line" + b"x" * (3 * MaxChunkSize)
+    chunks = list(content_chunks(io.BytesIO(data), len(data)))
+    assert b"".join(chunks) == data
+    assert max(map(len, chunks)) <= MaxChunkSize
+    assert b"".join(content_chunks(io.BytesIO(data), 100)) == data[:100]
+
+
+def test_insertion_only_stores_the_chunks_around_it(tmp_path):
+    data = lines(50000)
+    store = BackupStore(str(tmp_path / "backups"))
+    path = tmp_path / "data.json"
+    path.write_bytes(data)
+    before, _ = store.store_file(str(path), len(data))
+    assert len(before) > 10
+
+    edited = data[:1000] + b'{"login": "inserted"}\n' + data[1000:]
+    path.write_bytes(edited)
+    after, _ = store.store_file(str(path), len(edited))
+    assert len(set(after) - set(before)) <= 2
+    assert b"".join(map(store.read_chunk, after)) == edited
@@ -0,0 +1,348 @@
+import asyncio
+import json
+import os
+import threading
+import time
+
+import pytest
+
+from pyconduit.shared.datastore import (
+    AtomicDict,
+    DatastoreManager,
+    DatastoreSQLite,
+    Patch,
+    ScopeLocks,
+    TenantLocal,
+    datastore_route,
+    datastore_tenant,
+    deatomize,
+)
+
+
+def test_failed_commit_is_reported_and_retried(datastore_class, monkeypatch):
+    datastore = datastore_class("sheets")
+    fsync = os.fsync
+    failing = True
+
+    def failing_fsync(fd):
+        if failing:
+            raise OSError(5, "Input/output error")
+        fsync(fd)
+
+    monkeypatch.setattr(os, "fsync", failing_fsync)
+
+    async def edit():
+        async with datastore.aoperation("sheets"):
+            datastore["sheets"] = {"01": 1}
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(edit())
+    assert datastore.writer.committed == 0
+
+    failing = False
+    datastore.flush()
+    assert deatomize(datastore_class("sheets").data) == {"sheets": {"01": 1}}
+
+
+def test_routes_are_charged_the_bytes_their_commits_write(datastore_class):
+    datastore = datastore_class("sheets")
+    with datastore.operation():
+        datastore["sheets"] = {}
+    for route, size in (("/small", 10), ("/large", 10000)):
+        token = datastore_route.set(route)
+        try:
+            with datastore.operation("sheets", route):
+                datastore.sheets[route] = "x" * size
+        finally:
+            datastore_route.reset(token)
+        # Operations committed in one batch share its bytes by their number of updates
+        datastore.flush()
+
+    routes = datastore.stats.dump()["routes"]
+    assert routes["/small"]["operations"] == routes["/large"]["operations"] == 1
+    assert 10 <= routes["/small"]["payload"] < 1000 <= 10000 <= routes["/large"]["payload"]
+    assert sum(route["payload"] for route in routes.values()) <= datastore.stats.bytesWritten
+
+
+@pytest.mark.parametrize("backend", ["json", "sqlite"])
+def test_shared_processes_converge(backend, tmp_path):
+    from pyconduit.setup import stress
+
+    expected, states, reloaded = stress(backend, workers=3, operations=40, sheets=4, folder=str(tmp_path))
+    assert [worker for worker, _, _ in states] == [0, 1, 2]
+    assert all(state == expected for _, _, state in states)
+    assert reloaded == expected
+
+
+def test_journal_replay_drops_a_torn_record(datastore_class):
+    datastore = datastore_class("journal")
+    with datastore.operation():
+        datastore["a"] = {"x": 1}
+    datastore.flush()
+    # A process died in the middle of an append
+    with open(datastore.journalFilename, "ab") as f:
+        f.write(b'[["set",["a","torn"],')
+
+    with datastore.operation():
+        datastore.a["y"] = 2
+    datastore.flush()
+    with open(datastore.journalFilename, "rb") as f:
+        assert [json.loads(line) for line in f] == [
+            [["set", ["a"], {"x": 1}]],
+            [["set", ["a", "y"], 2]],
+        ]
+
+    with open(datastore.journalFilename, "ab") as f:
+        f.write(b'[["set",["a","torn"],')
+    reloaded = datastore_class("journal")
+    assert deatomize(reloaded.data) == {"a": {"x": 1, "y": 2}}
+    with open(reloaded.journalFilename, "rb") as f:
+        assert f.read() == b'{"generation": 1}\n'
+
+
+def test_shared_readers_follow_the_journal_generations(datastore_class):
+    shared_class = type("DatastoreShared", (datastore_class,), {"checkpointInterval": 2})
+    with open(f"{shared_class.baseDataFolder}/generations.journal", "w") as f:
+        # Written before the generation header was added
+        f.write('[["set",["n"],0]]\n')
+    writer, reader = shared_class("generations", True), shared_class("generations", True)
+    assert reader["n"] == 0 and reader.journalGeneration == 1
+
+    def write(n):
+        with writer.operation():
+            writer["n"] = n
+        writer.flush()
+
+    write(1)
+    reader.refresh()
+    assert reader["n"] == 1
+
+    write(2)
+    with open(writer.journalFilename, "rb") as f:
+        assert f.readline() == b'{"generation": 2}\n'
+    reader.refresh()
+    assert reader["n"] == 2 and reader.journalGeneration == 2
+
+    # The reader missed a whole generation and loads everything again
+    for n in range(3, 7):
+        write(n)
+    reader.refresh()
+    assert reader["n"] == 6 and reader.journalGeneration == 4
+
+
+def test_sqlite_saves_only_the_changed_rows(tmp_path):
+    sqlite_class = type(
+        "DatastoreTest", (DatastoreSQLite,), {"baseDataFolder": str(tmp_path), "groupCommitInterval": 0}
+    )
+    datastore = sqlite_class("sheets")
+    with datastore.operation():
+        datastore["sheets"] = {"01": {"name": "a" * 1000}, "02": {"name": "b"}, "03": {"name": "c"}}
+        datastore["settings"] = {"theme": "dark"}
+
+    written = datastore.stats.bytesWritten
+    with datastore.operation("sheets", "02"):
+        datastore.sheets["02"]["name"] = "b2"
+    assert datastore.stats.bytesWritten - written == len(json.dumps({"name": "b2"}))
+
+    with datastore.operation():
+        del datastore.sheets["01"]
+        datastore.sheets["04"] = {"name": "d"}
+    with datastore.operation():
+        datastore.sheets["01"] = {"name": "a"}
+    rows = datastore.connection.execute("SELECT key, value FROM documents ORDER BY rowid").fetchall()
+    assert rows == [
+        ("02", '{"name": "b2"}'),
+        ("03", '{"name": "c"}'),
+        ("theme", '"dark"'),
+        ("04", '{"name": "d"}'),
+        ("01", '{"name": "a"}'),
+    ]
+    assert deatomize(sqlite_class("sheets").data) == deatomize(datastore.data)
+    assert list(sqlite_class("sheets").sheets) == ["02", "03", "04", "01"]
+
+
+def test_views_record_the_paths_they_change():
+    raw = {"sheets": {"01": {"users": [{"login": "alice"}]}}}
+    data = AtomicDict(raw)
+    users = data.sheets["01"].users
+    assert users._data is raw["sheets"]["01"]["users"] and not data.updates
+
+    users.append({"login": "bob"})
+    users[0]["name"] = "Alice"
+    data.sheets.pop("02")
+    assert list(data.updates.records()) == [
+        ("append", ("sheets", "01", "users", 1), {"login": "bob"}),
+        ("set", ("sheets", "01", "users", 0, "name"), "Alice"),
+        ("delete", ("sheets", "02"), None),
+    ]
+
+    # Assigned values are copied, so later changes to them do not reach the data or the patch
+    value = {"login": "carol"}
+    users[1] = value
+    value["login"] = "dave"
+    assert raw["sheets"]["01"]["users"][1] == {"login": "carol"}
+    assert list(data.updates.records())[0] == ("append", ("sheets", "01", "users", 1), {"login": "carol"})
+    users[1]["login"] = "erin"
+    assert list(data.updates.records())[0] == ("append", ("sheets", "01", "users", 1), {"login": "carol"})
+
+
+def test_patch_keeps_one_operation_per_path():
+    patch = Patch()
+    patch.record(("users",), Patch.SET, [])
+    patch.record(("users", 0), Patch.APPEND, "alice")
+    # Setting the appended element still has to create it
+    patch.record(("users", 0), Patch.SET, "bob")
+    patch.record(("sheets", "01", "name"), Patch.SET, "a")
+    patch.record(("sheets", "01"), Patch.DELETE)
+    patch.record(("sheets", "02"), Patch.SET, {"name": "b"})
+    patch.record(("sheets", "02", "users"), Patch.SET, ["bob"])
+    assert list(patch.records()) == [
+        ("set", ("users",), []),
+        ("append", ("users", 0), "bob"),
+        ("delete", ("sheets", "01"), None),
+        ("set", ("sheets", "02"), {"name": "b"}),
+        ("set", ("sheets", "02", "users"), ["bob"]),
+    ]
+
+    data = {"sheets": {"01": {"name": "old"}}}
+    patch.apply(data)
+    expected = {"users": ["bob"], "sheets": {"02": {"name": "b", "users": ["bob"]}}}
+    assert data == expected
+    # Applying changed neither the patch nor any other data it is applied to
+    assert list(patch.records())[0] == ("set", ("users",), [])
+    assert list(patch.records())[3] == ("set", ("sheets", "02"), {"name": "b"})
+    data["sheets"]["02"]["name"] = "changed"
+    other = {"sheets": {}}
+    Patch.from_records(json.loads(patch.dump())).apply(other)
+    patch.apply(other)
+    assert other == expected
+
+
+def test_patch_with_list_deletes_can_be_applied_twice():
+    patch = Patch()
+    patch.record(("users",), Patch.SET, ["alice", "bob", "carol"])
+    patch.record(("users", 0), Patch.DELETE)
+    first, second = {}, {}
+    patch.apply(first)
+    patch.apply(second)
+    assert first == second == {"users": ["bob", "carol"]}
+
+
+def test_scope_locks_exclude_nested_paths():
+    locks = ScopeLocks()
+    acquired = []
+
+    def hold(scope):
+        with locks.hold(scope):
+            acquired.append(scope)
+
+    with locks.hold(("sheets", "01")):
+        sibling = threading.Thread(target=hold, args=(("sheets", "02"),))
+        sibling.start()
+        sibling.join(5)
+        assert acquired == [("sheets", "02")]
+
+        nested = [threading.Thread(target=hold, args=(scope,)) for scope in (("sheets",), (), ("sheets", "01", "x"))]
+        for thread in nested:
+            thread.start()
+        time.sleep(0.1)
+        assert acquired == [("sheets", "02")]
+    for thread in nested:
+        thread.join(5)
+    assert sorted(acquired) == [(), ("sheets",), ("sheets", "01", "x"), ("sheets", "02")]
+
+
+def test_async_scope_locks_wait_on_the_event_loop():
+    locks = ScopeLocks()
+
+    async def hold(scope, acquired):
+        async with locks.ahold(scope):
+            acquired.append(scope)
+
+    async def main():
+        acquired = []
+        with locks.hold(("sheets", "01")):
+            await asyncio.wait_for(hold(("accounts",), acquired), 5)
+            waiting = asyncio.create_task(hold(("sheets",), acquired))
+            await asyncio.sleep(0.05)
+            assert acquired == [("accounts",)] and not waiting.done()
+        await asyncio.wait_for(waiting, 5)
+        assert acquired == [("accounts",), ("sheets",)]
+
+    asyncio.run(main())
+
+
+def test_fingerprints_change_with_their_values_only(datastore_class):
+    datastore = datastore_class("fingerprints")
+    with datastore.operation():
+        datastore["sheets"] = {"01": {"name": "a", "users": ["alice"]}, "02": {"name": "b"}}
+    first, second, root = (datastore.fingerprint(*path) for path in (("sheets", "01"), ("sheets", "02"), ("sheets",)))
+    assert len({first, second, root}) == 3
+    assert datastore.fingerprint("sheets", "03") == datastore.fingerprint("missing")
+
+    with datastore.operation("sheets", "02"):
+        datastore.sheets["02"]["name"] = "b2"
+    # The untouched sibling keeps its hash without hashing it again
+    assert datastore.fingerprints.lookup(("sheets", "01")).digest.hex() == first
+    assert datastore.fingerprint("sheets", "01") == first
+    assert datastore.fingerprint("sheets", "02") != second
+    assert datastore.fingerprint("sheets") != root
+
+    with datastore.operation("sheets", "01"):
+        datastore.sheets["01"]["users"].append("bob")
+    assert datastore.fingerprint("sheets", "01") != first
+    with datastore.operation("sheets", "02"):
+        datastore.sheets["02"]["name"] = "b"
+    with datastore.operation("sheets", "01"):
+        datastore.sheets["01"] = {"name": "a", "users": ["alice"]}
+    assert datastore.fingerprint("sheets", "01") == first
+    assert datastore.fingerprint("sheets") == root
+
+
+def test_fingerprints_follow_the_changes_of_other_processes(datastore_class):
+    writer, reader = datastore_class("fingerprints", True), datastore_class("fingerprints", True)
+    with writer.operation():
+        writer["sheets"] = {"01": {"name": "a"}}
+    writer.flush()
+    reader.refresh()
+    before = reader.fingerprint("sheets", "01")
+
+    with writer.operation("sheets", "01"):
+        writer.sheets["01"]["name"] = "b"
+    writer.flush()
+    reader.refresh()
+    assert reader.fingerprint("sheets", "01") == writer.fingerprint("sheets", "01") != before
+
+
+def test_tenants_have_their_own_datastores(datastore_class, tmp_path):
+    manager = DatastoreManager("json", shared=False)
+    manager.accountCtor = datastore_class
+    accounts = manager.scoped("accounts")
+    indexes = TenantLocal(dict)
+
+    def write(tenant, login):
+        token = datastore_tenant.set(tenant)
+        try:
+            with accounts.operation():
+                accounts["accounts"] = {login: {"login": login}}
+            accounts.flush()
+            indexes.current()[login] = tenant
+        finally:
+            datastore_tenant.reset(token)
+
+    write(None, "admin")
+    write("a", "alice")
+    write("b", "bob")
+
+    def read(tenant):
+        token = datastore_tenant.set(tenant)
+        try:
+            return list(accounts["accounts"]), "admin" in indexes, manager.qualify("accounts")
+        finally:
+            datastore_tenant.reset(token)
+
+    assert read(None) == (["admin"], True, "accounts")
+    assert read("a") == (["alice"], False, "a/accounts")
+    assert read("b") == (["bob"], False, "b/accounts")
+    assert os.path.exists(tmp_path / "a" / "accounts.journal") and os.path.exists(tmp_path / "b" / "accounts.journal")
+    assert list(datastore_class("a/accounts")["accounts"]) == ["alice"]
@@ -0,0 +1,100 @@
+import pytest
+
+from pyconduit.models.conduit import ConduitContent
+from pyconduit.shared.formulas import (
+    MEMORY_LIMIT,
+    PROFILE_TIME_LIMIT,
+    TIME_LIMIT,
+    FormulaPool,
+    compile_formula,
+    profile_pool,
+    reads_only_arguments,
+    run_formula,
+    run_profiled,
+)
+
+RANKED = """
+totals = {}
+def total(position, login, name, row):
+    totals[login] = len([value for value in row if is_solved(value)])
+    return totals[login]
+provider.add_column(None, 'total', total)
+def rank(position, login, name, row):
+    return 1 + len([other for other in totals if totals[other] > totals[login]])
+provider.add_column(None, 'rank', rank)
+"""
+
+
+def document(content: dict[str, list[str]]) -> dict:
+    problems = ["1", "2"]
+    return dict(
+        id="01",
+        name="Sheet",
+        users=[dict(login=login, name=login) for login in content],
+        conduit=dict(content=content, problem_names=problems, problem_text_cache=[""] * len(problems)),
+        real_indices=list(range(len(problems))),
+    )
+
+
+def test_cross_row_column_is_not_incremental():
+    assert not reads_only_arguments(compile_formula(RANKED))
+    assert not reads_only_arguments(compile_formula("def total(p, u, n, row, seen=[]):\n    return len(seen)"))
+    assert reads_only_arguments(compile_formula("def total(p, u, n, row):\n    return len(row)"))
+
+    previous, output = run_formula(document({"alice": ["1", ""], "bob": ["1", "1"]}), RANKED)
+    assert not output, output
+    assert previous["conduit"]["content"] == {"alice": ["1", "", "1", "2"], "bob": ["1", "1", "2", "1"]}
+
+    # Only alice's cell changed, but bob's rank depends on her total
+    content = {"alice": ["1", "1"], "bob": ["1", "1"]}
+    result, output = run_formula(document(content), RANKED, previous, [("alice", "2")])
+    assert not output, output
+    assert result == run_formula(document(content), RANKED)[0]
+    assert result["conduit"]["content"]["bob"] == ["1", "1", "2", "1"]
+    assert result["conduit"]["content"]["alice"] == ["1", "1", "2", "1"]
+
+
+def test_scores_beyond_64_bits():
+    formula = "provider.add_column_values(None, 'sum', provider.scores().row_sums())"
+    result, output = run_formula(document({"alice": [str(2**70), "1"], "bob": ["2", ""]}), formula)
+    assert not output, output
+    assert result["conduit"]["content"]["alice"][-1] == str(2**70 + 1)
+    assert result["conduit"]["content"]["bob"][-1] == "2"
+
+
+def test_profile_timeout_cannot_be_caught():
+    formula = """
+def spin(position, login, name, row):
+    while True:
+        try:
+            name = name + "."
+        except Exception:
+            pass
+provider.add_column(None, 'spin', spin)
+"""
+    result, output, report = run_profiled(document({"alice": ["1", ""]}), formula, 0.2)
+    assert report["timed_out"]
+    assert "Formula execution stopped after 0.2 s" in output
+
+
+def test_profile_workers_have_the_cpu_time_of_their_profiles():
+    assert profile_pool.cpu_limit >= PROFILE_TIME_LIMIT * profile_pool.tasks_per_worker
+
+
+def test_dead_workers_are_replaced():
+    pool = FormulaPool(1, MEMORY_LIMIT, TIME_LIMIT, 10)
+    doc = ConduitContent.parse_obj(document({"alice": ["1", ""]}))
+    try:
+        pool.start()
+        worker = pool.idle[0]
+        worker.process.kill()
+        worker.process.join()
+        with pytest.raises(RuntimeError):
+            worker.run(doc.dict(), "", None, [], TIME_LIMIT)
+
+        pool.idle = [worker]
+        result, output = pool.execute(doc, "provider.add_column_values(None, 'n', [1])")
+        assert not output, output
+        assert result["conduit"]["content"]["alice"] == ["1", "", "1"]
+    finally:
+        pool.close()